@@ -2,7 +2,7 @@
 Data structures for events, examples, and datasets.
 '''
 
-from util import read_json
+from util import iter_json
 from event import Event
 from scenario_db import Scenario
 
@@ -63,20 +63,27 @@ def read_examples(scenario_db, paths, max_examples):
     '''
     Read a maximum of |max_examples| examples from |paths|.
     '''
-    examples = []
+    return list(iter_examples(scenario_db, paths, max_examples))
+
+def iter_examples(scenario_db, paths, max_examples=None):
+    '''
+    Yield a maximum of |max_examples| examples from |paths| (JSON lists or .jsonl files),
+    parsing the transcripts lazily and stopping as soon as enough examples are read.
+    '''
+    num_examples = 0
     for path in paths:
-        print 'read_examples: %s' % path
-        if max_examples and len(examples) >= max_examples:
+        if max_examples and num_examples >= max_examples:
             break
-        for raw in read_json(path):
-            if max_examples and len(examples) >= max_examples:
+        print 'read_examples: %s' % path
+        for raw in iter_json(path):
+            if max_examples and num_examples >= max_examples:
                 break
-            examples.append(Example.from_dict(scenario_db, raw))
-    return examples
+            yield Example.from_dict(scenario_db, raw)
+            num_examples += 1
 
 def add_dataset_arguments(parser):
-    parser.add_argument('--train-examples-paths', help='Input training examples', nargs='*', default=[])
-    parser.add_argument('--test-examples-paths', help='Input test examples', nargs='*', default=[])
+    parser.add_argument('--train-examples-paths', help='Input training examples (JSON list or .jsonl)', nargs='*', default=[])
+    parser.add_argument('--test-examples-paths', help='Input test examples (JSON list or .jsonl)', nargs='*', default=[])
     parser.add_argument('--train-max-examples', help='Maximum number of training examples', type=int)
     parser.add_argument('--test-max-examples', help='Maximum number of test examples', type=int)
 
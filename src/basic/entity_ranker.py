@@ -11,20 +11,26 @@ from sklearn.feature_extraction import DictVectorizer
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.linear_model import LogisticRegression
 from stop_words import get_stop_words
+from util import LRUCache
 
 
 class EntityRanker(object):
     """
     Learned ranker for ranking candidates of a span of text for the lexicon
     """
-    def __init__(self, entity_annotations, scenarios, train_data, transcripts_infile):
+    def __init__(self, entity_annotations, scenarios, train_data, transcripts_infile, feature_cache_size=100000):
         """
         :param entity_annotations:  Path to JSON of entity annotations
         :param scenarios: Path to scenarios file for generating training instance and feature vectorizing
         :param train_data: Path to file with train data
         :param transcripts_infile:
+        :param feature_cache_size: Number of (span, entity) pairs whose string features are remembered
         :return:
         """
+        # Features of a (span, entity) pair that do not depend on the scenario, as dicts for
+        # training and as rows of the feature matrix for scoring
+        self.string_feature_cache = LRUCache(feature_cache_size)
+        self.string_vector_cache = LRUCache(feature_cache_size)
         self._get_uuid_to_kbs(scenarios)
         # Rudimentary python stop word list
         self.stop_words = set(get_stop_words("en"))
@@ -73,6 +79,8 @@ class EntityRanker(object):
 
         # Map from uuid to KBs
         uuid_to_kbs = collections.defaultdict(dict)
+        # Map from uuid to entities (surface form only) in KBs
+        uuid_to_kb_entities = {}
         for scenario in scenarios_info:
             uuid = scenario["uuid"]
             agent_kbs = {0: set(), 1: set()}
@@ -82,34 +90,29 @@ class EntityRanker(object):
                     row_entities = [(e[0], e[1].lower()) for e in row_entities]
                     agent_kbs[agent_idx].update(row_entities)
             uuid_to_kbs[uuid] = agent_kbs
+            uuid_to_kb_entities[uuid] = {agent_idx: set([e[1] for e in entities]) for agent_idx, entities in agent_kbs.iteritems()}
 
         self.uuid_to_kbs = uuid_to_kbs
+        self.uuid_to_kb_entities = uuid_to_kb_entities
 
 
-    def _feature_func(self, span, entity, agent, uuid):
+    def _string_features(self, span, entity):
         """
-        Get a series of features between a span of text and a candidate entity
+        Get features between a span of text and a candidate entity that only depend on the two strings.
+        Features are memoized since the same pairs come up across candidates and dialogues.
         :param span:
         :param entity:
-        :param agent: Id of agent so we know which set of entities to use from scenario
-        :param uuid: uuid of scenario to with available KBs
-        :return:
+        :return: Dict of features (shared, do not modify)
         """
+        features = self.string_feature_cache.get((span, entity))
+        if features is not None:
+            return features
+
         entity_clean = re.sub("-", " ", entity)
         entity_clean_tokens = entity_clean.split()
         span_tokens = span.split()
 
-        try:
-            # Set of entities for given agent
-            kb_entities = self.uuid_to_kbs[uuid][agent]
-            # Only consider entity surface form and not type
-            kb_entities = set([e[1] for e in kb_entities])
-        except:
-            kb_entities = None
-            print "No entities found for scenario: {0} and agent: {1}".format(uuid, str(agent))
-
-
-        features = collections.defaultdict(float)
+        features = {}
         if span == entity:
             features["EXACT_MATCH"] = 1.0
 
@@ -147,17 +150,63 @@ class EntityRanker(object):
         # TODO: Good way to incorporate TF-IDF scores?
         #features["TFIDF_DIFF"] = -1*entity_tfidf + span_tfidf
 
-
-        # KB context - upweight if entity is in current agent's KB
-        if kb_entities is not None and entity in kb_entities:
-            features["IN_KB"] = 1.0
-
         # TODO: Use type features?
 
         # Feature if both span and entity are stop word
         if span in self.stop_words and entity in self.stop_words:
             features["SPAN_AND_ENTITY_STOP"] = 1.0
 
+        self.string_feature_cache.put((span, entity), features)
+        return features
+
+
+    def _string_vector(self, span, entity):
+        """
+        _string_features as a row of the feature matrix of the trained vectorizer
+        :param span:
+        :param entity:
+        :return: Array (shared, do not modify)
+        """
+        vector = self.string_vector_cache.get((span, entity))
+        if vector is None:
+            vector = np.zeros(len(self.feature_index))
+            for f, value in self._string_features(span, entity).iteritems():
+                if f in self.feature_index:
+                    vector[self.feature_index[f]] = value
+            self.string_vector_cache.put((span, entity), vector)
+        return vector
+
+
+    def _kb_entities(self, agent, uuid):
+        """
+        Set of entities (surface form only) for given agent, None if the scenario is unknown
+        :param agent:
+        :param uuid:
+        :return:
+        """
+        try:
+            return self.uuid_to_kb_entities[uuid][agent]
+        except KeyError:
+            print "No entities found for scenario: {0} and agent: {1}".format(uuid, str(agent))
+            return None
+
+
+    def _feature_func(self, span, entity, agent, uuid):
+        """
+        Get a series of features between a span of text and a candidate entity
+        :param span:
+        :param entity:
+        :param agent: Id of agent so we know which set of entities to use from scenario
+        :param uuid: uuid of scenario to with available KBs
+        :return:
+        """
+        kb_entities = self._kb_entities(agent, uuid)
+
+        features = collections.defaultdict(float, self._string_features(span, entity))
+
+        # KB context - upweight if entity is in current agent's KB
+        if kb_entities is not None and entity in kb_entities:
+            features["IN_KB"] = 1.0
 
         return features
 
@@ -224,6 +273,13 @@ class EntityRanker(object):
         # Train classifier
         classifier.fit(feature_vecs_transform, np.array(labels))
 
+        # Logistic regression is a linear function of the features: scores of stacked feature
+        # vectors are one matrix product (see score_batch)
+        assert len(classifier.classes_) == 2
+        self.feature_index = self.vectorizer.vocabulary_
+        self.weights = classifier.coef_[0]
+        self.intercept = classifier.intercept_[0]
+
         return classifier
 
 
@@ -236,11 +292,26 @@ class EntityRanker(object):
         :param uuid:
         :return:
         """
-        features = self._feature_func(span, entity, agent, uuid)
-        features_transformed = self.vectorizer.transform(features)
+        return self.score_batch(span, [entity], agent, uuid)
+
 
-        #print "Score: ", self.classifier.predict(features_transformed)
-        return self.classifier.predict_proba(features_transformed)
+    def score_batch(self, span, entities, agent, uuid):
+        """
+        Score a span against a list of entities: their feature vectors are stacked and scored
+        with a single matrix product
+        :param span:
+        :param entities: List of entities
+        :param agent:
+        :param uuid:
+        :return: Array with one row per entity, each row being what classifier.predict_proba returns for it
+        """
+        features = np.array([self._string_vector(span, entity) for entity in entities])
+        # KB context - upweight if entity is in current agent's KB
+        kb_entities = self._kb_entities(agent, uuid)
+        if kb_entities is not None and "IN_KB" in self.feature_index:
+            features[:, self.feature_index["IN_KB"]] = [entity in kb_entities for entity in entities]
+        prob = 1. / (1. + np.exp(-(features.dot(self.weights) + self.intercept)))
+        return np.column_stack([1. - prob, prob])
 
 
 if __name__ == "__main__":
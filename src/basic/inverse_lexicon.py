@@ -1,25 +1,68 @@
 import argparse
+import hashlib
 import numpy as np
+import os
 import time
 
 from lexicon import Lexicon
 from collections import defaultdict, Counter
+from itertools import izip
 from lexicon_utils import get_morphological_variants, get_prefixes, get_edits, get_acronyms
 from schema import Schema
 from src.model.vocab import is_entity
+from util import read_pickle, write_pickle
+
+# Bump when the realization table format changes so that old artifacts are rebuilt
+INVERSE_LEXICON_VERSION = 1
+
+def build_alias_table(weights):
+    '''
+    Build Walker's alias table (Vose's method) for sampling from a discrete distribution in O(1).
+    Index i is sampled by picking a column k uniformly, then returning k with probability prob[k]
+    and alias[k] otherwise.
+    :param weights: unnormalized probabilities
+    :return: prob, alias (lists)
+    '''
+    n = len(weights)
+    total = float(sum(weights))
+    scaled = [w * n / total for w in weights]
+    prob = [1.] * n
+    alias = range(n)
+    small = [i for i, p in enumerate(scaled) if p < 1.]
+    large = [i for i, p in enumerate(scaled) if p >= 1.]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] -= 1. - scaled[s]
+        if scaled[l] < 1.:
+            small.append(l)
+        else:
+            large.append(l)
+    # Remaining columns are full up to rounding errors
+    return prob, alias
 
 
 class InverseLexicon(object):
     """
     Inverse lexicon for taking a list of entity tuples and converting to a reasonable surface form
     """
-    def __init__(self, schema, inverse_lexicon_data):
+    def __init__(self, schema, inverse_lexicon_data, lexicon_cache=None):
         self.schema = schema
         self.entities = {}  # Mapping from (canonical) entity to type (assume type is unique)
         self.word_counts = defaultdict(int)  # Counts of words that show up in entities
-        self.inverse_lexicon = defaultdict(Counter)  # Mapping from entity -> list of realized variants of entity (seen in data)
+        # Realization table: variants of each entity (seen in data) are stored contiguously;
+        # entity -> (start, end) of its variants
+        self.entity_variants = {}
+        self.variants = []  # Realized variant (surface form)
+        self.counts = []  # Number of times the variant is seen
+        self.alias_prob = []  # Alias table of the sampling distribution of each entity
+        self.alias = []  # (absolute indices into self.variants)
         self.load_entities()
-        self._process_inverse_lexicon_data(inverse_lexicon_data)
+        if lexicon_cache is None or not self.load(lexicon_cache, inverse_lexicon_data):
+            self._process_inverse_lexicon_data(inverse_lexicon_data)
+            if lexicon_cache is not None:
+                self.save(lexicon_cache, inverse_lexicon_data)
 
     def _process_inverse_lexicon_data(self, inverse_lexicon_data):
         """
@@ -28,10 +71,71 @@ class InverseLexicon(object):
         and generate variant frequency count
         :return:
         """
+        inverse_lexicon = defaultdict(Counter)  # Mapping from entity -> list of realized variants of entity (seen in data)
         with open(inverse_lexicon_data, "r") as f:
             for line in f:
                 entity, span, type = line.split("\t")
-                self.inverse_lexicon[entity][span] += 1
+                inverse_lexicon[entity][span] += 1
+        self._build_table(inverse_lexicon)
+
+    def _build_table(self, inverse_lexicon):
+        for entity, variant_counts in inverse_lexicon.iteritems():
+            start = len(self.variants)
+            items = variant_counts.items()
+            self.variants.extend([item[0] for item in items])
+            self.counts.extend([item[1] for item in items])
+            # Make it peaky
+            prob, alias = build_alias_table([item[1] ** 2 for item in items])
+            self.alias_prob.extend(prob)
+            self.alias.extend([start + i for i in alias])
+            self.entity_variants[entity] = (start, len(self.variants))
+
+    @classmethod
+    def artifact_path(cls, lexicon_cache, inverse_lexicon_data):
+        # Key on the path, modification time and size of the data file instead of its content
+        # so that finding the artifact does not read the whole file
+        stat = os.stat(inverse_lexicon_data)
+        fingerprint = hashlib.sha1('%s-%r-%d' % (os.path.abspath(inverse_lexicon_data), stat.st_mtime, stat.st_size)).hexdigest()
+        return os.path.join(lexicon_cache, 'inverse-lexicon-v%d-%s.pkl' % (INVERSE_LEXICON_VERSION, fingerprint))
+
+    def save(self, lexicon_cache, inverse_lexicon_data):
+        """
+        Write the realization table to lexicon_cache.
+        """
+        if not os.path.isdir(lexicon_cache):
+            os.makedirs(lexicon_cache)
+        path = self.artifact_path(lexicon_cache, inverse_lexicon_data)
+        artifact = {'version': INVERSE_LEXICON_VERSION,
+                    'entity_variants': self.entity_variants,
+                    'variants': self.variants,
+                    'counts': self.counts,
+                    'alias_prob': self.alias_prob,
+                    'alias': self.alias,
+                    }
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        write_pickle(artifact, tmp_path, protocol=2)
+        os.rename(tmp_path, path)
+        print 'Saved inverse lexicon to', path
+        return path
+
+    def load(self, lexicon_cache, inverse_lexicon_data):
+        """
+        Load the realization table from lexicon_cache.
+        Return False if there is no artifact matching inverse_lexicon_data.
+        """
+        path = self.artifact_path(lexicon_cache, inverse_lexicon_data)
+        if not os.path.exists(path):
+            return False
+        artifact = read_pickle(path)
+        if artifact.get('version') != INVERSE_LEXICON_VERSION:
+            return False
+        self.entity_variants = artifact['entity_variants']
+        self.variants = artifact['variants']
+        self.counts = artifact['counts']
+        self.alias_prob = artifact['alias_prob']
+        self.alias = artifact['alias']
+        print 'Loaded inverse lexicon from', path
+        return True
 
 
     def load_entities(self):
@@ -49,7 +153,10 @@ class InverseLexicon(object):
 
 
     def lookup(self, phrase):
-        return self.inverse_lexicon.get(phrase, [])
+        if phrase not in self.entity_variants:
+            return []
+        start, end = self.entity_variants[phrase]
+        return Counter(dict(izip(self.variants[start:end], self.counts[start:end])))
 
 
     def realize_entity(self, entity_tokens):
@@ -65,21 +172,19 @@ class InverseLexicon(object):
         if type == 'item':
             return entity
         # Try checking in inverse lexicon frequency count
-        if entity not in self.inverse_lexicon:
+        if entity not in self.entity_variants:
             print "Have not encountered entity %s in data..." % entity
             realized = -1
         else:
-            items = self.inverse_lexicon[entity].items()
-            variants = [item[0] for item in items]
-            counts = np.array([item[1] for item in items], dtype=np.float32)
-            # Make it peaky
-            peaky_counts = counts ** 2
-            normal_counts = peaky_counts / np.sum(peaky_counts)
-            try:
-                idx = np.random.choice(np.arange(len(counts)), 1, p=normal_counts)[0]
-            except ValueError:
-                idx = np.argmax(counts)
-            realized = variants[idx]
+            # Sample a variant with probability proportional to its squared count using the alias table:
+            # the integer part of u picks a column and the fractional part decides between it and its alias
+            start, end = self.entity_variants[entity]
+            u = np.random.random_sample() * (end - start)
+            k = min(int(u), end - start - 1)
+            idx = start + k
+            if u - k >= self.alias_prob[idx]:
+                idx = self.alias[idx]
+            realized = self.variants[idx]
 
         if realized != -1:
             return realized
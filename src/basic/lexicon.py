@@ -1,36 +1,258 @@
 import collections
 import editdistance
+import gc
+import hashlib
 import json
+import mmap
+import multiprocessing
+import numpy as np
+import os
 import re
 import random
+import shutil
+import zlib
 
 from collections import defaultdict
+from itertools import izip, chain
 from fuzzywuzzy import fuzz
-from lexicon_utils import get_prefixes, get_acronyms, get_edits, get_morphological_variants
+from lexicon_utils import get_prefixes, get_acronyms, get_edits, get_deletes, is_edit, get_morphological_variants
+from util import read_pickle, write_pickle, LRUCache
+
+# Bump when the way synonyms are computed changes so that old artifacts are rebuilt
+LEXICON_VERSION = 1
+# Maximum number of fuzzy lookups remembered by the symspell index
+FUZZY_CACHE_SIZE = 50000
+
+# (lexicon, inputs) of the running link_entities_batch; pool workers inherit it when they are forked
+# so that neither the lexicon nor the KBs are pickled
+_batch = None
 
 def add_lexicon_arguments(parser):
     parser.add_argument('--stop-words', type=str, default='data/common_words.txt', help='Path to stop words list')
     parser.add_argument('--learned-lex', default=False, action='store_true', help='if true have entity linking in lexicon use learned system')
     parser.add_argument('--inverse-lexicon', help='Path to inverse lexicon data')
+    parser.add_argument('--lexicon-cache', help='Directory of prebuilt lexicon artifacts (see scripts/build_lexicon.py); built on first use if missing')
+    parser.add_argument('--link-cache-size', type=int, default=10000, help='Number of linked utterances to remember (0 to disable the cache)')
+    parser.add_argument('--link-workers', type=int, default=1, help='Number of processes used to link entities in a whole dataset')
+    parser.add_argument('--lexicon-mmap', default=False, action='store_true', help='Load the lexicon table from memory-mapped files in --lexicon-cache so that processes on the same host share one copy')
+    parser.add_argument('--fuzzy-index', default='edits', choices=['edits', 'symspell'], help='How misspelled entity tokens are matched: store all edits in the lexicon table (edits) or only deletion variants resolved at lookup time (symspell)')
+
+class MappedLexiconTable(object):
+    """
+    Read-only mapping from phrase to list of (entity, type) stored in memory-mapped files, so that all
+    processes loading the same table share one physical copy (in the page cache).
+    Phrases are concatenated in a string pool and found by an open addressing hash table (crc32, linear
+    probing) of phrase indices; the entities of phrase i are entity_ids[entity_offsets[i]:entity_offsets[i+1]].
+    """
+    def __init__(self, path, entity_list):
+        with open(os.path.join(path, 'pool.bin'), 'rb') as fin:
+            self.pool = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        load = lambda name: np.load(os.path.join(path, '%s.npy' % name), mmap_mode='r')
+        self.phrase_offsets = load('phrase_offsets')
+        self.entity_offsets = load('entity_offsets')
+        self.entity_ids = load('entity_ids')
+        self.slots = load('slots')
+        self.mask = len(self.slots) - 1
+        self.entity_list = entity_list
+
+    @classmethod
+    def write(cls, path, lexicon):
+        """
+        Write files of the table to the directory path.
+        :param lexicon: mapping from phrase to tuple of entity ids (indices in entity_list)
+        """
+        items = lexicon.items()
+        phrases = [phrase.encode('utf-8') if isinstance(phrase, unicode) else phrase for phrase, _ in items]
+        with open(os.path.join(path, 'pool.bin'), 'wb') as fout:
+            fout.write(''.join(phrases))
+        phrase_offsets = np.zeros(len(items) + 1, dtype=np.int64)
+        phrase_offsets[1:] = np.cumsum([len(phrase) for phrase in phrases])
+        entity_offsets = np.zeros(len(items) + 1, dtype=np.int64)
+        entity_offsets[1:] = np.cumsum([len(ids) for _, ids in items])
+        entity_ids = np.fromiter(chain.from_iterable([ids for _, ids in items]), dtype=np.int32, count=entity_offsets[-1])
+        # Keep the hash table at most half full
+        size = 1
+        while size < 2 * len(items):
+            size *= 2
+        mask = size - 1
+        slots = [-1] * size
+        for i, phrase in enumerate(phrases):
+            h = zlib.crc32(phrase) & mask
+            while slots[h] >= 0:
+                h = (h + 1) & mask
+            slots[h] = i
+        np.save(os.path.join(path, 'phrase_offsets.npy'), phrase_offsets)
+        np.save(os.path.join(path, 'entity_offsets.npy'), entity_offsets)
+        np.save(os.path.join(path, 'entity_ids.npy'), entity_ids)
+        np.save(os.path.join(path, 'slots.npy'), np.array(slots, dtype=np.int32))
+
+    def __len__(self):
+        return len(self.phrase_offsets) - 1
+
+    def num_entries(self):
+        return len(self.entity_ids)
+
+    def get(self, phrase, default=None):
+        if isinstance(phrase, unicode):
+            phrase = phrase.encode('utf-8')
+        h = zlib.crc32(phrase) & self.mask
+        while True:
+            i = self.slots[h]
+            if i < 0:
+                return default
+            if self.pool[self.phrase_offsets[i]:self.phrase_offsets[i+1]] == phrase:
+                return [self.entity_list[j] for j in self.entity_ids[self.entity_offsets[i]:self.entity_offsets[i+1]].tolist()]
+            h = (h + 1) & self.mask
+
+
+def _link_dialogue_in_worker(i):
+    '''
+    Return the linked dialogue i of _batch and the link_cache hits and misses of linking it,
+    which are otherwise lost with the worker.
+    '''
+    lexicon, utterances, kbs, mentioned_entities, known_kb = _batch
+    cache = lexicon.link_cache
+    if cache is not None:
+        hits, misses = cache.hits, cache.misses
+    linked = lexicon.link_dialogue(utterances[i], kbs[i], mentioned_entities[i], known_kb)
+    if cache is None:
+        return linked, 0, 0
+    return linked, cache.hits - hits, cache.misses - misses
 
 class BaseLexicon(object):
     """
     Base lexicon class defining general purpose functions for any lexicon
     """
-    def __init__(self, schema, learned_lex, stop_words=None):
+    def __init__(self, schema, learned_lex, stop_words=None, lexicon_cache=None, fuzzy_index='edits', lexicon_mmap=False):
         self.schema = schema
         # if True, lexicon uses learned system
         self.learned_lex = learned_lex
         self.entities = {}  # Mapping from (canonical) entity to type (assume type is unique)
         self.word_counts = defaultdict(int)  # Counts of words that show up in entities
         self.lexicon = defaultdict(list)  # Mapping from string -> list of (entity, type)
+        # Whether self.lexicon is loaded from memory-mapped files (MappedLexiconTable) in lexicon_cache
+        self.lexicon_mmap = lexicon_mmap
+        assert not lexicon_mmap or lexicon_cache is not None, 'Memory-mapped lexicon requires a lexicon cache'
+        self.entity_order = {}  # Mapping from entity -> order in which its synonyms were added
+        # SymSpell-style fuzzy index: instead of storing every edit of an entity token in
+        # self.lexicon, store deletion variants of the token and verify candidates at lookup time
+        self.fuzzy_index = fuzzy_index
+        self.fuzzy_tokens = defaultdict(list)  # Mapping from entity token -> list of (entity, type)
+        self.deletes = defaultdict(list)  # Mapping from deletion variant -> list of entity tokens
+        self.anagrams = defaultdict(list)  # Mapping from sorted letters -> list of entity tokens (for transpositions)
+        self.fuzzy_cache = {}  # Mapping from looked up string -> list of (entity, type), cleared when full
         with open(stop_words, 'r') as fin:
             self.stop_words = set([x.strip() for x in fin.read().split()][:1000])
             self.stop_words.update(['one', '1', 'two', '2', 'three', '3', 'four', '4', 'five', '5', 'six', '6', 'seven', '7', 'eight', '8', 'nine', '9', 'ten', '10'])
-        self.load_entities()
-        self.compute_synonyms()
-        print 'Created lexicon: %d phrases mapping to %d entities, %f entities per phrase' % (len(self.lexicon), len(self.entities), sum([len(x) for x in self.lexicon.values()])/float(len(self.lexicon)))
+        if lexicon_cache is None or not self.load(lexicon_cache):
+            self.load_entities()
+            self.entity_order = {e: i for i, e in enumerate(self.entities.iterkeys())}
+            self.compute_synonyms()
+            self.build_fuzzy_index()
+            if lexicon_cache is not None:
+                self.save(lexicon_cache)
+                if lexicon_mmap:
+                    # Switch to the shared table
+                    self.load(lexicon_cache)
+        if lexicon_mmap:
+            num_entries = self.lexicon.num_entries()
+        else:
+            num_entries = sum([len(x) for x in self.lexicon.values()])
+        print 'Created lexicon: %d phrases mapping to %d entities, %f entities per phrase' % (len(self.lexicon), len(self.entities), num_entries/float(len(self.lexicon)))
 
+    def fingerprint(self):
+        """
+        Hash of everything the lexicon table is computed from: the lexicon class and version,
+        the schema values and the stop words.
+        """
+        h = hashlib.sha1()
+        h.update('%s-%d-%s' % (type(self).__name__, LEXICON_VERSION, self.fuzzy_index))
+        h.update(json.dumps(self.schema.values, sort_keys=True))
+        h.update(' '.join(sorted(self.stop_words)))
+        return h.hexdigest()
+
+    def artifact_path(self, lexicon_cache):
+        # A memory-mapped artifact is a directory of table files and the pickled rest of the lexicon
+        ext = 'mmap' if self.lexicon_mmap else 'pkl'
+        return os.path.join(lexicon_cache, 'lexicon-v%d-%s.%s' % (LEXICON_VERSION, self.fingerprint(), ext))
+
+    def save(self, lexicon_cache, replace=False):
+        """
+        Write the precompiled lexicon table to lexicon_cache.
+        :param replace: whether to replace an existing artifact (otherwise it is kept)
+        """
+        if not os.path.isdir(lexicon_cache):
+            os.makedirs(lexicon_cache)
+        path = self.artifact_path(lexicon_cache)
+        # Store (entity, type) once and refer to it by index from each phrase
+        entity_list = sorted(self.entities.iteritems(), key=lambda e: self.entity_order[e[0]])
+        entity_ids = {e: i for i, e in enumerate(entity_list)}
+        lexicon = {phrase: tuple([entity_ids[e] for e in entities]) for phrase, entities in self.lexicon.iteritems()}
+        fuzzy_tokens = {token: tuple([entity_ids[e] for e in entities]) for token, entities in self.fuzzy_tokens.iteritems()}
+        artifact = {'version': LEXICON_VERSION,
+                    'entities': entity_list,
+                    'word_counts': dict(self.word_counts),
+                    'lexicon': lexicon,
+                    'fuzzy_tokens': fuzzy_tokens,
+                    }
+        # Write to a temporary file first so that concurrent readers never see a partial artifact
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        if self.lexicon_mmap:
+            os.makedirs(tmp_path)
+            MappedLexiconTable.write(tmp_path, artifact.pop('lexicon'))
+            write_pickle(artifact, os.path.join(tmp_path, 'meta.pkl'), protocol=2)
+            if replace and os.path.isdir(path):
+                # A directory cannot be renamed over a non-empty one; move the old artifact aside
+                # (processes that mapped its files keep reading them until they exit)
+                old_path = '%s.%d.old' % (path, os.getpid())
+                os.rename(path, old_path)
+                os.rename(tmp_path, path)
+                shutil.rmtree(old_path)
+            else:
+                try:
+                    os.rename(tmp_path, path)
+                except OSError:
+                    # Another process has saved the same artifact
+                    shutil.rmtree(tmp_path)
+        else:
+            write_pickle(artifact, tmp_path, protocol=2)
+            os.rename(tmp_path, path)
+        print 'Saved lexicon to', path
+        return path
+
+    def load(self, lexicon_cache):
+        """
+        Load the precompiled lexicon table from lexicon_cache.
+        Return False if there is no artifact matching the current schema and stop words.
+        """
+        path = self.artifact_path(lexicon_cache)
+        if not os.path.exists(path):
+            return False
+        # The artifact holds millions of small containers; the cyclic GC would otherwise
+        # rescan them repeatedly while unpickling
+        gc.disable()
+        try:
+            artifact = read_pickle(os.path.join(path, 'meta.pkl') if self.lexicon_mmap else path)
+            if artifact.get('version') != LEXICON_VERSION:
+                return False
+            entity_list = artifact['entities']
+            self.entities = dict(entity_list)
+            self.entity_order = {e: i for i, (e, _) in enumerate(entity_list)}
+            self.word_counts = defaultdict(int, artifact['word_counts'])
+            if self.lexicon_mmap:
+                self.lexicon = MappedLexiconTable(path, entity_list)
+            else:
+                self.lexicon = defaultdict(list)
+                for phrase, entity_ids in artifact['lexicon'].iteritems():
+                    self.lexicon[phrase] = [entity_list[i] for i in entity_ids]
+            self.fuzzy_tokens = defaultdict(list)
+            for token, entity_ids in artifact['fuzzy_tokens'].iteritems():
+                self.fuzzy_tokens[token] = [entity_list[i] for i in entity_ids]
+            self.build_fuzzy_index()
+        finally:
+            gc.enable()
+        print 'Loaded lexicon from', path
+        return True
 
     def load_entities(self):
         for type_, values in self.schema.values.iteritems():
@@ -44,8 +266,62 @@ class BaseLexicon(object):
                 self.word_counts[word] += 1
         self.entities[entity] = type
 
+    def _add_fuzzy_token(self, token, entity, type):
+        '''
+        Make edits of token match (entity, type) in lookup, equivalent to adding get_edits(token) to the lexicon.
+        NOTE: token must not contain spaces, otherwise stripped transpositions are not indexed.
+        '''
+        assert ' ' not in token, 'Fuzzy token cannot contain spaces: %s' % token
+        if len(token) < 3:
+            return
+        entities = self.fuzzy_tokens[token]
+        if (entity, type) not in entities:
+            entities.append((entity, type))
+
+    def build_fuzzy_index(self):
+        self.deletes = defaultdict(list)
+        self.anagrams = defaultdict(list)
+        for token in self.fuzzy_tokens:
+            # Inserts, deletes and substitutions share a deletion variant within distance 1
+            for variant in get_deletes(token, 1):
+                self.deletes[variant].append(token)
+            # Transpositions (of any two letters) share the same letters
+            self.anagrams[''.join(sorted(token))].append(token)
+
+    def fuzzy_lookup(self, phrase):
+        '''
+        Return entities with a token that phrase is an edit of.
+        '''
+        # Entity tokens have at least 3 characters
+        if len(phrase) < 2:
+            return []
+        if self.stop_words and phrase not in self.word_counts and phrase in self.stop_words:
+            return []
+        tokens = set(self.anagrams.get(''.join(sorted(phrase)), ()))
+        for variant in get_deletes(phrase, 1):
+            tokens.update(self.deletes.get(variant, ()))
+        entities = []
+        for token in tokens:
+            if is_edit(phrase, token):
+                entities.extend(self.fuzzy_tokens[token])
+        return entities
+
     def lookup(self, phrase):
-        return self.lexicon.get(phrase, [])
+        entities = self.lexicon.get(phrase, [])
+        if self.fuzzy_index == 'symspell':
+            if phrase in self.fuzzy_cache:
+                return self.fuzzy_cache[phrase]
+            fuzzy_entities = self.fuzzy_lookup(phrase)
+            if fuzzy_entities:
+                exact_entities = set(entities)
+                fuzzy_entities = set(fuzzy_entities).difference(exact_entities)
+                if fuzzy_entities:
+                    # Keep the order of the equivalent lexicon entry
+                    entities = sorted(exact_entities.union(fuzzy_entities), key=lambda e: self.entity_order[e[0]])
+            if len(self.fuzzy_cache) >= FUZZY_CACHE_SIZE:
+                self.fuzzy_cache.clear()
+            self.fuzzy_cache[phrase] = entities
+        return entities
 
 
 
@@ -53,8 +329,17 @@ class Lexicon(BaseLexicon):
     """
     Lexicon that only computes per token entity transforms rather than per phrase transforms (except for prefixes/acronyms)
     """
-    def __init__(self, schema, learned_lex=False, entity_ranker=None, scenarios_json=None, stop_words=None):
-        super(Lexicon, self).__init__(schema, learned_lex, stop_words)
+    def __init__(self, schema, learned_lex=False, entity_ranker=None, scenarios_json=None, stop_words=None, lexicon_cache=None, fuzzy_index='edits', link_cache_size=10000, lexicon_mmap=False):
+        super(Lexicon, self).__init__(schema, learned_lex, stop_words, lexicon_cache, fuzzy_index, lexicon_mmap)
+        # Entity with punctuation cleaned up and its tokens, for scoring candidates
+        self.candidate_tokens = {}
+        for entity in self.entities:
+            c_s = re.sub("-", " ", entity)
+            self.candidate_tokens[entity] = (c_s, c_s.split())
+        # Utterances are often repeated (e.g. "do you have any"); remember recently linked ones
+        self.link_cache = LRUCache(link_cache_size) if link_cache_size > 0 else None
+        # Mapping from token -> entity names and types of its candidates, cleared when full
+        self.candidate_names = {}
         # TODO: Remove hard-coding (use list of common words/phrases/stop words)
         self.common_phrases = set(["went", "to", "and", "of", "my", "the", "names", "any",
                                    "friends", "at", "for", "in", "many", "partner", "all", "we",
@@ -128,7 +413,10 @@ class Lexicon(BaseLexicon):
             for phrase in phrases:
                 synonyms.append(phrase)
                 if type != 'person':
-                    synonyms.extend(get_edits(phrase))
+                    if self.fuzzy_index == 'symspell':
+                        self._add_fuzzy_token(phrase, entity, type)
+                    else:
+                        synonyms.extend(get_edits(phrase))
                     synonyms.extend(get_morphological_variants(phrase))
                     synonyms.extend(get_prefixes(phrase, min_length=1))
                 if phrase in ('and', '&', "'n"):
@@ -162,46 +450,29 @@ class Lexicon(BaseLexicon):
         #print 'span:', span
         if not self.learned_lex:
             entity_scores = []
+            span_tokens = span.split()
+            # Filter false positives: spans of stop words only match an identical entity
+            span_is_stopwords = (len(span_tokens) == 1 and span in self.stop_words) or \
+                    span_tokens[0] in ('and', 'or', 'to', 'from', 'of', 'in', 'at') or \
+                    all([x in self.stop_words for x in span_tokens])
+            # A loop rather than arrays: most spans have a few candidates and most candidates
+            # are filtered by type before any string comparison
             for c in candidates:
-                #print 'c:', c
-                # Clean up punctuation
-                c_s = re.sub("-", " ", c[0])
-                span_tokens = span.split()
-                entity_tokens = c_s.split()
-
-                ed = editdistance.eval(span, c[0])
+                entity = c[0]
                 # Filter false positives
                 if c[1] not in kb_entity_types:
-                    #print 'false type'
                     continue
-
-                def is_stopwords():
-                    if span == c[0]:
-                        return False
-                    if len(span_tokens) == 1 and span in self.stop_words:
-                        return True
-                    if span_tokens[0] in ('and', 'or', 'to', 'from', 'of', 'in', 'at'):
-                        return True
-                    all_stop = True
-                    for x in span_tokens:
-                        if x not in self.stop_words:
-                            all_stop = False
-                            break
-                    if all_stop:
-                        return True
-                    return False
-
-                if is_stopwords():
-                    #print 'stop words'
+                is_span = entity == span
+                if span_is_stopwords and not is_span:
                     continue
+                c_s, entity_tokens = self.candidate_tokens[entity]
                 if len(span_tokens) > len(entity_tokens):
                     continue
-                if c[0] not in kb_entities and known_kb:
+                if entity not in kb_entities and known_kb:
                     # Prioritize exact match
-                    if c[0] == span:
+                    if is_span:
                         score = 0
                     else:
-                        #print 'not in kb'
                         continue
                 elif span in entity_tokens:
                     score = 0
@@ -209,21 +480,17 @@ class Lexicon(BaseLexicon):
                 elif len(span_tokens) > 1 and span in c_s:
                     score = 1
                 else:
-                    score = ed + 2
+                    score = editdistance.eval(span, entity) + 2
                 # Prioritize entity in KB even if we are not sure
-                if not known_kb and c[0] not in kb_entities and c[0] != span:
+                if not known_kb and entity not in kb_entities and not is_span:
                     score += 3
-                #print 'score:', score
 
                 entity_scores.append(c + (score,))
 
-            # Sort entity scores
             if len(entity_scores) == 0:
                 return (span, None)
-            entity_scores = sorted(entity_scores, key=lambda x: x[2])
-
-            # If exact match or substring match with an entity
-            entity, type_, score = entity_scores[0]
+            # If exact match or substring match with an entity (first one among the best scores)
+            entity, type_, score = min(entity_scores, key=lambda x: x[2])
 
             # Be more cautious when not known_kb; +3 because previous prioritization
             if score > 8 and not known_kb:
@@ -234,13 +501,14 @@ class Lexicon(BaseLexicon):
                 best_match = (entity, type_)
         else:
             # Use learned ranker
+            # Where does original span fit into all this? Score it along with the candidates
+            scores = self.entity_ranker.score_batch(span, [c[0] for c in candidates] + [span], agent, uuid)
             entity_scores = []
-            for c in candidates:
-                score = self.entity_ranker.score(span, c[0], agent, uuid).squeeze()
+            for c, score in izip(candidates, scores[:-1]):
                 entity_scores.append(c + (score[0] - score[1],))
 
-            # Where does original span fit into all this? If smaller than some threshold
-            span_score = self.entity_ranker.score(span, span, agent, uuid).squeeze()
+            # If smaller than some threshold
+            span_score = scores[-1]
 
             # Sort entity scores
             entity_scores = sorted(entity_scores, key=lambda x: x[2])
@@ -279,6 +547,37 @@ class Lexicon(BaseLexicon):
         combined_entity_tokens.extend(cache)
         return combined_entity_tokens
 
+    def _token_candidate_names(self, token):
+        '''
+        Return the entity names and types of lookup(token) as frozensets.
+        '''
+        names = self.candidate_names.get(token)
+        if names is None:
+            results = self.lookup(token)
+            names = (frozenset([c[0] for c in results]), frozenset([c[1] for c in results]))
+            if len(self.candidate_names) >= FUZZY_CACHE_SIZE:
+                self.candidate_names.clear()
+            self.candidate_names[token] = names
+        return names
+
+    def _link_cache_key(self, raw_tokens, agent, uuid, kb_entities, kb_entity_types, known_kb):
+        '''
+        Key of a linked utterance in link_cache. Linking only depends on the KB through the
+        candidates of the tokens (see score_and_match), so the key includes the candidate
+        entities and types in the KB rather than the whole KB; then an utterance can hit the
+        cache in other dialogues. agent and uuid are only used by the learned ranker.
+        '''
+        kb_candidates = set()
+        kb_types = set()
+        for token in raw_tokens:
+            names, types = self._token_candidate_names(token)
+            kb_candidates.update(names.intersection(kb_entities))
+            kb_types.update(types.intersection(kb_entity_types))
+        key = (tuple(raw_tokens), frozenset(kb_candidates), frozenset(kb_types), known_kb)
+        if self.learned_lex:
+            key += (agent, uuid)
+        return key
+
     def link_entity(self, raw_tokens, return_entities=False, agent=1, uuid="NONE", kb=None, mentioned_entities=None, known_kb=True):
         """
         Add detected entities to each token
@@ -299,23 +598,53 @@ class Lexicon(BaseLexicon):
             kb_entities = None
             kb_entity_types = None
 
+        # Linking is random without a KB
+        cache_key = None
+        if self.link_cache is not None and kb_entities is not None:
+            cache_key = self._link_cache_key(raw_tokens, agent, uuid, kb_entities, kb_entity_types, known_kb)
+            cached = self.link_cache.get(cache_key)
+            if cached is not None:
+                linked, found_entities = cached
+                if return_entities:
+                    return list(linked), list(found_entities)
+                return list(linked)
+
         i = 0
         found_entities = []
         linked = []
         stop_words = set(['of'])
+        # Candidates of each token in the utterance: (entities, set of entities)
+        token_candidates = {}
         while i < len(raw_tokens):
             candidate_entities = None
             single_char = False
-            # Find longest phrase (if any) that matches an entity
-            for l in range(6, 0, -1):
-                phrase = ' '.join(raw_tokens[i:i+l])
-                raw = raw_tokens[i:i+l]
-
-                for idx, token in enumerate(raw):
+            # Candidates of the phrase window[:l] are intersected token by token, so candidates
+            # of all windows starting at i are computed in one pass over the longest window
+            window = raw_tokens[i:i+6]
+            window_candidates = []
+            for idx, token in enumerate(window):
+                # Nothing left to intersect
+                if idx > 0 and not candidate_entities:
+                    window_candidates.append(candidate_entities)
+                    continue
+                if token not in token_candidates:
                     results = self.lookup(token)
-                    if idx == 0: candidate_entities = results
-                    if token not in stop_words:
-                        candidate_entities = list(set(candidate_entities).intersection(set(results)))
+                    token_candidates[token] = (results, set(results))
+                results, results_set = token_candidates[token]
+                if idx == 0: candidate_entities = results
+                if token not in stop_words:
+                    candidate_entities = list(set(candidate_entities).intersection(results_set))
+                window_candidates.append(candidate_entities)
+
+            lengths = range(len(window), 0, -1)
+            if len(window) == 1:
+                # At the last token, longer windows are the same phrase but the single
+                # character rule below does not apply to them
+                lengths.insert(0, 2)
+            # Find longest phrase (if any) that matches an entity
+            for l in lengths:
+                phrase = ' '.join(window[:l])
+                candidate_entities = window_candidates[min(l, len(window)) - 1]
 
                 # Single character token so disregard candidate entities
                 if l == 1 and len(phrase) == 1:
@@ -345,6 +674,8 @@ class Lexicon(BaseLexicon):
                 i += 1
 
         linked = self.combine_repeated_entity(linked)
+        if cache_key is not None:
+            self.link_cache.put(cache_key, (tuple(linked), tuple(found_entities)))
 
         # For computing per dialogue entities found
         if return_entities:
@@ -352,6 +683,57 @@ class Lexicon(BaseLexicon):
 
         return linked
 
+    def link_dialogue(self, utterances, kbs, mentioned_entities=None, known_kb=True):
+        '''
+        Link entities in utterances of a dialogue in order. Entities found in an utterance are
+        mentioned entities when linking the following ones.
+        :param utterances: list of tokenized utterances; None for turns that are not linked
+        :param kbs: KB of the speaker of each utterance
+        :param mentioned_entities: entities mentioned at each turn without being linked (e.g. selected items), or None
+        :return: list of linked utterances (None for turns that are not linked)
+        '''
+        mentioned = set()
+        linked_utterances = []
+        for i, (tokens, kb) in enumerate(izip(utterances, kbs)):
+            if tokens is None:
+                linked = None
+            else:
+                linked = self.link_entity(tokens, kb=kb, mentioned_entities=mentioned, known_kb=known_kb)
+                mentioned.update([x[1][0] for x in linked if not isinstance(x, basestring)])
+            if mentioned_entities is not None and mentioned_entities[i]:
+                mentioned.update(mentioned_entities[i])
+            linked_utterances.append(linked)
+        return linked_utterances
+
+    def link_entities_batch(self, utterances, kbs, mentioned_entities=None, known_kb=True, num_workers=1):
+        '''
+        Link entities in a batch of dialogues (see link_dialogue), sharding dialogues across
+        num_workers forked processes which share this lexicon. Order is preserved.
+        :param utterances: list of dialogues, each a list of tokenized utterances
+        :param kbs: list of dialogues, each a list of the KB of the speaker of each utterance
+        :param mentioned_entities: list of dialogues, each a list of entities mentioned at each turn, or None
+        :return: list of dialogues, each a list of linked utterances
+        '''
+        global _batch
+        if mentioned_entities is None:
+            mentioned_entities = [None] * len(utterances)
+        if num_workers <= 1 or len(utterances) <= 1:
+            return [self.link_dialogue(u, k, m, known_kb) for u, k, m in izip(utterances, kbs, mentioned_entities)]
+        _batch = (self, utterances, kbs, mentioned_entities, known_kb)
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            chunksize = max(1, len(utterances) / (num_workers * 4))
+            results = pool.map(_link_dialogue_in_worker, xrange(len(utterances)), chunksize)
+        finally:
+            pool.close()
+            pool.join()
+            _batch = None
+        if self.link_cache is not None:
+            # Each worker has its own copy of the cache; only its counters are reported back
+            self.link_cache.hits += sum([hits for _, hits, _ in results])
+            self.link_cache.misses += sum([misses for _, _, misses in results])
+        return [linked for linked, _, _ in results]
+
 
     def test(self):
         sentence3 = "I went to University of Pensylvania and most my friends are from there".split(" ")
@@ -74,6 +74,58 @@ def get_edits(entity):
                 edits.append(new_word)
     return edits
 
+def is_edit(word, entity):
+    """
+    Returns whether word is in get_edits(entity) without enumerating all edits when entity has
+    no spaces (transpositions in get_edits are stripped, e.g. 'ewnyork' from 'new york')
+    :param word:
+    :param entity:
+    :return:
+    """
+    n = len(entity)
+    if n < 3:
+        return False
+    if ' ' in entity:
+        return word in get_edits(entity)
+    m = len(word)
+    # Index of the first mismatch
+    k = 0
+    while k < min(m, n) and word[k] == entity[k]:
+        k += 1
+    # Insert
+    if m == n + 1:
+        return word[k] in alphabet and word[k+1:] == entity[k:]
+    # Delete
+    if m == n - 1:
+        return word[k:] == entity[k+1:]
+    if m != n or k == n:
+        return False
+    diffs = [i for i in xrange(k, n) if word[i] != entity[i]]
+    # Substitute
+    if len(diffs) == 1:
+        return word[k] in alphabet
+    # Transposition - swapping two letters
+    if len(diffs) == 2:
+        i, j = diffs
+        return word[i] == entity[j] and word[j] == entity[i]
+    return False
+
+
+def get_deletes(entity, max_distance=2):
+    """
+    Computes all strings obtained by deleting up to max_distance characters from entity (including itself).
+    Two strings within edit distance max_distance share at least one deletion variant.
+    :param entity:
+    :param max_distance:
+    :return:
+    """
+    deletes = set([entity])
+    variants = [entity]
+    for _ in xrange(max_distance):
+        variants = set([v[:i] + v[i+1:] for v in variants for i in xrange(len(v))])
+        deletes.update(variants)
+    return deletes
+
 
 def get_morphological_variants(entity):
     """
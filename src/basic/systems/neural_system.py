@@ -35,6 +35,8 @@ class NeuralSystem(System):
         config['batch_size'] = 1
         config['gpu'] = 0  # Don't need GPU for batch_size=1
         config['decoding'] = decoding
+        # Models saved before --msg-passing was added
+        config.setdefault('msg_passing', 'padded')
         args = argparse.Namespace(**config)
 
         mappings_path = os.path.join(model_path, 'vocab.pkl')
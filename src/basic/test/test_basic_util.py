@@ -0,0 +1,34 @@
+import pytest
+import json
+from basic.util import iter_json_list
+
+class TestBasicUtil(object):
+    examples = [
+        {'uuid': 'a', 'events': [{'data': 'he said "hi", then ] left [', 'time': 12.5}]},
+        {'uuid': 'b\\"c', 'events': []},
+        [1, [2, [3]], {'x': '\\\\'}],
+        123456789,
+        'quote " and ] , [ { }',
+        u'caf\xe9',
+        None,
+        ]
+
+    def write(self, tmpdir, text):
+        path = str(tmpdir.join('data.json'))
+        with open(path, 'w') as fout:
+            fout.write(text)
+        return path
+
+    @pytest.mark.parametrize('chunk_size', [1, 2, 3, 5, 7, 64])
+    def test_iter_json_list(self, tmpdir, chunk_size):
+        for text in (json.dumps(self.examples), json.dumps(self.examples, indent=2), '[]', ' [ \n ] ', '[0]'):
+            path = self.write(tmpdir, text)
+            with open(path) as fin:
+                expected = json.load(fin)
+            assert list(iter_json_list(path, chunk_size)) == expected, text
+
+    @pytest.mark.parametrize('text', ['', '{}', '[1, 2', '[1 2]', '["a]', '[1,]'])
+    def test_iter_json_list_error(self, tmpdir, text):
+        path = self.write(tmpdir, text)
+        with pytest.raises(Exception):
+            list(iter_json_list(path, 2))
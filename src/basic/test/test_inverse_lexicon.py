@@ -0,0 +1,64 @@
+import pytest
+import os
+import numpy as np
+from collections import Counter
+from basic.schema import Schema
+from basic.inverse_lexicon import InverseLexicon, build_alias_table
+
+class TestInverseLexicon(object):
+    entity = ('new york university', 'school')
+    counts = {'nyu': 6, 'new york univ': 3, 'new york university': 1}
+
+    @pytest.fixture(scope='session')
+    def schema(self):
+        return Schema('data/friends-schema.json')
+
+    @pytest.fixture
+    def data_path(self, tmpdir):
+        path = str(tmpdir.join('inverse_lexicon_data.txt'))
+        with open(path, 'w') as fout:
+            for span, count in sorted(self.counts.iteritems()):
+                for _ in xrange(count):
+                    fout.write('%s\t%s\t%s\n' % (self.entity[0], span, self.entity[1]))
+        return path
+
+    def test_build_alias_table(self):
+        weights = [36, 9, 1, 0, 4]
+        prob, alias = build_alias_table(weights)
+        n = len(weights)
+        # Probability of each index: its own column plus the columns it is the alias of
+        p = np.array(prob) / n
+        for k in xrange(n):
+            if alias[k] != k:
+                p[alias[k]] += (1. - prob[k]) / n
+        np.testing.assert_allclose(p, np.array(weights, dtype=float) / sum(weights))
+
+    def test_realize_entity(self, schema, data_path):
+        inverse_lexicon = InverseLexicon(schema, data_path)
+        assert inverse_lexicon.lookup(self.entity[0]) == Counter(self.counts)
+        np.random.seed(0)
+        num_samples = 20000
+        realized = Counter([inverse_lexicon.realize_entity(['at', ('', self.entity)])[1] for _ in xrange(num_samples)])
+        # Variants are sampled proportional to their squared counts
+        total = float(sum([c ** 2 for c in self.counts.itervalues()]))
+        for span, count in self.counts.iteritems():
+            assert abs(realized[span] / float(num_samples) - count ** 2 / total) < 0.01, span
+
+    def test_save_load(self, schema, data_path, tmpdir):
+        lexicon_cache = str(tmpdir.join('cache'))
+        path = InverseLexicon.artifact_path(lexicon_cache, data_path)
+        inverse_lexicon = InverseLexicon(schema, data_path, lexicon_cache)
+        assert os.path.exists(path)
+        loaded = InverseLexicon(schema, data_path, lexicon_cache)
+        for attr in ('entity_variants', 'variants', 'counts', 'alias_prob', 'alias'):
+            assert getattr(loaded, attr) == getattr(inverse_lexicon, attr), attr
+        np.random.seed(1)
+        expected = [inverse_lexicon._realize_entity(self.entity) for _ in xrange(100)]
+        np.random.seed(1)
+        assert [loaded._realize_entity(self.entity) for _ in xrange(100)] == expected
+
+        # A modified data file does not match the artifact
+        with open(data_path, 'a') as fout:
+            fout.write('%s\t%s\t%s\n' % (self.entity[0], 'nyu', self.entity[1]))
+        assert InverseLexicon.artifact_path(lexicon_cache, data_path) != path
+        assert InverseLexicon(schema, data_path, lexicon_cache).lookup(self.entity[0])['nyu'] == self.counts['nyu'] + 1
@@ -0,0 +1,44 @@
+import pytest
+import random
+from collections import defaultdict
+from basic.schema import Schema
+from basic.lexicon import Lexicon
+from basic.lexicon_utils import get_edits, is_edit
+
+class TestLexiconUtils(object):
+    @pytest.fixture(scope='session')
+    def lexicon(self):
+        schema = Schema('data/friends-schema.json')
+        return Lexicon(schema, False, stop_words='data/common_words.txt', fuzzy_index='symspell')
+
+    @pytest.fixture(scope='session')
+    def tokens(self, lexicon):
+        random.seed(0)
+        return random.sample(sorted(lexicon.fuzzy_tokens.keys()), 10)
+
+    def test_is_edit(self):
+        for entity in ('hiking', 'ucla', 'new york', 'computer science'):
+            edits = set(get_edits(entity))
+            words = edits.union([entity, entity[1:], entity[::-1]])
+            for word in words:
+                assert is_edit(word, entity) == (word in edits), word
+        # Stripped transposition of 'n' and ' '
+        assert is_edit('ewnyork', 'new york')
+
+    @pytest.fixture(scope='session')
+    def edit_entities(self, lexicon):
+        # What the lexicon would contain with fuzzy_index='edits'
+        edit_entities = defaultdict(set)
+        for token, entities in lexicon.fuzzy_tokens.iteritems():
+            for word in get_edits(token):
+                edit_entities[word].update(entities)
+        return edit_entities
+
+    def test_fuzzy_lookup(self, lexicon, tokens, edit_entities):
+        for token in tokens:
+            for word in get_edits(token):
+                if word not in lexicon.word_counts and word in lexicon.stop_words:
+                    continue
+                assert set(lexicon.fuzzy_lookup(word)) == edit_entities[word], word
+        for word in ('xyzzy', 'ab'):
+            assert set(lexicon.fuzzy_lookup(word)) == edit_entities.get(word, set())
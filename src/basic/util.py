@@ -2,6 +2,7 @@ import random
 import json
 import string
 import cPickle as pickle
+from collections import OrderedDict
 
 def random_multinomial(probs):
     target = random.random()
@@ -26,10 +27,136 @@ def write_json(raw, path):
     with open(path, 'w') as out:
         print >>out, json.dumps(raw)
 
+def iter_json_list(path, chunk_size=1 << 20):
+    '''
+    Yield elements of the JSON list in path one at a time, reading the file in chunks,
+    so that memory is bounded by the largest element instead of the whole file.
+    '''
+    decoder = json.JSONDecoder()
+    whitespace = ' \t\n\r'
+    error = 'Error reading JSON list from %s' % path
+    with open(path) as fin:
+        # state: buffer, position in the buffer, end of file reached
+        state = ['', 0, False]
+
+        def next_char():
+            # Return the next non-whitespace character (None at end of file)
+            while True:
+                buf, pos, eof = state
+                while pos < len(buf) and buf[pos] in whitespace:
+                    pos += 1
+                state[1] = pos
+                if pos < len(buf):
+                    return buf[pos]
+                if eof:
+                    return None
+                chunk = fin.read(chunk_size)
+                state[:] = [chunk, 0, not chunk]
+
+        if next_char() != '[':
+            raise Exception(error)
+        state[1] += 1
+        if next_char() == ']':
+            return
+        while True:
+            if next_char() is None:
+                raise Exception(error)
+            # Read more until the element decodes
+            while True:
+                buf, pos, eof = state
+                try:
+                    raw, end = decoder.raw_decode(buf, pos)
+                    # A number cut by the chunk boundary decodes as a prefix,
+                    # so only accept the element once its delimiter is read
+                    i = end
+                    while i < len(buf) and buf[i] in whitespace:
+                        i += 1
+                    if i < len(buf) and buf[i] in ',]':
+                        break
+                except ValueError:
+                    pass
+                if eof:
+                    raise Exception(error)
+                chunk = fin.read(chunk_size)
+                state[:] = [buf[pos:] + chunk, 0, not chunk]
+            yield raw
+            state[1] = end
+            c = next_char()
+            if c == ']':
+                return
+            if c != ',':
+                raise Exception(error)
+            state[1] += 1
+
+def read_jsonl(path):
+    '''
+    Yield objects of the JSON-lines file in path, one per non-empty line.
+    '''
+    with open(path) as fin:
+        for line in fin:
+            if line.strip():
+                yield json.loads(line)
+
+def write_jsonl(raws, path):
+    with open(path, 'w') as out:
+        for raw in raws:
+            print >>out, json.dumps(raw)
+
+def iter_json(path):
+    '''
+    Yield elements of a JSON list (.json) or objects of a JSON-lines file (.jsonl) lazily.
+    '''
+    if path.endswith('.jsonl'):
+        return read_jsonl(path)
+    return iter_json_list(path)
+
 def read_pickle(path):
     with open(path, 'rb') as fin:
         return pickle.load(fin)
 
-def write_pickle(obj, path):
+def write_pickle(obj, path, protocol=0):
     with open(path, 'wb') as fout:
-        pickle.dump(obj, fout)
+        pickle.dump(obj, fout, protocol)
+
+class LRUCache(object):
+    '''
+    Mapping holding at most size items; the least recently used item is evicted first.
+    Counts hits and misses of get.
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.cache)
+
+    def get(self, key, default=None):
+        try:
+            value = self.cache.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        # Move to the most recent end
+        self.cache[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if key in self.cache:
+            del self.cache[key]
+        elif len(self.cache) >= self.size:
+            self.cache.popitem(last=False)
+        self.cache[key] = value
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'size': len(self.cache),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / float(total) if total else 0.,
+                }
@@ -13,7 +13,7 @@ from src.basic.dataset import add_dataset_arguments, read_dataset
 from src.basic.schema import Schema
 from src.basic.scenario_db import ScenarioDB, add_scenario_arguments
 from src.basic.lexicon import Lexicon, add_lexicon_arguments
-from src.model.preprocess import DataGenerator, Preprocessor, add_preprocess_arguments
+from src.model.preprocess import DataGenerator, PreparedDataGenerator, Preprocessor, add_preprocess_arguments
 from src.model.encdec import add_model_arguments, build_model
 from src.model.learner import add_learner_arguments, Learner
 from src.model.evaluate import Evaluator
@@ -52,6 +52,7 @@ if __name__ == '__main__':
         saved_config = read_json(config_path)
         saved_config['decoding'] = args.decoding
         saved_config['batch_size'] = args.batch_size
+        saved_config['msg_passing'] = args.msg_passing
         model_args = argparse.Namespace(**saved_config)
 
         # Checkpoint
@@ -76,24 +77,33 @@ if __name__ == '__main__':
         ckpt = None
 
     schema = Schema(model_args.schema_path, model_args.domain)
-    scenario_db = ScenarioDB.from_dict(schema, read_json(args.scenarios_path))
-    dataset = read_dataset(scenario_db, args)
-    print 'Building lexicon...'
-    start = time.time()
-    lexicon = Lexicon(schema, args.learned_lex, stop_words=args.stop_words)
-    print '%.2f s'% (time.time() - start)
 
     # Dataset
     use_kb = False if model_args.model == 'encdec' else True
     copy = True if model_args.model == 'attn-copy-encdec' else False
     if model_args.model == 'attn-copy-encdec':
         model_args.entity_target_form = 'graph'
-    preprocessor = Preprocessor(schema, lexicon, model_args.entity_encoding_form, model_args.entity_decoding_form, model_args.entity_target_form)
     if args.test:
         model_args.dropout = 0
-        data_generator = DataGenerator(None, None, dataset.test_examples, preprocessor, schema, model_args.num_items, mappings, use_kb, copy)
+    if args.prepared_data:
+        # Examples are preprocessed and batched already; the preprocessor only maps entity forms
+        preprocessor = Preprocessor(schema, None, model_args.entity_encoding_form, model_args.entity_decoding_form, model_args.entity_target_form)
+        data_generator = PreparedDataGenerator(args.prepared_data, preprocessor, mappings, use_kb, copy)
     else:
-        data_generator = DataGenerator(dataset.train_examples, dataset.test_examples, None, preprocessor, schema, model_args.num_items, mappings, use_kb, copy)
+        scenario_db = ScenarioDB.from_dict(schema, read_json(args.scenarios_path))
+        dataset = read_dataset(scenario_db, args)
+        print 'Building lexicon...'
+        start = time.time()
+        lexicon = Lexicon(schema, args.learned_lex, stop_words=args.stop_words, lexicon_cache=args.lexicon_cache, fuzzy_index=args.fuzzy_index, link_cache_size=args.link_cache_size, lexicon_mmap=args.lexicon_mmap)
+        print '%.2f s'% (time.time() - start)
+
+        preprocessor = Preprocessor(schema, lexicon, model_args.entity_encoding_form, model_args.entity_decoding_form, model_args.entity_target_form, num_workers=args.link_workers)
+        if args.test:
+            data_generator = DataGenerator(None, None, dataset.test_examples, preprocessor, schema, model_args.num_items, mappings, use_kb, copy, cache=args.preprocess_cache, bucket=args.bucket)
+        else:
+            data_generator = DataGenerator(dataset.train_examples, dataset.test_examples, None, preprocessor, schema, model_args.num_items, mappings, use_kb, copy, cache=args.preprocess_cache, bucket=args.bucket)
+        if lexicon.link_cache is not None:
+            print 'Entity linking cache: %(hits)d hits, %(misses)d misses' % lexicon.link_cache.stats()
     for d, n in data_generator.num_examples.iteritems():
         logstats.add('data', d, 'num_dialogues', n)
 
@@ -1,6 +1,6 @@
 from collections import defaultdict
 import numpy as np
-from itertools import izip, islice, chain, repeat
+from itertools import izip, islice
 from src.model.vocab import is_entity, Vocabulary
 from src.model.graph_embedder_config import GraphEmbedderConfig
 
@@ -20,7 +20,7 @@ class GraphMetadata(object):
     '''
     Schema information and basic config of Graph.
     '''
-    def __init__(self, schema, entity_map, relation_map, utterance_size, max_num_entities, max_degree=10, entity_hist_len=2, max_num_items=10):
+    def __init__(self, schema, entity_map, relation_map, utterance_size, max_num_entities, max_degree=10, entity_hist_len=2, max_num_items=10, msg_passing='padded'):
         # {attribute_name: attribute_type}, e.g., 'Name': 'person'
         self.attribute_types = schema.get_attributes()
 
@@ -37,6 +37,9 @@ class GraphMetadata(object):
         # initial utterance matrix size.
         self.max_num_entities = max_num_entities
 
+        # Message passing of GraphEmbedder: batch node_paths (padded) or edge lists (segment)
+        self.msg_passing = msg_passing
+
         # Node features {feat_name: (offset, feat_size)}
         # degree: 0-max_degree
         # node_type: entity, item, attr
@@ -74,6 +77,12 @@ class GraphBatch(object):
     def __init__(self, graphs):
         self.graphs = graphs
         self.batch_size = len(graphs)
+        # Batched graph tensors and the versions of graphs they are computed from
+        self.graph_tensors = None
+        self.graph_tensors_versions = None
+        # Batched entity id <-> node id lookup arrays
+        self.entity_node_maps = None
+        self.entity_node_maps_versions = None
 
     def _max_num_nodes(self):
         return max([graph.nodes.size for graph in self.graphs])
@@ -82,7 +91,8 @@ class GraphBatch(object):
         return max([graph.paths.shape[0] for graph in self.graphs])
 
     def _max_num_paths_per_node(self):
-        return max([max([paths.shape[0] for paths in graph.node_paths]) for graph in self.graphs])
+        # Nodes without paths have one padded path
+        return max([max(1, np.max(np.diff(graph.path_ptr))) for graph in self.graphs])
 
     def _make_batch(self, shape, fill_value, dtype, attr):
         batch_data = np.full(shape, fill_value, dtype=dtype)
@@ -108,11 +118,26 @@ class GraphBatch(object):
 
     def _batch_node_paths(self, max_num_nodes, max_num_paths_per_node):
         batch_data = np.full((self.batch_size, max_num_nodes, max_num_paths_per_node), Graph.metadata.PAD_PATH_ID, dtype=np.int32)
+        path_inds = np.arange(max_num_paths_per_node, dtype=np.int32)
         for i, graph in enumerate(self.graphs):
-            for j, node_path in enumerate(graph.node_paths):
-                batch_data[i][j][:len(node_path)] = node_path
+            start, end = graph.path_ptr[:-1], graph.path_ptr[1:]
+            node_paths = start[:, np.newaxis] + path_inds
+            has_path = node_paths < end[:, np.newaxis]
+            batch_data[i][:len(start)][has_path] = node_paths[has_path]
         return batch_data
 
+    def _batch_edges(self, max_num_nodes, max_num_paths):
+        '''
+        Flat edge lists of the batch, excluding padded paths. edge_paths are row indices of
+        paths reshaped to (batch_size x max_num_paths) and edge_nodes are row indices of nodes
+        reshaped to (batch_size x max_num_nodes), i.e. the (sorted) segment id of each edge.
+        '''
+        edge_paths, edge_nodes = [], []
+        for i, graph in enumerate(self.graphs):
+            edge_paths.append(np.arange(1, graph.paths.shape[0], dtype=np.int32) + i * max_num_paths)
+            edge_nodes.append(graph.paths[1:, 0] + i * max_num_nodes)
+        return np.concatenate(edge_paths), np.concatenate(edge_nodes)
+
     def _batch_node_feats(self, max_num_nodes):
         return self._make_batch((self.batch_size, max_num_nodes, Graph.metadata.feat_size), 0, np.float32, 'feats')
 
@@ -131,33 +156,62 @@ class GraphBatch(object):
             batch_entity_lists[i][:n] = entity_list
         return batch_entity_lists
 
+    def _batch_rows(self, data):
+        '''
+        Batch index of each element in data (batch_size, ...), for fancy indexing.
+        '''
+        return np.arange(self.batch_size).reshape((-1,) + (1,) * (data.ndim - 1))
+
+    def _get_entity_node_maps(self):
+        '''
+        Return batched entity_to_node (batch_size, entity_map size) and node_to_entity
+        (batch_size, max_num_nodes) arrays, where -1 means no such node/entity. They are
+        reused until the version of some graph changes (see _get_graph_tensors).
+        '''
+        versions = tuple([graph.version for graph in self.graphs])
+        if versions != self.entity_node_maps_versions:
+            entity_to_node = np.array([graph.entity_to_node for graph in self.graphs])
+            node_to_entity = self._make_batch((self.batch_size, self._max_num_nodes()), -1, np.int32, 'entity_ids')
+            self.entity_node_maps = (entity_to_node, node_to_entity)
+            self.entity_node_maps_versions = versions
+        return self.entity_node_maps
+
     def copy_targets(self, targets, vocab_size):
         '''
         Replace targets that are entities to node ids, so that we learn to copy them from graph.
         We assume that entities in targets are mapped by entity_map and offset by vocab.size.
         '''
         new_targets = np.array(targets)
-        for i, graph in enumerate(self.graphs):
-            for j, t in enumerate(new_targets[i]):
-                if t >= vocab_size:
-                    entity = Graph.metadata.entity_map.to_word(t - vocab_size)
-                    new_targets[i][j] = graph.nodes.to_ind(entity) + vocab_size
+        entity_to_node, _ = self._get_entity_node_maps()
+        entity_mask = new_targets >= vocab_size
+        rows = np.broadcast_to(self._batch_rows(new_targets), new_targets.shape)[entity_mask]
+        node_ids = entity_to_node[rows, new_targets[entity_mask] - vocab_size]
+        assert np.all(node_ids >= 0), 'Target entity is not in the graph'
+        new_targets[entity_mask] = node_ids + vocab_size
         return new_targets
 
-    def copy_preds(self, preds, vocab_size):
+    def get_node_to_entity(self):
+        '''
+        Return the current node to entity map for copy_preds. It is not modified when the
+        graphs are updated later, so it can be kept to convert predictions made now.
+        '''
+        return self._get_entity_node_maps()[1]
+
+    def copy_preds(self, preds, vocab_size, node_to_entity=None):
         '''
         Inverse of copy_targets.
+        node_to_entity: see get_node_to_entity; defaults to the current map.
         '''
         new_preds = np.array(preds)
-        for i, graph in enumerate(self.graphs):
-            for j, t in enumerate(new_preds[i]):
-                if t >= vocab_size:
-                    try:
-                        entity = graph.nodes.to_word(t - vocab_size)
-                    except KeyError:
-                        new_preds[i][j] = 0  # <unk>
-                        continue
-                    new_preds[i][j] = Graph.metadata.entity_map.to_ind(entity) + vocab_size
+        if node_to_entity is None:
+            node_to_entity = self.get_node_to_entity()
+        node_ids = new_preds - vocab_size
+        is_node = (node_ids >= 0) & (node_ids < node_to_entity.shape[1])
+        rows = np.broadcast_to(self._batch_rows(new_preds), new_preds.shape)[is_node]
+        entity_ids = node_to_entity[rows, node_ids[is_node]]
+        # A padded node is predicted: <unk>
+        new_preds[new_preds >= vocab_size] = 0
+        new_preds[is_node] = np.where(entity_ids >= 0, entity_ids + vocab_size, 0)
         return new_preds
 
     def update_graph(self, tokens, stage=None):
@@ -171,31 +225,37 @@ class GraphBatch(object):
         entity_lists = [graph.get_entity_list() for graph in self.graphs]
         return entity_lists
 
-    def _batch_zero_utterances(self, max_num_nodes):
-        # Plus one because the last utterance is the padding.
-        num_rows = max(max_num_nodes, Graph.metadata.max_num_entities) + 1
-        self.pad_utterance_id = num_rows - 1
+    def _batch_zero_utterances(self, num_rows):
         return np.zeros([self.batch_size, num_rows, Graph.metadata.utterance_size], dtype=np.float32)
 
-    def update_utterances(self, utterances, max_num_nodes):
-        return (self._update_utterances(utterances[0], max_num_nodes),
-                self._update_utterances(utterances[1], max_num_nodes))
-
-    def _update_utterances(self, utterances, max_num_nodes):
+    def _update_utterances(self, utterances, num_rows):
         '''
-        Resize utterance matrix if there are more nodes (expensive).
+        Resize utterance matrix if there are more nodes than rows (see get_graph_data).
+        Only rows before the padded utterance (the last row) are kept, i.e. new nodes and
+        reserved rows start from zero utterances.
         '''
-        num_rows = utterances.shape[1]
-        if num_rows > max_num_nodes:
+        if utterances.shape[1] == num_rows:
             return utterances
         else:
-            new_utterances = self._batch_zero_utterances(max_num_nodes)
-            old_num_rows = num_rows
-            batch_size, num_rows, _ = new_utterances.shape
-            for i in xrange(batch_size):
-                new_utterances[i][:old_num_rows] = utterances[i]
+            new_utterances = self._batch_zero_utterances(num_rows)
+            old_pad_utterance_id = utterances.shape[1] - 1
+            new_utterances[:, :old_pad_utterance_id] = utterances[:, :old_pad_utterance_id]
             return new_utterances
 
+    def get_utterances(self, utterances, num_rows):
+        '''
+        Return encoder and decoder utterance matrices with num_rows rows: zero matrices at the
+        beginning of a dialogue (utterances is None), otherwise utterances from the GraphEmbedder.
+        Also return the utterance mask (batch_size, num_rows), which is False for reserved rows
+        and the padded utterance, i.e. rows that are not nodes of the graph.
+        '''
+        utterance_mask = self._batch_mask(num_rows)
+        if utterances is None:
+            return (self._batch_zero_utterances(num_rows),
+                    self._batch_zero_utterances(num_rows)), utterance_mask
+        return (self._update_utterances(utterances[0], num_rows),
+                self._update_utterances(utterances[1], num_rows)), utterance_mask
+
     def get_zero_checklists(self, seq_len):
         max_num_nodes = self._max_num_nodes()
         return np.zeros([self.batch_size, seq_len, max_num_nodes])
@@ -208,19 +268,14 @@ class GraphBatch(object):
         '''
         Convert entity ids from entity_map to node ids in graph.
         entities: array of same size as inputs, -1 means non-entity words.
-        Return entity_mask and node_ids.
+        Return node_ids, where -1 means non-entity words or entities not in the graph.
         '''
+        entity_to_node, _ = self._get_entity_node_maps()
         node_ids = np.full(entities.shape, -1, dtype=np.int32)
-        graph_iter = chain.from_iterable((repeat(graph, entities.shape[1]) for graph in self.graphs))
-        for entity_id, node_id, graph in izip(np.nditer(entities), np.nditer(node_ids, op_flags=['readwrite']), graph_iter):
-            entity_id = entity_id[()]
-            if entity_id != -1:
-                try:
-                    # [()]: entity_id is a 0-dim ndarray
-                    node_id[...] = graph.nodes.to_ind(Graph.metadata.entity_map.to_word(entity_id))
-                except KeyError:
-                    # A padded node is predicted and the entity is <unk>
-                    pass
+        # Entities out of range are predicted from padded nodes and are <unk>
+        entity_mask = (entities >= 0) & (entities < entity_to_node.shape[1])
+        rows = np.broadcast_to(self._batch_rows(entities), entities.shape)[entity_mask]
+        node_ids[entity_mask] = entity_to_node[rows, entities[entity_mask]]
         return node_ids
 
     def _pred_to_node_id(self, preds, offset):
@@ -228,42 +283,79 @@ class GraphBatch(object):
         entities[entities < 0] = -1
         return self._entity_to_node_id(entities)
 
-    def get_batch_data(self, encoder_tokens, decoder_tokens, encoder_entities, decoder_entities, utterances, vocab):
+    def get_graph_data(self, encoder_tokens, decoder_tokens, encoder_entities, decoder_entities, num_utterance_rows=None):
         '''
-        Construct batched inputs for GraphEmbedder. (These could be precomputed as well but
-        can take lots of memory.)
+        Construct batched inputs for GraphEmbedder except utterance matrices, which depend on
+        the GraphEmbedder outputs of the previous step (see get_utterances). Thus inputs of a
+        sequence of batches can be computed ahead of running the model.
         - Extract entities from encoder_tokens, decoder_tokens to update their utterances.
-        - At the beginning of a dialogue, provide zero utterance matrices; during the dialogue
-          we will get updated utterance matrices from GraphEmbedder.
-        - node_ids, entity_ids, paths, node_paths, node_feats
+        - node_ids, entity_ids, paths, node_paths or edge_paths/edge_nodes, node_feats
+        num_utterance_rows: number of rows in the current utterance matrices, None at the
+        beginning of a dialogue; the returned num_utterance_rows is that of the new ones.
+        Rows are reserved for nodes to be added: the utterance matrices are only resized
+        (doubled) when the number of nodes reaches the padded utterance. Reserved rows are
+        masked out by the utterance mask (see get_utterances).
         '''
         encoder_entity_lists = self.update_graph(encoder_tokens, stage='encoding')
         decoder_entity_lists = self.update_graph(decoder_tokens, stage='decoding')
 
         max_num_nodes = self._max_num_nodes()
-        if utterances is None:
-            # Encoder utterances and decoder utterances
-            utterances = (self._batch_zero_utterances(max_num_nodes),
-                          self._batch_zero_utterances(max_num_nodes))
-        else:
-            utterances = self.update_utterances(utterances, max_num_nodes)
+        if num_utterance_rows is None:
+            # Plus one because the last utterance is the padding.
+            num_utterance_rows = max(max_num_nodes, Graph.metadata.max_num_entities) + 1
+        elif num_utterance_rows <= max_num_nodes:
+            num_utterance_rows = max(max_num_nodes + 1, num_utterance_rows * 2)
+        self.pad_utterance_id = num_utterance_rows - 1
 
-        max_num_paths = self._max_num_paths()
-        max_num_paths_per_node = self._max_num_paths_per_node()
         # TODO: entities -> update_entities
-        batch = {
+        batch = dict(self._get_graph_tensors(max_num_nodes))
+        batch.update({
+                 'num_utterance_rows': num_utterance_rows,
+                 'encoder_entities': self._batch_entity_lists(encoder_entity_lists, self.pad_utterance_id),
+                 'decoder_entities': self._batch_entity_lists(decoder_entity_lists, self.pad_utterance_id),
+                 'encoder_nodes': None if encoder_entities is None else self._entity_to_node_id(encoder_entities),
+                 'decoder_nodes': None if decoder_entities is None else self._entity_to_node_id(decoder_entities),
+                })
+        return batch
+
+    def _get_graph_tensors(self, max_num_nodes):
+        '''
+        Return padded node_ids, mask, entity_ids, paths, node_feats, and node_paths or flat
+        edge_paths and edge_nodes (see _batch_edges) depending on Graph.metadata.msg_passing.
+        They only change when nodes are added to a graph, so they are reused until the version
+        of some graph changes. NOTE: the arrays are shared between calls and should not be
+        modified.
+        '''
+        versions = tuple([graph.version for graph in self.graphs])
+        if versions != self.graph_tensors_versions:
+            max_num_paths = self._max_num_paths()
+            self.graph_tensors = {
                  'node_ids': self._batch_node_ids(max_num_nodes),
                  'mask': self._batch_mask(max_num_nodes),
                  'entity_ids': self._batch_entity_ids(max_num_nodes),
                  'paths': self._batch_paths(max_num_paths),
-                 'node_paths': self._batch_node_paths(max_num_nodes, max_num_paths_per_node),
                  'node_feats': self._batch_node_feats(max_num_nodes),
-                 'utterances': utterances,
-                 'encoder_entities': self._batch_entity_lists(encoder_entity_lists, self.pad_utterance_id),
-                 'decoder_entities': self._batch_entity_lists(decoder_entity_lists, self.pad_utterance_id),
-                 'encoder_nodes': None if encoder_entities is None else self._entity_to_node_id(encoder_entities),
-                 'decoder_nodes': None if decoder_entities is None else self._entity_to_node_id(decoder_entities),
                 }
+            if Graph.metadata.msg_passing == 'segment':
+                edge_paths, edge_nodes = self._batch_edges(max_num_nodes, max_num_paths)
+                self.graph_tensors['edge_paths'] = edge_paths
+                self.graph_tensors['edge_nodes'] = edge_nodes
+            else:
+                self.graph_tensors['node_paths'] = self._batch_node_paths(max_num_nodes, self._max_num_paths_per_node())
+            self.graph_tensors_versions = versions
+        return self.graph_tensors
+
+    def get_batch_data(self, encoder_tokens, decoder_tokens, encoder_entities, decoder_entities, utterances, vocab):
+        '''
+        Construct batched inputs for GraphEmbedder. (These could be precomputed as well but
+        can take lots of memory.)
+        - At the beginning of a dialogue, provide zero utterance matrices; during the dialogue
+          we will get updated utterance matrices from GraphEmbedder.
+        - See get_graph_data for the rest.
+        '''
+        num_utterance_rows = None if utterances is None else utterances[0].shape[1]
+        batch = self.get_graph_data(encoder_tokens, decoder_tokens, encoder_entities, decoder_entities, num_utterance_rows)
+        batch['utterances'], batch['utterance_mask'] = self.get_utterances(utterances, batch['num_utterance_rows'])
         return batch
 
 class Graph(object):
@@ -275,6 +367,8 @@ class Graph(object):
     def __init__(self, kb):
         assert Graph.metadata is not None
         self.kb = kb
+        # Incremented whenever nodes or paths change (see GraphBatch._get_graph_tensors)
+        self.version = 0
         self.reset()
 
     def reset(self):
@@ -293,22 +387,34 @@ class Graph(object):
 
         # Input data to feed_dict
         self.node_ids = np.arange(self.nodes.size, dtype=np.int32)
-        self.entity_ids = np.array([Graph.metadata.entity_map.to_ind(self.nodes.to_word(i)) for i in xrange(self.nodes.size)], dtype=np.int32)
+        self.entity_ids = Graph.metadata.entity_map.to_inds(self.nodes.ind_to_word)
+        # Map entity ids to node ids (-1 if the entity is not in the graph)
+        entity_map = Graph.metadata.entity_map
+        self.entity_to_node = np.full(entity_map.offset + entity_map.size, -1, dtype=np.int32)
+        self._update_entity_to_node(self.node_ids, self.entity_ids)
         self.paths = np.array(self.paths, dtype=np.int32)
         self.feats = self.get_features()
-        self.node_paths = self.get_node_paths()
 
         # Entity/token sequence in the dialogue
         self.entities = []
+        self.version += 1
 
     def get_node_paths(self):
+        '''
+        Return a list of path ids starting from each node (PAD_PATH_ID if there is none).
+        '''
         node_paths = []
-        for node_id in self.node_ids:
-            # Skip the first padding path
-            paths = [path_id for path_id, path in enumerate(self.paths) if path_id != Graph.metadata.PAD_PATH_ID and path[0] == node_id]
-            node_paths.append(np.array(paths, dtype=np.int32))
+        for start, end in izip(self.path_ptr[:-1], self.path_ptr[1:]):
+            if start == end:
+                node_paths.append(np.array([Graph.metadata.PAD_PATH_ID], dtype=np.int32))
+            else:
+                node_paths.append(np.arange(start, end, dtype=np.int32))
         return node_paths
 
+    @property
+    def node_paths(self):
+        return self.get_node_paths()
+
     def get_input_data(self):
         '''
         Return feed_dict data to the GraphEmbed model.
@@ -356,6 +462,18 @@ class Graph(object):
             for entity_node in ent_set:
                 self._add_path(attr_node, 'has', entity_node)
         self.paths = np.array(self.paths, dtype=np.int32)
+        self._sort_paths()
+
+    def _sort_paths(self):
+        '''
+        Store paths in CSR form: paths (except the first padding path) are sorted by the
+        source node, such that paths starting from node i are path_ptr[i]:path_ptr[i+1].
+        '''
+        # Stable sort to keep the order of paths of each node
+        order = np.argsort(self.paths[1:, 0], kind='mergesort') + 1
+        self.paths = np.concatenate((self.paths[:1], self.paths[order]), axis=0)
+        num_paths = np.bincount(self.paths[1:, 0], minlength=self.nodes.size)
+        self.path_ptr = np.concatenate(([1], 1 + np.cumsum(num_paths))).astype(np.int32)
 
     def read_utterance(self, tokens, stage=None):
         '''
@@ -380,16 +498,24 @@ class Graph(object):
         new_feat_vec = self.get_feat_vec(feats)
         self.feats = np.concatenate((self.feats, new_feat_vec), axis=0)
 
+    def _update_entity_to_node(self, node_ids, entity_ids):
+        unk_ind = Graph.metadata.entity_map.unk_ind
+        if unk_ind is not None:
+            # Nodes that are not in entity_map
+            known = entity_ids != unk_ind
+            node_ids, entity_ids = node_ids[known], entity_ids[known]
+        self.entity_to_node[entity_ids] = node_ids
+
     def _update_entity_ids(self, entities):
-        self.entity_ids = np.concatenate([self.entity_ids,
-                   [Graph.metadata.entity_map.to_ind(entity) for entity in entities]], axis=0)
+        entity_ids = Graph.metadata.entity_map.to_inds(entities)
+        self._update_entity_to_node(self.nodes.to_inds(entities), entity_ids)
+        self.entity_ids = np.concatenate([self.entity_ids, entity_ids], axis=0)
 
     def _update_node_paths(self, entities):
         '''
-        New entities map to the padded path.
+        New entities have no paths (i.e. they map to the padded path).
         '''
-        for _ in entities:
-            self.node_paths.append(np.array([Graph.metadata.PAD_PATH_ID]))
+        self.path_ptr = np.concatenate((self.path_ptr, np.full(len(entities), self.path_ptr[-1], dtype=np.int32)))
 
     def add_entity_nodes(self, entities):
         # Paths do not change, no need to update
@@ -397,6 +523,7 @@ class Graph(object):
         self._update_entity_ids(entities)
         self._update_feats(entities)
         self._update_node_paths(entities)
+        self.version += 1
 
     def get_entity_list(self):
         '''
@@ -423,14 +550,14 @@ class Graph(object):
         #return type_
 
     def get_features(self):
-        nodes = [self.nodes.to_word(i) for i in xrange(self.nodes.size)]
+        nodes = self.nodes.ind_to_word
         # For entity node, -1 degree so that it excludes the edge incident to the attr node
         feats = [[0, self._node_type(node)] if node[1] == 'item' or node[1] == 'attr'
                 else [-1, self._node_type(node)] for node in nodes]
         # Compute degree of each node
-        for path in self.paths:
-            n1, r, n2 = path
-            feats[n1][0] += 1
+        degrees = np.bincount(self.paths[:, 0], minlength=len(nodes))
+        for feat, degree in izip(feats, degrees):
+            feat[0] += int(degree)
         return self.get_feat_vec(feats)
 
     @classmethod
@@ -13,6 +13,7 @@ def add_graph_embed_arguments(parser):
     parser.add_argument('--utterance-decay', type=float, default=1, help='Decay of old utterance embedding over time')
     parser.add_argument('--learned-utterance-decay', default=False, action='store_true', help='Learning weight to combine old and new utterances')
     parser.add_argument('--msg-aggregation', default='sum', choices=['sum', 'max', 'avg'], help='How to aggregate messages from neighbors')
+    parser.add_argument('--msg-passing', default='padded', choices=['padded', 'segment'], help='Gather messages through padded neighbor lists of each node (padded) or aggregate flat edge lists by segment ops (segment)')
 
 activation = tf.tanh
 
@@ -54,16 +55,27 @@ class GraphEmbedder(object):
                 paths = tf.placeholder(tf.int32, shape=[None, None, 3], name='paths')
 
                 # Each node has a list of paths starting from that node. path id is row index
-                # in paths. Paths of padded nodes are PATH_PAD.
+                # in paths. Paths of padded nodes are PATH_PAD. Not fed for msg_passing='segment'.
                 node_paths = tf.placeholder(tf.int32, shape=[None, None, None], name='node_paths')
 
                 # Node features. NOTE: feats[i] must corresponds to node_ids[i]
                 node_feats = tf.placeholder(tf.float32, shape=[None, None, self.config.feat_size], name='node_feats')
 
+                # Rows of the utterance matrices that are nodes; the others are reserved for
+                # nodes to be added or the padded utterance.
+                self.utterance_mask = tf.placeholder(tf.bool, shape=[None, None], name='utterance_mask')
+
                 self.input_data = (node_ids, mask, entity_ids, paths, node_paths, node_feats)
                 # TODO:
                 self.node_ids, self.mask, self.entity_ids, self.paths, self.node_paths, self.node_feats = self.input_data
 
+                # Flat edge lists (excluding padded paths) for msg_passing='segment'. An edge is a
+                # path id in (batch_size x num_paths) paths and its source node id in
+                # (batch_size x num_nodes) nodes, sorted by the node id.
+                if self.config.msg_passing == 'segment':
+                    self.edge_paths = tf.placeholder(tf.int32, shape=[None], name='edge_paths')
+                    self.edge_nodes = tf.placeholder(tf.int32, shape=[None], name='edge_nodes')
+
             # This will be used by GraphDecoder to figure out the shape of the output attention scores
             self.node_ids = self.input_data[0]
 
@@ -73,8 +85,13 @@ class GraphEmbedder(object):
         feed_dict[self.mask] = kwargs.pop('mask')
         feed_dict[self.entity_ids] = kwargs.pop('entity_ids')
         feed_dict[self.paths] = kwargs.pop('paths')
-        feed_dict[self.node_paths] = kwargs.pop('node_paths')
         feed_dict[self.node_feats] = kwargs.pop('node_feats')
+        feed_dict[self.utterance_mask] = kwargs.pop('utterance_mask')
+        if self.config.msg_passing == 'segment':
+            feed_dict[self.edge_paths] = kwargs.pop('edge_paths')
+            feed_dict[self.edge_nodes] = kwargs.pop('edge_nodes')
+        else:
+            feed_dict[self.node_paths] = kwargs.pop('node_paths')
         return feed_dict
 
     def get_context(self, utterances):
@@ -83,6 +100,9 @@ class GraphEmbedder(object):
         utterances: current utterance embeddings from the dialogue history
         '''
         node_ids, mask, entity_ids, paths, node_paths, node_feats = self.input_data
+        # Only utterances of nodes are aggregated into node embeddings
+        utterance_mask = tf.expand_dims(tf.to_float(self.utterance_mask), 2)
+        utterances = [u * utterance_mask for u in utterances]
         with tf.variable_scope(self.scope or type(self).__name__):
             with tf.variable_scope('NodeEmbedding'):
                 with tf.variable_scope('InitNodeEmbedding') as scope:
@@ -104,6 +124,8 @@ class GraphEmbedder(object):
                 # Message passing
                 def mp(curr_node_embedding):
                     messages = self.embed_path(curr_node_embedding, self.edge_embedding, paths)
+                    if self.config.msg_passing == 'segment':
+                        return self.pass_message_segment(messages, self.edge_paths, self.edge_nodes, tf.shape(node_ids)[1])
                     return self.pass_message(messages, node_paths, self.config.pad_path_id)
 
                 node_embeds = [initial_node_embed]
@@ -176,6 +198,45 @@ class GraphEmbedder(object):
 
         return new_node_embeds
 
+    def pass_message_segment(self, path_embeds, edge_paths, edge_nodes, num_nodes):
+        '''
+        Same as pass_message but aggregate path embeddings of the flat edge list by segment
+        ops, so that the computation is proportional to the number of edges instead of
+        num_nodes x max degree.
+        edge_paths: row index of each edge in path_embeds reshaped to (batch_size x num_paths)
+        edge_nodes: (sorted) row index of the source node of each edge in (batch_size x num_nodes)
+        '''
+        batch_size = tf.shape(path_embeds)[0]
+        path_embed_size = path_embeds.get_shape().as_list()[-1]
+        num_segments = batch_size * num_nodes
+
+        embeds = tf.gather(tf.reshape(path_embeds, [-1, path_embed_size]), edge_paths)  # (num_edges, path_embed_size)
+        num_neighbors = tf.unsorted_segment_sum(tf.ones_like(edge_nodes, dtype=tf.float32), edge_nodes, num_segments)
+        num_neighbors = tf.reshape(num_neighbors, [batch_size, num_nodes, 1])
+
+        # (batch_size, num_nodes, path_embed_size)
+        if self.config.msg_agg == 'sum' or self.config.msg_agg == 'avg':
+            new_node_embeds = tf.unsorted_segment_sum(embeds, edge_nodes, num_segments)
+            new_node_embeds = tf.reshape(new_node_embeds, [batch_size, num_nodes, path_embed_size])
+            if self.config.msg_agg == 'avg':
+                new_node_embeds = new_node_embeds / (num_neighbors + EPS)
+        elif self.config.msg_agg == 'max':
+            # segment_max requires consecutive segment ids, so take the max over nodes with
+            # edges and then scatter them to all nodes (nodes without edges are 0)
+            nodes, segment_ids = tf.unique(edge_nodes)
+            new_node_embeds = tf.segment_max(embeds, segment_ids)
+            new_node_embeds = tf.unsorted_segment_sum(new_node_embeds, nodes, num_segments)
+            new_node_embeds = tf.reshape(new_node_embeds, [batch_size, num_nodes, path_embed_size])
+            # In pass_message, padded neighbors (masked to 0) take part in the max for nodes
+            # with fewer neighbors than the max degree
+            max_num_neighbors = tf.maximum(tf.reduce_max(num_neighbors), 1)
+            has_padded = tf.tile(tf.less(num_neighbors, max_num_neighbors), [1, 1, path_embed_size])
+            new_node_embeds = tf.where(has_padded, tf.maximum(new_node_embeds, 0), new_node_embeds)
+        else:
+            raise ValueError('Unknown message aggregation method')
+
+        return new_node_embeds
+
     def update_utterance(self, entity_indices, utterance, curr_utterances, utterance_id):
         new_utterances = []
         for i, u in enumerate(curr_utterances):
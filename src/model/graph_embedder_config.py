@@ -1,5 +1,5 @@
 class GraphEmbedderConfig(object):
-    def __init__(self, node_embed_size, edge_embed_size, graph_metadata, entity_embed_size=None, use_entity_embedding=False, mp_iters=2, decay=1, msg_agg='sum', learned_decay=False):
+    def __init__(self, node_embed_size, edge_embed_size, graph_metadata, entity_embed_size=None, use_entity_embedding=False, mp_iters=2, decay=1, msg_agg='sum', learned_decay=False, msg_passing='padded'):
         self.node_embed_size = node_embed_size
 
         self.num_edge_labels = graph_metadata.relation_map.size
@@ -16,6 +16,7 @@ class GraphEmbedderConfig(object):
         # Number of message passing iterations
         self.mp_iters = mp_iters
         self.msg_agg = msg_agg
+        self.msg_passing = msg_passing
 
         self.context_size = self.node_embed_size * mp_iters
         # x2 because we encoder and decoder utterances are concatenated
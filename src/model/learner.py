@@ -3,7 +3,11 @@ Main learning loop.
 '''
 
 import os
+import sys
 import time
+import threading
+from Queue import Queue, Empty
+from itertools import izip
 import tensorflow as tf
 from lib import logstats
 from vocab import is_entity
@@ -26,12 +30,75 @@ def add_learner_arguments(parser):
     parser.add_argument('--init-from', help='Initial parameters')
     parser.add_argument('--checkpoint', default='.', help='Directory to save learned models')
     parser.add_argument('--gpu', type=int, default=0, help='Use GPU or not')
+    parser.add_argument('--prefetch', type=int, default=0, help='Number of training batches to prepare in a background thread while the model runs (0 to prepare them in turn)')
 
 optim = {'adagrad': tf.train.AdagradOptimizer,
          'sgd': tf.train.GradientDescentOptimizer,
          'adam': tf.train.AdamOptimizer,
         }
 
+class Prefetcher(object):
+    '''
+    Pull items from iterator and apply func to them in a background thread, keeping at most
+    depth processed items ahead of the consumer. Only as many items as requested (see
+    request) are pulled, so that the iterator is idle in between, e.g. during evaluation.
+    '''
+    def __init__(self, iterator, func, depth):
+        self.queue = Queue(maxsize=depth)
+        self.requests = threading.Semaphore(0)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._produce, args=(iterator, func))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _produce(self, iterator, func):
+        try:
+            while True:
+                self.requests.acquire()
+                if self.stopped.is_set():
+                    return
+                try:
+                    item = iterator.next()
+                except StopIteration:
+                    break
+                self.queue.put((func(item), None))
+        except Exception:
+            self.queue.put((None, sys.exc_info()))
+            return
+        self.queue.put((None, None))
+
+    def request(self, num_items):
+        '''
+        Allow the producer to pull num_items more items from iterator.
+        '''
+        for _ in xrange(num_items):
+            self.requests.release()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        item, exc_info = self.queue.get()
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if item is None:
+            raise StopIteration
+        return item
+
+    def close(self):
+        '''
+        Stop the producer and wait for the thread to exit.
+        '''
+        self.stopped.set()
+        # Unblock the producer if it is waiting for requests or the queue is full
+        self.requests.release()
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except Empty:
+                pass
+        self.thread.join()
+
 class Learner(object):
     def __init__(self, data, model, evaluator, batch_size=1, verbose=False):
         self.data = data  # DataGenerator object
@@ -55,15 +122,19 @@ class Learner(object):
             self._run_batch(dialogue_batch, sess, summary_map, test=True)
         return summary_map['total_loss']['sum'] / (summary_map['num_tokens']['sum'] + EPS)
 
+    def _copy_targets(self, graphs, targets, matched_items):
+        targets = graphs.copy_targets(targets, self.vocab.size)
+        matched_items = graphs.copy_targets(np.reshape(matched_items, [-1, 1]), self.vocab.size)
+        matched_items = np.reshape(matched_items, [-1])
+        return targets, matched_items
+
     # TODO: don't need graphs in the parameters
-    def _get_feed_dict(self, batch, encoder_init_state=None, graph_data=None, graphs=None, copy=False, init_checklists=None, encoder_nodes=None, decoder_nodes=None, matched_items=None):
+    def _get_feed_dict(self, batch, encoder_init_state=None, graph_data=None, graphs=None, copy=False, init_checklists=None, encoder_nodes=None, decoder_nodes=None, matched_items=None, targets=None):
         # NOTE: We need to do the processing here instead of in preprocess because the
         # graph is dynamic; also the original batch data should not be modified.
         if copy:
-            targets = graphs.copy_targets(batch['targets'], self.vocab.size)
-            matched_items = graphs.copy_targets(np.reshape(matched_items, [-1, 1]), self.vocab.size)
-            matched_items = np.reshape(matched_items, [-1])
-        else:
+            targets, matched_items = self._copy_targets(graphs, batch['targets'], matched_items)
+        elif targets is None:
             targets = batch['targets']
 
         encoder_args = {'inputs': batch['encoder_inputs'],
@@ -113,6 +184,38 @@ class Learner(object):
             print 'PRED:', self.data.textint_map.int_to_text(preds[i], 'target')
             print 'LOSS:', loss[i]
 
+    def _graph_seq(self, dialogue_batch):
+        '''
+        Yield inputs of each batch in the sequence that depend on the graph but not on the
+        model: graph data except utterances, checklists, targets, matched items and the
+        node to entity map to convert predictions (the graph may be updated by later batches
+        or reset by the time they are made). The graph is updated by each batch, so they are
+        computed in order.
+        '''
+        graphs = dialogue_batch['graph']
+        matched_items = dialogue_batch['matched_items']
+        num_utterance_rows = None
+        for batch in dialogue_batch['batch_seq']:
+            graph_data = graphs.get_graph_data(batch['encoder_tokens'], batch['decoder_tokens'], batch['encoder_entities'], batch['decoder_entities'], num_utterance_rows)
+            num_utterance_rows = graph_data['num_utterance_rows']
+            init_checklists = graphs.get_zero_checklists(1)
+            if self.data.copy:
+                targets, batch_matched_items = self._copy_targets(graphs, batch['targets'], matched_items)
+            else:
+                targets, batch_matched_items = batch['targets'], matched_items
+            yield graph_data, init_checklists, targets, batch_matched_items, graphs.get_node_to_entity()
+
+    def _prepare_batch(self, dialogue_batch):
+        '''
+        Compute the model-independent inputs of dialogue_batch ahead (see Prefetcher).
+        '''
+        if 'graph' not in dialogue_batch:
+            return dialogue_batch
+        # Batches are reused in every epoch, so don't modify them
+        dialogue_batch = dict(dialogue_batch)
+        dialogue_batch['graph_seq'] = list(self._graph_seq(dialogue_batch))
+        return dialogue_batch
+
     def _run_batch_graph(self, dialogue_batch, sess, summary_map, test=False):
         '''
         Run truncated RNN through a sequence of batch examples with knowledge graphs.
@@ -120,11 +223,11 @@ class Learner(object):
         encoder_init_state = None
         utterances = None
         graphs = dialogue_batch['graph']
-        matched_items = dialogue_batch['matched_items']
-        for i, batch in enumerate(dialogue_batch['batch_seq']):
-            graph_data = graphs.get_batch_data(batch['encoder_tokens'], batch['decoder_tokens'], batch['encoder_entities'], batch['decoder_entities'], utterances, self.vocab)
-            init_checklists = graphs.get_zero_checklists(1)
-            feed_dict = self._get_feed_dict(batch, encoder_init_state, graph_data, graphs, self.data.copy, init_checklists, graph_data['encoder_nodes'], graph_data['decoder_nodes'], matched_items)
+        # Computed in turn with the model unless prepared ahead
+        graph_seq = dialogue_batch.get('graph_seq') or self._graph_seq(dialogue_batch)
+        for batch, (graph_data, init_checklists, targets, matched_items, node_to_entity) in izip(dialogue_batch['batch_seq'], graph_seq):
+            graph_data['utterances'], graph_data['utterance_mask'] = graphs.get_utterances(utterances, graph_data['num_utterance_rows'])
+            feed_dict = self._get_feed_dict(batch, encoder_init_state, graph_data, graphs, False, init_checklists, graph_data['encoder_nodes'], graph_data['decoder_nodes'], matched_items, targets)
             if test:
                 logits, final_state, utterances, loss, seq_loss, total_loss = sess.run(
                         [self.model.decoder.output_dict['logits'],
@@ -147,7 +250,7 @@ class Learner(object):
             if self.verbose:
                 preds = np.argmax(logits, axis=2)
                 if self.data.copy:
-                    preds = graphs.copy_preds(preds, self.data.mappings['vocab'].size)
+                    preds = graphs.copy_preds(preds, self.data.mappings['vocab'].size, node_to_entity)
                 self._print_batch(batch, preds, seq_loss)
 
             if test:
@@ -215,6 +318,8 @@ class Learner(object):
         # Training loop
         train_data = self.data.generator(split, self.batch_size)
         num_per_epoch = train_data.next()
+        if args.prefetch > 0:
+            train_data = Prefetcher(train_data, self._prepare_batch, args.prefetch)
         step = 0
         saver = tf.train.Saver()
         save_path = os.path.join(args.checkpoint, 'tf_model.ckpt')
@@ -237,6 +342,10 @@ class Learner(object):
             epoch = 1
             while True:
                 print '================== Epoch %d ==================' % (epoch)
+                if args.prefetch > 0:
+                    # Batches of an epoch are only prepared once the previous epoch and
+                    # evaluation are done, when the producer resets the graphs
+                    train_data.request(num_per_epoch)
                 for i in xrange(num_per_epoch):
                     start_time = time.time()
                     self._run_batch(train_data.next(), sess, summary_map, test=False)
@@ -249,6 +358,7 @@ class Learner(object):
                         print '{}/{} (epoch {}) {}'.format(i+1, num_per_epoch, epoch, logstats.summary_map_to_str(summary_map))
                         summary_map = {}  # Reset
                 step = 0
+                print 'padding ratio=%.4f' % self.data.padding_ratio(split)
 
                 # Save model after each epoch
                 print 'Save model checkpoint to', save_path
@@ -283,3 +393,6 @@ class Learner(object):
                 if (epoch > args.min_epochs and num_epoch_no_impr >= 5) or epoch > args.max_epochs:
                     break
                 epoch += 1
+
+            if args.prefetch > 0:
+                train_data.close()
@@ -4,32 +4,63 @@ Preprocess examples in a dataset and generate data for models.
 
 import random
 import re
+import os
+import json
+import time
+import hashlib
 import numpy as np
+from src.basic.util import read_pickle, write_pickle, read_json, write_json
 from src.model.vocab import Vocabulary, is_entity
 from src.model.graph import Graph, GraphBatch, inv_rel, item_to_str
 from itertools import chain, izip
 from collections import namedtuple, defaultdict
 import copy
 
+# Bump when the output of Preprocessor.preprocess changes so that cached dialogues are recomputed
+PREPROCESS_VERSION = 2
+# Bump when the format written by DataGenerator.write_prepared_data changes
+PREPARED_DATA_VERSION = 1
+
 def add_preprocess_arguments(parser):
     parser.add_argument('--entity-encoding-form', choices=['type', 'canonical'], default='canonical', help='Input entity form to the encoder')
     parser.add_argument('--entity-decoding-form', choices=['canonical', 'type'], default='canonical', help='Input entity form to the decoder')
     parser.add_argument('--entity-target-form', choices=['canonical', 'type', 'graph'], default='canonical', help='Output entity form to the decoder')
+    parser.add_argument('--bucket', default=False, action='store_true', help='Batch dialogues with similar numbers of tokens at each turn together to reduce padding (otherwise batch by number of turns)')
+    parser.add_argument('--preprocess-cache', help='Directory to cache preprocessed dialogues in; reused when the examples, schema and lexicon are the same')
+    parser.add_argument('--prepared-data', help='Directory of batches prepared by scripts/prepare_data.py; used instead of preprocessing the examples')
 
 SpecialSymbols = namedtuple('SpecialSymbols', ['EOS', 'GO', 'SELECT', 'PAD', 'EOE'])
 markers = SpecialSymbols(EOS='</s>', GO='<go>', SELECT='<select>', PAD='<pad>', EOE='</e>')
 
+# Words or punctuation. '-' is removed to match lexicon preprocess: it is not part of any
+# token, so it separates tokens like a space.
+token_pattern = re.compile(r"[\w']+|[.,!?;&]")
+
 def tokenize(utterance):
     '''
     'hi there!' => ['hi', 'there', '!']
     '''
-    utterance = utterance.encode('utf-8').lower()
-    # Remove '-' to match lexicon preprocess
-    for s in (' - ', '-'):
-        utterance = utterance.replace(s, ' ')
-    # Split on punctuation
-    tokens = re.findall(r"[\w']+|[.,!?;&-]", utterance)
-    return tokens
+    return token_pattern.findall(utterance.encode('utf-8').lower())
+
+def tokenize_batch(utterances, cache=None):
+    '''
+    Tokenize a list of utterances; repeated utterances are tokenized once and share the
+    same list of tokens, which should not be modified.
+    cache: LRUCache of tokens of utterances shared across calls (optional).
+    '''
+    seen = {}
+    batch_tokens = []
+    for utterance in utterances:
+        tokens = seen.get(utterance)
+        if tokens is None:
+            tokens = cache.get(utterance) if cache is not None else None
+            if tokens is None:
+                tokens = tokenize(utterance)
+                if cache is not None:
+                    cache.put(utterance, tokens)
+            seen[utterance] = tokens
+        batch_tokens.append(tokens)
+    return batch_tokens
 
 word_to_num = {'one': '1', 'two': '2', 'three': '3', 'four': '4', 'five': '5', 'six': '6', 'seven': '7', 'eight': '8', 'nine': '9', 'ten': '10'}
 def normalize_number(token):
@@ -74,13 +105,14 @@ def build_vocab(dialogues, special_symbols=[], entity_forms=[]):
     # Add words
     for dialogue in dialogues:
         assert dialogue.is_int is False
+        words = dialogue.token_table.get_words()
         for turns in dialogue.token_turns:
-            for turn in turns:
-                for token in chain.from_iterable(turn):
-                    if is_entity(token):
-                        _add_entity(token)
-                    else:
-                        vocab.add_word(token)
+            for token in words[turns.data]:
+                if is_entity(token):
+                    _add_entity(token)
+                # </s> is added with the special symbols
+                elif token != markers.EOS:
+                    vocab.add_word(token)
 
     # Add special symbols
     vocab.add_words(special_symbols)
@@ -98,6 +130,8 @@ def create_mappings(dialogues, schema, num_items, entity_forms):
 class TextIntMap(object):
     '''
     Map between text and int for visualizing results.
+    Conversions of int arrays go through lookup arrays built on first use, since the
+    vocab and the entity map are fixed by the time they are converted.
     '''
     def __init__(self, vocab, entity_map, preprocessor):
         self.vocab = vocab
@@ -105,6 +139,43 @@ class TextIntMap(object):
         self.entity_forms = preprocessor.entity_forms
         self.preprocessor = preprocessor
         self.setting = {k: self.use_entity_map(v) for k, v in self.entity_forms.iteritems()}
+        # {stage: entity id -> vocab id of the entity form}
+        self.entity_to_vocab = {}
+        # Word of each vocab id followed by word of each entity id (offset by vocab size)
+        self.words = None
+        # Target id -> decoding input id
+        self.pred_to_input_table = None
+
+    def _get_words(self):
+        if self.words is None:
+            self.words = np.concatenate([self.vocab.get_words(), self.entity_map.get_words()])
+        return self.words
+
+    def _get_entity_to_vocab(self, stage):
+        if stage not in self.entity_to_vocab:
+            form = self.entity_forms[stage]
+            # NOTE: at this point we have lost the surface form of the entity: using an empty string
+            self.entity_to_vocab[stage] = self.vocab.to_inds([self.preprocessor.get_entity_form(('', entity), form)
+                for entity in self.entity_map.ind_to_word])
+        return self.entity_to_vocab[stage]
+
+    def _get_pred_to_input_table(self):
+        if self.pred_to_input_table is None:
+            size = self.vocab.size + (self.entity_map.size if self.setting['target'] else 0)
+            table = np.full(size, -1, dtype=np.int64)
+            for i in xrange(size):
+                try:
+                    table[i] = self._pred_to_input([[i]])[0][0]
+                except (KeyError, IndexError):
+                    # Left to _pred_to_input to raise if it is ever predicted
+                    pass
+            self.pred_to_input_table = table
+        return self.pred_to_input_table
+
+    def _pred_to_input(self, preds):
+        preds_utterances = [self.int_to_text(pred, 'target') for pred in preds]
+        input_utterances = [self.preprocessor.process_utterance(utterance, 'decoding') for utterance in preds_utterances]
+        return np.array([self.text_to_int(utterance, 'decoding') for utterance in input_utterances])
 
     def pred_to_input(self, preds):
         '''
@@ -112,9 +183,13 @@ class TextIntMap(object):
         '''
         if self.entity_forms['target'] == self.entity_forms['decoding']:
             return preds
-        preds_utterances = [self.int_to_text(pred, 'target') for pred in preds]
-        input_utterances = [self.preprocessor.process_utterance(utterance, 'decoding') for utterance in preds_utterances]
-        inputs = np.array([self.text_to_int(utterance, 'decoding') for utterance in input_utterances])
+        table = self._get_pred_to_input_table()
+        try:
+            inputs = table[preds]
+        except IndexError:
+            return self._pred_to_input(preds)
+        if (inputs < 0).any():
+            return self._pred_to_input(preds)
         return inputs
 
     def process_entity(self, token_array, stage):
@@ -133,12 +208,7 @@ class TextIntMap(object):
         # If use_entity_map, nothing needs to be done as entities are already mapped by the entity_map
         if not use_entity_map:
             # Entities needs to be transformed and mapped by vocab
-            for tok_int, is_ent in izip(np.nditer(token_array, op_flags=['readwrite']), np.nditer(entity_inds)):
-                if is_ent:
-                    entity = self.entity_map.to_word(tok_int - offset)
-                    # NOTE: at this point we have lost the surface form of the entity: using an empty string
-                    processed_entity = self.preprocessor.get_entity_form(('', entity), self.entity_forms[stage])
-                    tok_int[...] = self.vocab.to_ind(processed_entity)
+            token_array[entity_inds] = self._get_entity_to_vocab(stage)[entity_array[entity_inds]]
         return token_array, entity_array
 
     def use_entity_map(self, entity_form):
@@ -171,11 +241,86 @@ class TextIntMap(object):
         '''
         Inverse of text_to_int.
         '''
-        use_entity_map = self.setting[stage]
-        if not use_entity_map:
-            return [self.vocab.to_word(ind) for ind in inds]
-        else:
-            return [self.vocab.to_word(ind) if ind < self.vocab.size else self.entity_map.to_word(ind - self.vocab.size) for ind in inds]
+        words = self._get_words()
+        if not self.setting[stage]:
+            words = words[:self.vocab.size]
+        inds = np.asarray(inds, dtype=np.int64)
+        # Negative ids would wrap around in fancy indexing
+        if inds.size > 0 and (inds.min() < 0 or inds.max() >= len(words)):
+            raise KeyError('Index out of range of the vocabulary')
+        return words[inds].tolist()
+
+class TokenTable(Vocabulary):
+    '''
+    Interned tokens (words and entities) of the token turns of dialogues, such that each
+    entity tuple is stored once and turns are stored as token ids (see TurnArray).
+    '''
+    def __init__(self):
+        super(TokenTable, self).__init__(offset=0, unk=False)
+        # Lookup array built on first use
+        self.int_ids = None
+
+    def __setstate__(self, state):
+        super(TokenTable, self).__setstate__(state)
+        self.int_ids = None
+
+    def get_int_ids(self, textint_map):
+        '''
+        Array of the integer (see TextIntMap.text_to_int) of each id.
+        '''
+        if self.int_ids is None or self.int_ids[0] is not textint_map or len(self.int_ids[1]) != self.size:
+            ids = np.array(textint_map.text_to_int(self.get_words().tolist()), dtype=np.int32)
+            self.int_ids = (textint_map, ids)
+        return self.int_ids[1]
+
+class TurnArray(object):
+    '''
+    Turns of one agent perspective in a dialogue stored in a flat int32 array: utterances
+    are flattened with </s> after each one, and turn j is data[offsets[j]:offsets[j+1]].
+    '''
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_turns(cls, turns, eos):
+        '''
+        turns: list of turns, each a list of utterances (sequences of ids).
+        '''
+        lengths = [sum([len(utterance) + 1 for utterance in turn]) for turn in turns]
+        offsets = np.zeros(len(turns) + 1, dtype=np.int32)
+        offsets[1:] = np.cumsum(lengths)
+        data = np.full(offsets[-1], eos, dtype=np.int32)
+        start = 0
+        for turn in turns:
+            for utterance in turn:
+                data[start:start+len(utterance)] = utterance
+                # Followed by </s>
+                start += len(utterance) + 1
+        return cls(data, offsets)
+
+    def map(self, table):
+        '''
+        Return a TurnArray with the same turns where each id x is replaced by table[x].
+        '''
+        return TurnArray(table[self.data], self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def turn_lengths(self):
+        return np.diff(self.offsets)
+
+    def __getitem__(self, j):
+        return self.data[self.offsets[j]:self.offsets[j+1]]
+
+    def get_turn(self, j):
+        '''
+        Turn j, or an empty turn if j is beyond the end of the dialogue (padded turns).
+        '''
+        if j >= len(self):
+            return self.data[:0]
+        return self[j]
 
 class Dialogue(object):
     textint_map = None
@@ -191,15 +336,14 @@ class Dialogue(object):
         self.uuid = uuid
         self.kbs = kbs
         self.matched_items = self.get_correct_item(kbs)
-        # token_turns: tokens and entitys (output of entitylink)
+        # token_turns: tokens and entitys (output of entitylink) of encoding and decoding,
+        # lists of turns while adding utterances and TurnArrays of token_table ids after compact
         self.token_turns = ([], [])
-        # entities: -1 for non-entity words, entities are mapped based on entity_map
-        self.entities = ([], [])
-        # turns: input tokens of encoder, decoder input and target, later converted to integers
-        self.turns = ([], [], [])
+        self.token_table = None
+        # turns: TurnArrays of integers input to encoder, decoder input and target
+        self.turns = None
         self.agents = []
         self.is_int = False  # Whether we've converted it to integers
-        self.flattened = False
 
     @classmethod
     def get_correct_item(cls, kbs):
@@ -223,52 +367,34 @@ class Dialogue(object):
             for i in xrange(2):
                 self.token_turns[i].append([utterances[i]])
 
-    def convert_to_int(self):
-        if self.is_int:
-            return
-        for i, turns in enumerate(self.token_turns):
-            for turn in turns:
-                self.turns[i].append([self.textint_map.text_to_int(utterance)
-                    for utterance in turn])
-        # Target tokens
-        stage = 'target'
-        for turn in self.token_turns[self.DEC]:
-            self.turns[self.TARGET].append([self.textint_map.text_to_int(utterance)
-                for utterance in turn])
-        self.is_int = True
-
-    def flatten_turns(self):
+    def compact(self, token_table):
         '''
-        Flatten turns to a list of tokens with </s> between utterances and </t> at the end.
+        Store token_turns as TurnArrays of ids in token_table (shared by dialogues).
         '''
-        if self.flattened:
-            return
-
-        for i, turns in enumerate(self.turns):
-            for j, turn in enumerate(turns):
+        self.token_table = token_table
+        token_table.add_word(markers.EOS)
+        for turns in self.token_turns:
+            for turn in turns:
                 for utterance in turn:
-                    utterance.append(int_markers.EOS)
-                self.turns[i][j] = [x for x in chain.from_iterable(turn)]
-
-        if hasattr(self, 'token_turns'):
-            for i, turns in enumerate(self.token_turns):
-                for j, turn in enumerate(turns):
-                    for utterance in turn:
-                        utterance.append(markers.EOS)
-                    self.token_turns[i][j] = [x for x in chain.from_iterable(turn)]
+                    token_table.add_words(utterance)
+        eos = token_table.to_ind(markers.EOS)
+        self.token_turns = tuple([TurnArray.from_turns([[token_table.to_inds(utterance) for utterance in turn] for turn in turns], eos)
+            for turns in self.token_turns])
 
-        self.flattened = True
+    def convert_to_int(self):
+        if self.is_int:
+            return
+        int_ids = self.token_table.get_int_ids(self.textint_map)
+        encoder_turns, decoder_turns = [turns.map(int_ids) for turns in self.token_turns]
+        # Target tokens are the same integers as decoder inputs until entities are processed
+        self.turns = (encoder_turns, decoder_turns, decoder_turns)
+        self.is_int = True
 
-    def pad_turns(self, num_turns):
+    def get_tokens(self, stage, j):
         '''
-        Pad turns to length num_turns.
+        List of tokens in turn j of token_turns[stage].
         '''
-        turns, agents = self.turns, self.agents
-        assert len(turns[0]) == len(turns[1]) and len(turns[0]) == len(turns[2])
-        for i in xrange(len(turns[0]), num_turns):
-            agents.append(1 - agents[-1])
-            for j in xrange(len(turns)):
-                turns[j].append([])
+        return self.token_table.get_words()[self.token_turns[stage][j]].tolist()
 
 class DialogueBatch(object):
     use_kb = False
@@ -279,34 +405,30 @@ class DialogueBatch(object):
 
     def _normalize_dialogue(self):
         '''
-        All dialogues in a batch should have the same number of turns.
+        All dialogues in a batch should have the same number of turns: shorter dialogues
+        are padded with empty turns (see TurnArray.get_turn).
         '''
-        max_num_turns = max([len(d.turns[0]) for d in self.dialogues])
-        for dialogue in self.dialogues:
-            dialogue.flatten_turns()
-            dialogue.pad_turns(max_num_turns)
-        self.num_turns = len(self.dialogues[0].turns[0])
+        self.num_turns = max([len(d.turns[Dialogue.ENC]) for d in self.dialogues])
 
     def _normalize_turn(self, turn_batch):
         '''
         All turns at the same time step should have the same number of tokens.
         '''
-        max_num_tokens = max([len(t) for t in turn_batch])
+        lengths = np.array([len(t) for t in turn_batch], dtype=np.int32)
         batch_size = len(turn_batch)
-        T = np.full([batch_size, max_num_tokens+1], int_markers.PAD, dtype=np.int32)
+        T = np.full([batch_size, lengths.max()+1], int_markers.PAD, dtype=np.int32)
         for i, turn in enumerate(turn_batch):
-            T[i, 1:len(turn)+1] = turn
-            # Insert <go> at the beginning at each turn because for decoding we want to
-            # start from <go> to generate, except for padded turns
-            if T[i][1] != int_markers.PAD:
-                T[i][0] = int_markers.GO
+            T[i, 1:lengths[i]+1] = turn
+        # Insert <go> at the beginning at each turn because for decoding we want to
+        # start from <go> to generate, except for padded turns
+        T[lengths > 0, 0] = int_markers.GO
         return T
 
     def _create_turn_batches(self):
         turn_batches = []
         for i in xrange(Dialogue.num_stages):
             turn_batches.append([self._normalize_turn(
-                [dialogue.turns[i][j] for dialogue in self.dialogues])
+                [dialogue.turns[i].get_turn(j) for dialogue in self.dialogues])
                 for j in xrange(self.num_turns)])
         return turn_batches
 
@@ -329,12 +451,12 @@ class DialogueBatch(object):
         The last token input to decoder should not be </s> otherwise the model will learn
         </s> <pad> (deterministically).
         '''
-        nrows, ncols = array.shape
-        for i in xrange(nrows):
-            for j in xrange(ncols-1, -1, -1):
-                if array[i][j] == value:
-                    array[i][j] = int_markers.PAD
-                    break
+        ncols = array.shape[1]
+        mask = (array == value)
+        rows = np.nonzero(mask.any(axis=1))[0]
+        # Index of the last occurence is the first one in the reversed row
+        cols = ncols - 1 - np.argmax(mask[rows, ::-1], axis=1)
+        array[rows, cols] = int_markers.PAD
         return array
 
     def _create_one_batch(self, encode_turn, decode_turn, target_turn, encode_tokens, decode_tokens):
@@ -385,10 +507,8 @@ class DialogueBatch(object):
         return inds
 
     def _get_token_turns(self, i, stage):
-        if not hasattr(self.dialogues[0], 'token_turns'):
-            return None
-        # Return None for padded turns
-        return [dialogue.token_turns[stage][i] if i < len(dialogue.token_turns[stage]) else ''
+        # Return '' for padded turns
+        return [dialogue.get_tokens(stage, i) if i < len(dialogue.token_turns[stage]) else ''
                 for dialogue in self.dialogues]
 
     def create_batches(self):
@@ -424,10 +544,12 @@ class Preprocessor(object):
     Preprocess raw utterances: tokenize, entity linking.
     Convert an Example into a Dialogue data structure used by DataGenerator.
     '''
-    def __init__(self, schema, lexicon, entity_encoding_form, entity_decoding_form, entity_target_form):
+    def __init__(self, schema, lexicon, entity_encoding_form, entity_decoding_form, entity_target_form, num_workers=1):
         self.attributes = schema.attributes
         self.attribute_types = schema.get_attributes()
         self.lexicon = lexicon
+        # Number of processes used to link entities in preprocess
+        self.num_workers = num_workers
         self.entity_forms = {'encoding': entity_encoding_form,
                 'decoding': entity_decoding_form,
                 'target': entity_target_form}
@@ -455,16 +577,18 @@ class Preprocessor(object):
         else:
             return [self.get_entity_form(x, self.entity_forms[stage]) if is_entity(x) else x for x in utterance]
 
-    def _process_example(self, ex):
+    def _process_example(self, ex, linked_events=None):
         '''
         Convert example to turn-based dialogue.
+        linked_events: linked tokens of each event from link_examples; messages are linked here if None.
         '''
         kbs = ex.scenario.kbs
         dialogue = Dialogue(kbs, ex.uuid)
 
         mentioned_entities = set()
-        for e in ex.events:
-            utterances = self.process_event(e, kbs[e.agent], mentioned_entities)
+        for i, e in enumerate(ex.events):
+            entity_tokens = linked_events[i] if linked_events is not None else None
+            utterances = self.process_event(e, kbs[e.agent], mentioned_entities, entity_tokens=entity_tokens)
             if utterances:
                 dialogue.add_utterance(e.agent, utterances)
                 for token in utterances[0]:
@@ -497,13 +621,33 @@ class Preprocessor(object):
         assert item_id is not None
         return item_id
 
-    def process_event(self, e, kb, mentioned_entities=None, known_kb=True):
+    def link_examples(self, examples, select_mentions=True):
+        '''
+        Link entities in messages of all examples with self.num_workers processes.
+        Return linked tokens of each event of each example (None for non-message events),
+        to be passed to process_event.
+        select_mentions: whether entities of a selected item count as mentioned (as in _process_example).
+        '''
+        messages = tokenize_batch([e.data for ex in examples for e in ex.events if e.action == 'message'])
+        messages.reverse()
+        utterances, kbs, mentioned_entities = [], [], []
+        for ex in examples:
+            utterances.append([messages.pop() if e.action == 'message' else None for e in ex.events])
+            kbs.append([ex.scenario.kbs[e.agent] for e in ex.events])
+            if select_mentions:
+                mentioned_entities.append([[x[1][0] for x in self.item_to_entities(e.data, ex.scenario.kbs[e.agent].attributes)]
+                    if e.action == 'select' else None for e in ex.events])
+        return self.lexicon.link_entities_batch(utterances, kbs, mentioned_entities if select_mentions else None, num_workers=self.num_workers)
+
+    def process_event(self, e, kb, mentioned_entities=None, known_kb=True, entity_tokens=None):
         '''
         Convert event to two lists of tokens and entities for encoding and decoding.
+        entity_tokens: output of link_entity for a message that is already linked (see link_examples).
         '''
         if e.action == 'message':
             # Lower, tokenize, link entity
-            entity_tokens = self.lexicon.link_entity(tokenize(e.data), kb=kb, mentioned_entities=mentioned_entities, known_kb=known_kb)
+            if entity_tokens is None:
+                entity_tokens = self.lexicon.link_entity(tokenize(e.data), kb=kb, mentioned_entities=mentioned_entities, known_kb=known_kb)
             #print e.data
             #print entity_tokens
             entity_tokens = [normalize_number(x) if not is_entity(x) else x for x in entity_tokens]
@@ -521,21 +665,34 @@ class Preprocessor(object):
         else:
             raise ValueError('Unknown event action.')
 
+    def fingerprint(self):
+        '''
+        Hash of everything the output of preprocess depends on besides the examples.
+        None if it cannot be determined, e.g. for a learned lexicon.
+        NOTE: entity forms are applied when batching, not in preprocess.
+        '''
+        if self.lexicon is None or self.lexicon.learned_lex or not hasattr(self.lexicon, 'fingerprint'):
+            return None
+        h = hashlib.sha1()
+        h.update('preprocess-%d' % PREPROCESS_VERSION)
+        h.update(self.lexicon.fingerprint())
+        h.update(json.dumps(self.attribute_types, sort_keys=True))
+        return h.hexdigest()
+
     @classmethod
     def count_words(cls, examples):
         counts = defaultdict(int)
-        for ex in examples:
-            for event in ex.events:
-                if event.action == 'message':
-                    tokens = tokenize(event.data)
-                    for token in tokens:
-                        counts[token] += 1
+        for tokens in tokenize_batch([event.data for ex in examples for event in ex.events if event.action == 'message']):
+            for token in tokens:
+                counts[token] += 1
         return counts
 
     def preprocess(self, examples):
         dialogues = []
-        for ex in examples:
-            d = self._process_example(ex)
+        token_table = TokenTable()
+        linked_examples = self.link_examples(examples)
+        for ex, linked_events in izip(examples, linked_examples):
+            d = self._process_example(ex, linked_events)
             # Skip incomplete chats
             if len(d.agents) < 2 or ex.outcome['reward'] == 0:
                 continue
@@ -543,27 +700,29 @@ class Preprocessor(object):
                 for event in ex.events:
                     print event.to_dict()
             else:
+                d.compact(token_table)
                 dialogues.append(d)
         return dialogues
 
-class DataGenerator(object):
-    def __init__(self, train_examples, dev_examples, test_examples, preprocessor, schema, num_items, mappings=None, use_kb=False, copy=False):
-        examples = {'train': train_examples or [], 'dev': dev_examples or [], 'test': test_examples or []}
-        self.num_examples = {k: len(v) if v else 0 for k, v in examples.iteritems()}
+class BaseDataGenerator(object):
+    '''
+    Generate batches of a split in a (shuffled) order for every epoch. Subclasses
+    provide the dialogue batches: DataGenerator batches preprocessed examples and
+    PreparedDataGenerator reads batches written by DataGenerator.write_prepared_data.
+    '''
+    def _setup(self, preprocessor, mappings, use_kb, copy):
+        '''
+        Set the mappings and how dialogues are converted and batched.
+        '''
         self.use_kb = use_kb  # Whether to generate graph
         self.copy = copy
-
         DialogueBatch.use_kb = use_kb
         DialogueBatch.copy = copy
 
-        self.dialogues = {k: preprocessor.preprocess(v)  for k, v in examples.iteritems()}
-
-        for fold, dialogues in self.dialogues.iteritems():
-            print '%s: %d dialogues out of %d examples' % (fold, len(dialogues), self.num_examples[fold])
-
-        if not mappings:
-            mappings = create_mappings(self.dialogues['train'], schema, num_items, preprocessor.entity_forms.values())
         self.mappings = mappings
+        # Mappings are fixed from now on
+        for m in mappings.itervalues():
+            m.freeze()
 
         self.textint_map = TextIntMap(mappings['vocab'], mappings['entity'], preprocessor)
         Dialogue.textint_map = self.textint_map
@@ -572,6 +731,158 @@ class DataGenerator(object):
         global int_markers
         int_markers = SpecialSymbols(*[mappings['vocab'].to_ind(m) for m in markers])
 
+    @classmethod
+    def mappings_fingerprint(cls, mappings):
+        h = hashlib.sha1()
+        for name in sorted(mappings.keys()):
+            m = mappings[name]
+            h.update(name)
+            h.update(repr([m.to_word(i + m.offset) for i in xrange(m.size)]))
+        return h.hexdigest()
+
+    def padding_ratio(self, name):
+        '''
+        Fraction of encoder inputs and targets that are <pad> in the batches of name generated
+        in the current (or last) epoch.
+        '''
+        num_pad_tokens, num_tokens = self.padding.get(name, (0, 0))
+        return num_pad_tokens / float(num_tokens) if num_tokens else 0.
+
+    @classmethod
+    def count_padding(cls, dialogue_batch):
+        '''
+        Return the number of <pad> and of all tokens in the encoder inputs and targets.
+        '''
+        num_pad_tokens, num_tokens = 0, 0
+        for batch in dialogue_batch['batch_seq']:
+            for name in ('encoder_inputs', 'targets'):
+                num_pad_tokens += np.count_nonzero(batch[name] == int_markers.PAD)
+                num_tokens += batch[name].size
+        return num_pad_tokens, num_tokens
+
+    def reset_graph(self, dialogue_batches):
+        if not self.use_kb:
+            return
+        for dialogue_batch in dialogue_batches:
+            for graph in dialogue_batch['graph'].graphs:
+                graph.reset()
+
+    def get_dialogue_batches(self, name, batch_size):
+        '''
+        Return all batches of split name.
+        '''
+        raise NotImplementedError
+
+    def generator(self, name, batch_size, shuffle=True):
+        for x in self._generate(name, self.get_dialogue_batches(name, batch_size), shuffle):
+            yield x
+
+    def _generate(self, name, dialogue_batches, shuffle):
+        '''
+        Yield the number of batches, then batches in a (shuffled) order for every epoch.
+        '''
+        yield len(dialogue_batches)
+        inds = range(len(dialogue_batches))
+        while True:
+            if shuffle:
+                random.shuffle(inds)
+            num_pad_tokens, num_tokens = 0, 0
+            for ind in inds:
+                dialogue_batch = dialogue_batches[ind]
+                # Counted before yielding so that the padding of an epoch is complete when its last batch is consumed
+                batch_pad_tokens, batch_tokens = self.count_padding(dialogue_batch)
+                num_pad_tokens += batch_pad_tokens
+                num_tokens += batch_tokens
+                self.padding[name] = (num_pad_tokens, num_tokens)
+                yield dialogue_batch
+            # We want graphs clean of dialgue history for the new epoch
+            self.reset_graph(dialogue_batches)
+
+    # Arrays of each batch in the sequence of a dialogue batch
+    seq_arrays = ('encoder_inputs', 'encoder_inputs_last_inds', 'decoder_inputs', 'decoder_inputs_last_inds',
+            'targets', 'encoder_entities', 'decoder_entities')
+
+class DataGenerator(BaseDataGenerator):
+    # Number of batches of dialogues (by number of turns) to choose the dialogues of a bucketed batch from
+    bucket_window = 4
+
+    def __init__(self, train_examples, dev_examples, test_examples, preprocessor, schema, num_items, mappings=None, use_kb=False, copy=False, cache=None, bucket=False):
+        examples = {'train': train_examples or [], 'dev': dev_examples or [], 'test': test_examples or []}
+        self.num_examples = {k: len(v) if v else 0 for k, v in examples.iteritems()}
+        # Directory of preprocessed dialogues
+        self.cache = cache
+        # Whether to batch dialogues by their padded shape (see group_dialogues)
+        self.bucket = bucket
+        # {name: (number of <pad>, number of tokens)} of batches from the generator in an epoch
+        self.padding = {}
+
+        self.dialogues = {}
+        cache_keys = {}
+        for k, v in examples.iteritems():
+            self.dialogues[k], cache_keys[k] = self.preprocess(preprocessor, v)
+
+        for fold, dialogues in self.dialogues.iteritems():
+            print '%s: %d dialogues out of %d examples' % (fold, len(dialogues), self.num_examples[fold])
+
+        if not mappings:
+            mappings = create_mappings(self.dialogues['train'], schema, num_items, preprocessor.entity_forms.values())
+        self._setup(preprocessor, mappings, use_kb, copy)
+
+        for k, dialogues in self.dialogues.iteritems():
+            if cache_keys[k] is not None:
+                self.convert_to_int_cached(dialogues, cache_keys[k])
+
+    @classmethod
+    def examples_fingerprint(cls, examples):
+        h = hashlib.sha1()
+        for ex in examples:
+            h.update(json.dumps(ex.to_dict(), sort_keys=True))
+        return h.hexdigest()
+
+    def preprocess(self, preprocessor, examples):
+        '''
+        Preprocess examples, or load the dialogues from self.cache if they have been preprocessed
+        with the same preprocessor before.
+        Return dialogues and their cache key (None if not cached).
+        '''
+        fingerprint = preprocessor.fingerprint()
+        if self.cache is None or not examples or fingerprint is None:
+            return preprocessor.preprocess(examples), None
+        key = hashlib.sha1(fingerprint + self.examples_fingerprint(examples)).hexdigest()
+        path = os.path.join(self.cache, 'dialogues-%s.pkl' % key)
+        if os.path.exists(path):
+            start = time.time()
+            dialogues = read_pickle(path)
+            print 'Loaded %d preprocessed dialogues from %s [%.2fs]' % (len(dialogues), path, time.time() - start)
+        else:
+            dialogues = preprocessor.preprocess(examples)
+            self._write_cache(dialogues, path)
+        return dialogues, key
+
+    def convert_to_int_cached(self, dialogues, key):
+        '''
+        Convert dialogues to integers, or load the integer turns from self.cache if they have been
+        converted with the same mappings before.
+        '''
+        key = hashlib.sha1(key + self.mappings_fingerprint(self.mappings)).hexdigest()
+        path = os.path.join(self.cache, 'turns-%s.pkl' % key)
+        if os.path.exists(path):
+            for dialogue, turns in izip(dialogues, read_pickle(path)):
+                dialogue.turns = turns
+                dialogue.is_int = True
+        else:
+            for dialogue in dialogues:
+                dialogue.convert_to_int()
+            self._write_cache([dialogue.turns for dialogue in dialogues], path)
+
+    def _write_cache(self, obj, path):
+        if not os.path.isdir(self.cache):
+            os.makedirs(self.cache)
+        # Write to a temporary file first so that concurrent runs never read a partial file
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        write_pickle(obj, tmp_path, protocol=2)
+        os.rename(tmp_path, path)
+
     def convert_to_int(self):
         '''
         Convert tokens to integers.
@@ -580,17 +891,46 @@ class DataGenerator(object):
             for dialogue in dialogues:
                 dialogue.convert_to_int()
 
+    def group_dialogues(self, dialogues, batch_size):
+        '''
+        Split dialogues into lists of at most batch_size dialogues to batch, ordered by the
+        number of turns. With self.bucket, each batch starts from the first remaining dialogue
+        and adds one at a time the dialogue among the next bucket_window * batch_size ones
+        that adds the least <pad> to the padded shape (number of tokens at each turn).
+        '''
+        num_turns = np.array([len(d.turns[Dialogue.ENC]) for d in dialogues], dtype=np.int32)
+        order = np.argsort(num_turns, kind='mergesort')
+        if not self.bucket or not dialogues:
+            return [[dialogues[i] for i in order[start:start+batch_size]] for start in xrange(0, len(dialogues), batch_size)]
+        # Row width of each turn including <go> (0 for padded turns), see DialogueBatch._normalize_turn
+        widths = np.zeros([len(dialogues), num_turns.max()], dtype=np.int64)
+        for i, dialogue in enumerate(dialogues):
+            widths[i, :num_turns[i]] = dialogue.turns[Dialogue.ENC].turn_lengths() + 1
+        taken = np.zeros(len(dialogues), dtype=np.bool_)
+        groups = []
+        for first in order:
+            if taken[first]:
+                continue
+            taken[first] = True
+            group, shape = [first], widths[first]
+            candidates = order[~taken[order]][:self.bucket_window * batch_size]
+            while len(group) < batch_size and candidates.size > 0:
+                shapes = np.maximum(shape, widths[candidates])
+                # <pad> in the row of the candidate and in the rows already in the batch
+                cost = shapes.sum(axis=1) + len(group) * (shapes - shape).sum(axis=1)
+                best = np.argmin(cost)
+                group.append(candidates[best])
+                shape = shapes[best]
+                candidates = np.delete(candidates, best)
+            taken[group] = True
+            groups.append([dialogues[i] for i in group])
+        return groups
+
     def create_dialogue_batches(self, dialogues, batch_size):
-        dialogues.sort(key=lambda d: len(d.turns[0]))
-        N = len(dialogues)
         dialogue_batches = []
-        start = 0
-        while start < N:
-            # NOTE: last batch may have a smaller size if we don't have enough examples
-            end = min(start + batch_size, N)
-            dialogue_batch = dialogues[start:end]
-            dialogue_batches.extend(DialogueBatch(dialogue_batch).create_batches())
-            start = end
+        # NOTE: last batch may have a smaller size if we don't have enough examples
+        for group in self.group_dialogues(dialogues, batch_size):
+            dialogue_batches.extend(DialogueBatch(group).create_batches())
         return dialogue_batches
 
     def create_graph(self, dialogues):
@@ -599,26 +939,154 @@ class DataGenerator(object):
         for dialogue in dialogues:
             dialogue.create_graph()
 
-    def reset_graph(self, dialogue_batches):
-        if not self.use_kb:
-            return
-        for dialogue_batch in dialogue_batches:
-            for graph in dialogue_batch['graph'].graphs:
-                graph.reset()
-
-    def generator(self, name, batch_size, shuffle=True):
+    def get_dialogue_batches(self, name, batch_size):
         dialogues = self.dialogues[name]
         for dialogue in dialogues:
             dialogue.convert_to_int()
         # NOTE: we assume that GraphMetadata has been constructed before DataGenerator is called
         self.create_graph(dialogues)
-        dialogue_batches = self.create_dialogue_batches(dialogues, batch_size)
-        yield len(dialogue_batches)
-        inds = range(len(dialogue_batches))
-        while True:
-            if shuffle:
-                random.shuffle(inds)
-            for ind in inds:
-                yield dialogue_batches[ind]
-            # We want graphs clean of dialgue history for the new epoch
-            self.reset_graph(dialogue_batches)
+        return self.create_dialogue_batches(dialogues, batch_size)
+
+    @classmethod
+    def _tokens_to_arrays(cls, tokens, token_table):
+        '''
+        Token ids of all rows concatenated and the length of each row (-1 for padded turns).
+        '''
+        lengths = np.array([-1 if isinstance(row, basestring) else len(row) for row in tokens], dtype=np.int32)
+        token_table.add_words([token for row in tokens if not isinstance(row, basestring) for token in row])
+        ids = token_table.to_inds([token for row in tokens if not isinstance(row, basestring) for token in row])
+        return ids, lengths
+
+    def _batch_to_arrays(self, dialogue_batch, prefix, arrays, token_table, kb_ids):
+        '''
+        Add arrays of dialogue_batch to arrays with keys starting with prefix.
+        kb_ids: {id(kb): index of kb}, updated with new KBs in dialogue_batch.
+        '''
+        for kb in dialogue_batch['kb']:
+            if id(kb) not in kb_ids:
+                kb_ids[id(kb)] = (len(kb_ids), kb)
+        arrays[prefix + 'agent'] = np.array(dialogue_batch['agent'], dtype=np.int32)
+        arrays[prefix + 'kb'] = np.array([kb_ids[id(kb)][0] for kb in dialogue_batch['kb']], dtype=np.int32)
+        arrays[prefix + 'matched_items'] = np.array(dialogue_batch['matched_items'], dtype=np.int32)
+        arrays[prefix + 'seq_len'] = np.array(len(dialogue_batch['batch_seq']), dtype=np.int32)
+        for t, batch in enumerate(dialogue_batch['batch_seq']):
+            batch_prefix = '%s%d.' % (prefix, t)
+            for name in self.seq_arrays:
+                arrays[batch_prefix + name] = batch[name]
+            for name in ('encoder_tokens', 'decoder_tokens'):
+                if batch[name] is not None:
+                    arrays[batch_prefix + name], arrays[batch_prefix + name + '_lengths'] = self._tokens_to_arrays(batch[name], token_table)
+
+    def write_prepared_data(self, path, batch_size, shard_size=100):
+        '''
+        Batch dialogues of all splits and write them to path for PreparedDataGenerator:
+        - <split>-<shard>.npz: integer arrays of shard_size batches each;
+        - tables.pkl: KBs and tokens (encoder/decoder_tokens) referenced by ids in the shards;
+        - vocab.pkl: the mappings;
+        - index.json: shards of each split and settings the batches depend on.
+        '''
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        token_table = TokenTable()
+        kb_ids = {}
+        index = {'version': PREPARED_DATA_VERSION,
+                 'batch_size': batch_size,
+                 'copy': self.copy,
+                 'entity_forms': self.textint_map.entity_forms,
+                 'mappings': self.mappings_fingerprint(self.mappings),
+                 'splits': {},
+                }
+        for name, dialogues in self.dialogues.iteritems():
+            if not dialogues:
+                continue
+            for dialogue in dialogues:
+                dialogue.convert_to_int()
+            dialogue_batches = self.create_dialogue_batches(dialogues, batch_size)
+            shards = []
+            for start in xrange(0, len(dialogue_batches), shard_size):
+                shard_batches = dialogue_batches[start:start+shard_size]
+                arrays = {}
+                for i, dialogue_batch in enumerate(shard_batches):
+                    self._batch_to_arrays(dialogue_batch, '%d.' % i, arrays, token_table, kb_ids)
+                shard_path = '%s-%05d.npz' % (name, len(shards))
+                np.savez(os.path.join(path, shard_path), **arrays)
+                shards.append({'path': shard_path, 'num_batches': len(shard_batches)})
+            index['splits'][name] = {'num_examples': self.num_examples[name],
+                                     'shards': shards,
+                                    }
+            print '%s: %d batches in %d shards' % (name, len(dialogue_batches), len(shards))
+        kbs = [kb for i, kb in sorted(kb_ids.values(), key=lambda x: x[0])]
+        write_pickle({'kbs': kbs, 'tokens': token_table.get_words().tolist()}, os.path.join(path, 'tables.pkl'), protocol=2)
+        write_pickle(self.mappings, os.path.join(path, 'vocab.pkl'))
+        # Written last: a directory with an index is complete
+        write_json(index, os.path.join(path, 'index.json'))
+
+class PreparedDataGenerator(BaseDataGenerator):
+    '''
+    Generate batches written by DataGenerator.write_prepared_data instead of preprocessing
+    and batching examples, so that training jobs can share one prepared dataset.
+    '''
+    def __init__(self, path, preprocessor, mappings=None, use_kb=False, copy=False):
+        self.path = path
+        self.index = read_json(os.path.join(path, 'index.json'))
+        assert self.index['version'] == PREPARED_DATA_VERSION, 'Prepared data in %s is outdated' % path
+        assert self.index['copy'] == copy and self.index['entity_forms'] == preprocessor.entity_forms, \
+                'Prepared data in %s is batched for a different model (entity forms or copy)' % path
+        if mappings:
+            assert self.mappings_fingerprint(mappings) == self.index['mappings'], \
+                    'Prepared data in %s is encoded with different mappings' % path
+        else:
+            mappings = read_pickle(os.path.join(path, 'vocab.pkl'))
+        self._setup(preprocessor, mappings, use_kb, copy)
+        splits = self.index['splits']
+        self.num_examples = {name: split['num_examples'] for name, split in splits.iteritems()}
+        self.padding = {}
+
+        tables = read_pickle(os.path.join(path, 'tables.pkl'))
+        self.kbs = tables['kbs']
+        self.tokens = np.empty(len(tables['tokens']), dtype=object)
+        for i, token in enumerate(tables['tokens']):
+            self.tokens[i] = token
+
+    def _arrays_to_tokens(self, ids, lengths):
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.maximum(lengths, 0))
+        return ['' if length < 0 else self.tokens[ids[offsets[i]:offsets[i+1]]].tolist()
+                for i, length in enumerate(lengths)]
+
+    def _arrays_to_batch(self, arrays, prefix):
+        '''
+        Inverse of _batch_to_arrays.
+        '''
+        batch_seq = []
+        for t in xrange(int(arrays[prefix + 'seq_len'])):
+            batch_prefix = '%s%d.' % (prefix, t)
+            batch = {name: arrays[batch_prefix + name] for name in self.seq_arrays}
+            for name in ('encoder_tokens', 'decoder_tokens'):
+                if batch_prefix + name in arrays:
+                    batch[name] = self._arrays_to_tokens(arrays[batch_prefix + name], arrays[batch_prefix + name + '_lengths'])
+                else:
+                    batch[name] = None
+            batch_seq.append(batch)
+        kbs = [self.kbs[i] for i in arrays[prefix + 'kb']]
+        dialogue_batch = {'agent': arrays[prefix + 'agent'].tolist(),
+                          'kb': kbs,
+                          'matched_items': arrays[prefix + 'matched_items'],
+                          'batch_seq': batch_seq,
+                         }
+        if self.use_kb:
+            # NOTE: we assume that GraphMetadata has been constructed before DataGenerator is called
+            dialogue_batch['graph'] = GraphBatch([Graph(kb) for kb in kbs])
+        return dialogue_batch
+
+    def read_batches(self, name):
+        dialogue_batches = []
+        for shard in self.index['splits'][name]['shards']:
+            with np.load(os.path.join(self.path, shard['path'])) as data:
+                arrays = {key: data[key] for key in data.files}
+            dialogue_batches.extend([self._arrays_to_batch(arrays, '%d.' % i) for i in xrange(shard['num_batches'])])
+        return dialogue_batches
+
+    def get_dialogue_batches(self, name, batch_size):
+        assert batch_size == self.index['batch_size'], 'Data in %s is prepared with batch size %d' % (self.path, self.index['batch_size'])
+        return self.read_batches(name)
@@ -1,5 +1,6 @@
 import pytest
-from model.graph_embedder import GraphEmbedder, GraphEmbedderConfig
+from model.graph_embedder import GraphEmbedder
+from model.graph_embedder_config import GraphEmbedderConfig
 from model.graph import Graph, GraphMetadata, GraphBatch
 from basic.schema import Schema
 from basic.lexicon import Lexicon
@@ -10,13 +11,9 @@ max_degree = 5
 
 @pytest.fixture(scope='session')
 def config(metadata):
-    num_edge_labels = metadata.relation_map.size
     node_embed_size = 4
     edge_embed_size = 4
-    utterance_size = metadata.utterance_size
-    feat_size = metadata.feat_size
-    batch_size = 2
-    return GraphEmbedderConfig(num_edge_labels, node_embed_size, edge_embed_size, utterance_size, feat_size, batch_size=batch_size, max_degree=max_degree)
+    return GraphEmbedderConfig(node_embed_size, edge_embed_size, metadata)
 
 @pytest.fixture(scope='session')
 def graph_embedder(config):
@@ -47,14 +44,14 @@ def graph(metadata, schema):
     Graph.metadata = metadata
     items = [{'Name': 'Alice', 'Company': 'Microsoft', 'Hobby': 'hiking'},\
              {'Name': 'Bob', 'Company': 'Apple', 'Hobby': 'hiking'}]
-    kb = KB.from_dict(schema, items)
+    kb = KB.from_dict(schema.attributes, items)
     return Graph(kb)
 
 @pytest.fixture
 def graph2(schema):
     items = [{'Name': 'Alice', 'Company': 'Microsoft', 'Hobby': 'reading'},\
              {'Name': 'Bob', 'Company': 'Apple', 'Hobby': 'hiking'}]
-    kb = KB.from_dict(schema, items)
+    kb = KB.from_dict(schema.attributes, items)
     return Graph(kb)
 
 @pytest.fixture
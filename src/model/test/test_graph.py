@@ -81,15 +81,62 @@ class TestGraph(object):
         assert graph.nodes.size == graph.feats.shape[0]
         assert_array_equal(graph.get_entity_list(2), [[alice], [alice, google]])
 
-    def test_update_utterances(self, graph_batch):
-        utterances = np.ones([2, 3, Graph.metadata.utterance_size])
-        max_num_nodes = 5
-        utterances = graph_batch.update_utterances(utterances, max_num_nodes)
+    def test_csr_node_paths(self, graph):
+        graph.add_entity_nodes([('facebook', 'company')])
+        pad = Graph.metadata.PAD_PATH_ID
+        # Per node lists found by scanning all paths, and the padded path for nodes without any
+        expected = []
+        for node_id in graph.node_ids:
+            paths = [path_id for path_id, path in enumerate(graph.paths) if path_id != pad and path[0] == node_id]
+            expected.append(paths or [pad])
+        assert graph.path_ptr[0] == 1 and graph.path_ptr[-1] == graph.paths.shape[0]
+        assert len(graph.path_ptr) == graph.nodes.size + 1
+        assert len(graph.node_paths) == len(expected)
+        for node_paths, expected_node_paths in zip(graph.node_paths, expected):
+            assert_array_equal(node_paths, expected_node_paths)
+
+    def test_batch_node_paths(self, graph_batch):
+        graph_batch.graphs[1].add_entity_nodes([('facebook', 'company')])
+        max_num_nodes = graph_batch._max_num_nodes()
+        max_num_paths_per_node = graph_batch._max_num_paths_per_node()
+        assert max_num_paths_per_node == max([len(p) for g in graph_batch.graphs for p in g.node_paths])
+        node_paths = graph_batch._batch_node_paths(max_num_nodes, max_num_paths_per_node)
+        assert node_paths.shape == (2, max_num_nodes, max_num_paths_per_node)
+        for graph, batch_node_paths in zip(graph_batch.graphs, node_paths):
+            for i, paths in enumerate(graph.node_paths):
+                assert_array_equal(batch_node_paths[i][:len(paths)], paths)
+                assert np.all(batch_node_paths[i][len(paths):] == Graph.metadata.PAD_PATH_ID)
+            assert np.all(batch_node_paths[len(graph.node_paths):] == Graph.metadata.PAD_PATH_ID)
 
-        x = np.zeros([Graph.metadata.max_num_entities+1, Graph.metadata.utterance_size])
-        x[:3, :] = 1
-        expected = np.tile(np.expand_dims(x, 0), [2, 1, 1])
-        assert_array_equal(utterances, expected)
+    def test_update_utterances(self, graph_batch):
+        utterance_size = Graph.metadata.utterance_size
+        utterances = np.ones([2, 5, utterance_size])
+        assert graph_batch._update_utterances(utterances, 5) is utterances
+        new_utterances = graph_batch._update_utterances(utterances, 9)
+        # Rows before the old padded utterance are kept; the rest start from zero
+        expected = np.zeros([2, 9, utterance_size])
+        expected[:, :4, :] = 1
+        assert_array_equal(new_utterances, expected)
+
+    def test_utterance_rows(self, graph_batch):
+        utterance_size = Graph.metadata.utterance_size
+        graph_data = graph_batch.get_graph_data(None, None, None, None)
+        max_num_nodes = graph_batch._max_num_nodes()
+        num_rows = graph_data['num_utterance_rows']
+        assert num_rows == max(max_num_nodes, Graph.metadata.max_num_entities) + 1
+        # Reserved rows are used before the matrices grow
+        graph_data = graph_batch.get_graph_data(None, None, None, None, max_num_nodes + 1)
+        assert graph_data['num_utterance_rows'] == max_num_nodes + 1
+        # Doubled when the nodes reach the padded utterance
+        graph_data = graph_batch.get_graph_data(None, None, None, None, max_num_nodes)
+        assert graph_data['num_utterance_rows'] == 2 * max_num_nodes
+        assert graph_batch.pad_utterance_id == 2 * max_num_nodes - 1
+        utterances, utterance_mask = graph_batch.get_utterances((np.ones([2, max_num_nodes, utterance_size]),) * 2, graph_data['num_utterance_rows'])
+        assert all([u.shape == (2, 2 * max_num_nodes, utterance_size) for u in utterances])
+        # Only rows of nodes are valid
+        assert utterance_mask.shape == (2, 2 * max_num_nodes)
+        for graph, row_mask in zip(graph_batch.graphs, utterance_mask):
+            assert row_mask[:len(graph.node_ids)].all() and not row_mask[len(graph.node_ids):].any()
 
     def test_batch_entity_lists(self, graph_batch):
         entity_lists = [[1,2,3], [4]]
@@ -127,6 +174,60 @@ class TestGraph(object):
         expected = ['work', ('alice', 'person'), ('hiking', 'hobby')]
         assert_equal(tokens, expected)
 
+    def test_entity_node_maps(self, graph_batch, metadata):
+        entity_map = metadata.entity_map
+        # A new entity in entity_map and one that is not (i.e. <unk>)
+        graph_batch.graphs[0].add_entity_nodes([('google', 'company'), ('unknown inc', 'company')])
+        assert entity_map.has(('google', 'company')) and not entity_map.has(('unknown inc', 'company'))
+
+        # Previous per-element lookups through the node and entity dicts
+        def entity_to_node_id(graph, entity_id):
+            try:
+                return graph.nodes.to_ind(entity_map.to_word(entity_id))
+            except KeyError:
+                return -1
+        def node_to_entity_id(graph, node_id):
+            try:
+                return entity_map.to_ind(graph.nodes.to_word(node_id))
+            except KeyError:
+                return -1
+
+        # All entity ids, non-entity words (-1) and ids beyond entity_map
+        entities = np.arange(-1, entity_map.size + 2, dtype=np.int32)
+        entities = np.tile(entities, (2, 1))
+        node_ids = graph_batch._entity_to_node_id(entities)
+        for i, graph in enumerate(graph_batch.graphs):
+            expected = [-1 if e == -1 else entity_to_node_id(graph, e) for e in entities[i]]
+            assert_array_equal(node_ids[i], expected)
+        assert node_ids[0][entity_map.unk_ind + 1] == -1
+        assert node_ids[0][entity_map.to_ind(('google', 'company')) + 1] == graph_batch.graphs[0].nodes.to_ind(('google', 'company'))
+        assert node_ids[1][entity_map.to_ind(('google', 'company')) + 1] == -1
+
+        # Node ids of all nodes, of padded nodes of the smaller graph and beyond max_num_nodes
+        vocab_size = 3
+        max_num_nodes = graph_batch._max_num_nodes()
+        preds = np.tile(np.arange(max_num_nodes + 2 + vocab_size, dtype=np.int32), (2, 1))
+        new_preds = graph_batch.copy_preds(preds, vocab_size)
+        assert graph_batch.graphs[1].nodes.size < max_num_nodes
+        for i, graph in enumerate(graph_batch.graphs):
+            # <unk> (0) for padded nodes
+            expected = [p if p < vocab_size else node_to_entity_id(graph, p - vocab_size) + vocab_size
+                        if node_to_entity_id(graph, p - vocab_size) >= 0 else 0 for p in preds[i]]
+            assert_array_equal(new_preds[i], expected)
+        assert new_preds[0][graph_batch.graphs[0].nodes.to_ind(('unknown inc', 'company')) + vocab_size] == entity_map.unk_ind + vocab_size
+        assert new_preds[1][graph_batch.graphs[1].nodes.size + vocab_size] == 0
+
+        # Targets of entities in the graph and back
+        targets = np.array([[0, entity_map.to_ind(('google', 'company')) + vocab_size, 2],
+                            [1, entity_map.to_ind(('reading', 'hobby')) + vocab_size, 0]])
+        new_targets = graph_batch.copy_targets(targets, vocab_size)
+        for i, graph in enumerate(graph_batch.graphs):
+            expected = [t if t < vocab_size else graph.nodes.to_ind(entity_map.to_word(t - vocab_size)) + vocab_size for t in targets[i]]
+            assert_array_equal(new_targets[i], expected)
+        assert_array_equal(graph_batch.copy_preds(new_targets, vocab_size), targets)
+        with pytest.raises(AssertionError):
+            graph_batch.copy_targets(targets[::-1], vocab_size)
+
     @pytest.mark.only
     def test_checklist(self, graph_batch, vocab, metadata):
         alice = metadata.entity_map.to_ind(('alice', 'person')) + vocab.size
@@ -2,7 +2,8 @@ import pytest
 import tensorflow as tf
 import numpy as np
 from numpy.testing import assert_array_equal
-from model.graph_embedder import GraphEmbedder, GraphEmbedderConfig
+from model.graph_embedder import GraphEmbedder
+from model.graph_embedder_config import GraphEmbedderConfig
 
 class TestGraphEmbedder(object):
     num_nodes = 5
@@ -68,6 +69,28 @@ class TestGraphEmbedder(object):
                                  [[0,0,0],[2,2,2],[0,0,0],[0,0,0]]])
         assert_array_equal(ans, expected_ans)
 
+    @pytest.mark.parametrize('msg_agg', ['sum', 'avg', 'max'])
+    def test_pass_message_segment(self, metadata, msg_agg):
+        config = GraphEmbedderConfig(4, 4, metadata, msg_agg=msg_agg, msg_passing='segment')
+        graph_embedder = GraphEmbedder(config, scope='SegmentGraphEmbedder_%s' % msg_agg)
+        pad = 0
+        num_paths, num_nodes = 4, 4
+        # Messages of both signs: padded neighbors (0) take part in the max of pass_message
+        path_embeds = tf.constant(np.random.RandomState(0).randn(2, num_paths, 3), dtype=tf.float32)
+        neighbors = tf.constant([[[1,2], [3,pad], [pad,pad], [pad,pad]],
+                                 [[1,pad], [2,3], [pad,pad], [pad,pad]]], dtype=tf.int32)
+        # The same edges flattened: path ids in (2 x num_paths) and node ids in (2 x num_nodes)
+        edge_paths = tf.constant([1, 2, 3, num_paths+1, num_paths+2, num_paths+3], dtype=tf.int32)
+        edge_nodes = tf.constant([0, 0, 1, num_nodes, num_nodes+1, num_nodes+1], dtype=tf.int32)
+        padded_embed = graph_embedder.pass_message(path_embeds, neighbors, pad)
+        segment_embed = graph_embedder.pass_message_segment(path_embeds, edge_paths, edge_nodes, num_nodes)
+
+        with tf.Session() as sess:
+            [ans, expected_ans] = sess.run([segment_embed, padded_embed])
+
+        assert ans.shape == expected_ans.shape
+        np.testing.assert_allclose(ans, expected_ans, atol=1e-6)
+
     def test_get_context(self, graph_embedder, capsys):
         config = graph_embedder.config
         node_ids = np.array([[0,1,2], [0,1,2]], dtype=np.int32)
@@ -0,0 +1,71 @@
+import pytest
+import time
+from itertools import count
+from model.learner import Prefetcher
+
+class TestPrefetcher(object):
+    def test_order(self):
+        prefetcher = Prefetcher(iter(xrange(20)), lambda x: x * 2, 3)
+        prefetcher.request(20)
+        assert [prefetcher.next() for _ in xrange(20)] == [x * 2 for x in xrange(20)]
+        # The end of the items is found when one more is requested
+        prefetcher.request(1)
+        with pytest.raises(StopIteration):
+            prefetcher.next()
+        prefetcher.close()
+        assert not prefetcher.thread.is_alive()
+
+    def test_request(self):
+        pulled = []
+        def items():
+            for i in count():
+                pulled.append(i)
+                yield i
+        prefetcher = Prefetcher(items(), lambda x: x, 10)
+        time.sleep(0.1)
+        assert pulled == []
+        prefetcher.request(3)
+        assert [prefetcher.next() for _ in xrange(3)] == [0, 1, 2]
+        time.sleep(0.1)
+        # Nothing is pulled beyond the requested items
+        assert pulled == [0, 1, 2]
+        prefetcher.close()
+
+    def test_exception(self):
+        def items():
+            yield 1
+            raise ValueError('producer')
+        prefetcher = Prefetcher(items(), lambda x: x, 2)
+        prefetcher.request(5)
+        assert prefetcher.next() == 1
+        with pytest.raises(ValueError) as excinfo:
+            prefetcher.next()
+        assert 'producer' in str(excinfo.value)
+        prefetcher.close()
+        assert not prefetcher.thread.is_alive()
+
+    def test_func_exception(self):
+        def func(x):
+            if x == 2:
+                raise KeyError(x)
+            return x
+        prefetcher = Prefetcher(iter(xrange(5)), func, 2)
+        prefetcher.request(5)
+        assert [prefetcher.next(), prefetcher.next()] == [0, 1]
+        with pytest.raises(KeyError):
+            prefetcher.next()
+
+    def test_close_early(self):
+        # Endless items with a full queue and pending requests
+        prefetcher = Prefetcher(count(), lambda x: x, 2)
+        prefetcher.request(100)
+        assert prefetcher.next() == 0
+        time.sleep(0.1)
+        assert prefetcher.queue.full()
+        prefetcher.close()
+        assert not prefetcher.thread.is_alive()
+
+        # Producer waiting for requests
+        prefetcher = Prefetcher(count(), lambda x: x, 2)
+        prefetcher.close()
+        assert not prefetcher.thread.is_alive()
@@ -1,11 +1,17 @@
 import pytest
+import cPickle as pickle
 from itertools import izip
-from model.preprocess import DialogueBatch, DataGenerator
+from model import preprocess
+from model.preprocess import DialogueBatch, DataGenerator, PreparedDataGenerator, Dialogue, TurnArray, TokenTable, TextIntMap, Preprocessor, SpecialSymbols, markers, build_schema_mappings
+from model.vocab import Vocabulary
 from basic.dataset import read_examples
+from basic.kb import KB
 from basic.schema import Schema
 from basic.util import read_json
 from basic.lexicon import Lexicon
-from basic.scenario_db import ScenarioDB
+from basic.scenario_db import ScenarioDB, Scenario
+from basic.dataset import Example
+from basic.event import Event
 from model.graph import GraphMetadata, Graph
 import numpy as np
 from numpy.testing import assert_array_equal
@@ -44,9 +50,8 @@ class TestPreprocess(object):
                 for utterance in turn:
                     print utterance
                 print 'Integers:'
-                for utterance in int_dialogue.turns[0][i]:
-                    print utterance
-                    print map(generator.vocab.to_word, utterance)
+                print int_dialogue.turns[0][i]
+                print map(generator.vocab.to_word, int_dialogue.turns[0][i])
 
     @pytest.fixture(scope='session')
     def dialogue_batch(self, generator):
@@ -60,7 +65,7 @@ class TestPreprocess(object):
 
     def test_normalize_dialogue(self, generator, dialogue_batch, capsys):
         dialogue_batch._normalize_dialogue()
-        assert len(dialogue_batch.dialogues[0].turns[0]) == len(dialogue_batch.dialogues[1].turns[0])
+        assert dialogue_batch.num_turns == max([len(d.turns[0]) for d in dialogue_batch.dialogues])
         with capsys.disabled():
             print '\n========== Example flattened turn =========='
             turn = dialogue_batch.dialogues[0].turns[0][0]
@@ -113,3 +118,274 @@ class TestPreprocess(object):
         inds = dialogue_batch._get_last_inds(inputs, pad)
         expected = np.array([2, 0])
         assert_array_equal(inds, expected)
+
+    def test_turn_array(self):
+        eos = 0
+        turns = TurnArray.from_turns([[[1, 2], [3]], [[4]]], eos)
+        assert len(turns) == 2
+        assert turns.data.dtype == np.int32
+        assert_array_equal(turns[0], [1, 2, eos, 3, eos])
+        assert_array_equal(turns[1], [4, eos])
+        # Padded turns beyond the end of the dialogue are empty
+        assert_array_equal(turns.get_turn(1), [4, eos])
+        assert turns.get_turn(2).size == 0
+        mapped = turns.map(np.array([10, 11, 12, 13, 14], dtype=np.int32))
+        assert_array_equal(mapped[0], [11, 12, 10, 13, 10])
+        assert_array_equal(mapped[1], [14, 10])
+
+    def test_token_table(self, schema):
+        token_table = TokenTable()
+        school = ('adelphi', ('adelphi university', 'school'))
+        token_table.add_words([markers.EOS, 'works', 'at', school])
+        eos = token_table.to_ind(markers.EOS)
+        utterances = [['works', 'at'], [school, 'works']]
+        turns = TurnArray.from_turns([[token_table.to_inds(u) for u in utterances]], eos)
+        assert token_table.get_words()[turns[0]].tolist() == ['works', 'at', markers.EOS, school, 'works', markers.EOS]
+
+        vocab = Vocabulary(unk=False)
+        vocab.add_words([markers.EOS, 'works', 'at'])
+        entity_map, _ = build_schema_mappings(schema, 2)
+        textint_map = TextIntMap(vocab, entity_map, Preprocessor(schema, None, 'canonical', 'canonical', 'graph'))
+        int_ids = token_table.get_int_ids(textint_map)
+        expected = [vocab.to_ind(markers.EOS), vocab.to_ind('works'), vocab.to_ind('at'), entity_map.to_ind(school[1]) + vocab.size]
+        assert_array_equal(int_ids, expected)
+        assert_array_equal(turns.map(int_ids)[0], [expected[i] for i in [1, 2, 0, 3, 1, 0]])
+
+        # Lookup arrays are rebuilt after unpickling
+        token_table = pickle.loads(pickle.dumps(token_table, protocol=2))
+        assert token_table.int_ids is None
+        assert token_table.get_words()[turns[0]].tolist() == ['works', 'at', markers.EOS, school, 'works', markers.EOS]
+
+    def test_padded_turns(self, schema, monkeypatch):
+        # Set by DataGenerator from the vocab
+        monkeypatch.setattr(preprocess, 'int_markers', SpecialSymbols(*range(len(markers))), raising=False)
+        eos, go, pad = preprocess.int_markers.EOS, preprocess.int_markers.GO, preprocess.int_markers.PAD
+        items = [{'Name': 'Alice', 'Company': 'Microsoft', 'Hobby': 'hiking'}]
+        kb = KB.from_dict(schema.attributes, items)
+        dialogues = []
+        # Dialogues with different numbers of turns and turn lengths
+        for turns in ([[[5, 6]], [[7], [8, 9]], [[5]]], [[[6, 7, 8]]]):
+            dialogue = Dialogue([kb, kb], None)
+            dialogue.turns = (TurnArray.from_turns(turns, eos),) * Dialogue.num_stages
+            dialogues.append(dialogue)
+        dialogue_batch = DialogueBatch(dialogues)
+        dialogue_batch._normalize_dialogue()
+        assert dialogue_batch.num_turns == 3
+
+        turn_batches = dialogue_batch._create_turn_batches()
+        for stage_turn_batches in turn_batches:
+            assert len(stage_turn_batches) == dialogue_batch.num_turns
+        expected = [np.array([[go, 5, 6, eos, pad],
+                              [go, 6, 7, 8, eos]]),
+                    np.array([[go, 7, eos, 8, 9, eos],
+                              [pad, pad, pad, pad, pad, pad]]),
+                    np.array([[go, 5, eos],
+                              [pad, pad, pad]])]
+        for turn_batch, expected_turn_batch in izip(turn_batches[Dialogue.ENC], expected):
+            assert_array_equal(turn_batch, expected_turn_batch)
+
+    def test_int_to_text(self, schema):
+        vocab = Vocabulary(unk=False)
+        vocab.add_words(['works', 'at'])
+        entity_map, _ = build_schema_mappings(schema, 2)
+        textint_map = TextIntMap(vocab, entity_map, Preprocessor(schema, None, 'canonical', 'type', 'graph'))
+        entity = ('adelphi university', 'school')
+        entity_id = entity_map.to_ind(entity) + vocab.size
+        assert textint_map.int_to_text([1, entity_id], 'target') == ['at', entity]
+        assert textint_map.int_to_text([], 'target') == []
+        for inds, stage in (([-1], 'target'), ([0, vocab.size + entity_map.size], 'target'), ([entity_id], 'encoding')):
+            with pytest.raises(KeyError):
+                textint_map.int_to_text(inds, stage)
+
+@pytest.fixture(scope='session')
+def friends_schema():
+    return Schema('data/friends-schema.json')
+
+@pytest.fixture(scope='session')
+def friends_lexicon(friends_schema):
+    return Lexicon(friends_schema, learned_lex=False, stop_words='data/common_words.txt')
+
+@pytest.fixture(scope='session')
+def friends_examples(friends_schema):
+    items = [{'Name': 'Alice', 'School': 'Adelphi University', 'Major': 'Accounting', 'Company': 'Microsoft',
+              'Hobby': 'Hiking', 'Time Preference': 'morning', 'Location Preference': 'indoors'},
+             {'Name': 'Bob', 'School': 'Boston University', 'Major': 'Biology', 'Company': 'Google',
+              'Hobby': 'Baseball', 'Time Preference': 'evening', 'Location Preference': 'outdoors'},
+             {'Name': 'Carol', 'School': 'Columbia University', 'Major': 'Chemistry', 'Company': 'Apple',
+              'Hobby': 'Cooking', 'Time Preference': 'morning', 'Location Preference': 'outdoors'}]
+    examples = []
+    for i, (matched, other) in enumerate([(0, 1), (1, 2), (2, 0)]):
+        kbs = [KB.from_dict(friends_schema.attributes, [items[matched], items[other]]),
+               KB.from_dict(friends_schema.attributes, [items[3 - matched - other], items[matched]])]
+        scenario = Scenario('S_%d' % i, friends_schema.attributes, kbs)
+        events = [Event.MessageEvent(0, 'anyone at %s?' % items[matched]['School'].lower()),
+                  Event.MessageEvent(1, 'yes, my friend likes %s' % items[matched]['Hobby'].lower()),
+                  Event.MessageEvent(0, 'works at %s' % items[other]['Company'].lower()),
+                  Event.SelectionEvent(1, items[matched]),
+                  Event.SelectionEvent(0, items[matched])]
+        examples.append(Example(scenario, 'S_%d' % i, events, {'reward': 1}, 'E_%d' % i, {0: 'human', 1: 'human'}))
+    return examples
+
+class TestPreprocessCache(object):
+    @pytest.fixture
+    def schema(self, friends_schema):
+        return friends_schema
+
+    @pytest.fixture
+    def lexicon(self, friends_lexicon):
+        return friends_lexicon
+
+    @pytest.fixture
+    def examples(self, friends_examples):
+        return friends_examples
+
+    def get_tokens(self, dialogue):
+        words = dialogue.token_table.get_words()
+        return dialogue.uuid, dialogue.agents, [words[turns.data].tolist() for turns in dialogue.token_turns]
+
+    def generator(self, schema, lexicon, examples, cache, entity_form='type', attribute_types=None):
+        preprocessor = Preprocessor(schema, lexicon, entity_form, entity_form, entity_form)
+        if attribute_types:
+            preprocessor.attribute_types = attribute_types
+        return DataGenerator(examples, None, None, preprocessor, schema, 3, cache=cache)
+
+    def count_preprocess(self, monkeypatch):
+        calls = []
+        preprocess_examples = Preprocessor.preprocess
+        def counted(preprocessor, examples):
+            # Empty folds are never cached
+            if examples:
+                calls.append(len(examples))
+            return preprocess_examples(preprocessor, examples)
+        monkeypatch.setattr(Preprocessor, 'preprocess', counted)
+        return calls
+
+    def test_cache_hit(self, schema, lexicon, examples, tmpdir, monkeypatch):
+        cache = str(tmpdir)
+        calls = self.count_preprocess(monkeypatch)
+        fresh = self.generator(schema, lexicon, examples, cache)
+        assert calls == [len(examples)]
+        assert len(tmpdir.listdir(lambda p: p.basename.startswith('dialogues-'))) == 1
+
+        cached = self.generator(schema, lexicon, examples, cache)
+        # Loaded from the cache without preprocessing again
+        assert calls == [len(examples)]
+        assert len(cached.dialogues['train']) == len(fresh.dialogues['train']) == len(examples)
+        for d_cached, d_fresh in izip(cached.dialogues['train'], fresh.dialogues['train']):
+            assert self.get_tokens(d_cached) == self.get_tokens(d_fresh)
+            for turns_cached, turns_fresh in izip(d_cached.turns, d_fresh.turns):
+                assert_array_equal(turns_cached.data, turns_fresh.data)
+                assert_array_equal(turns_cached.offsets, turns_fresh.offsets)
+
+    def test_cache_miss(self, schema, lexicon, examples, tmpdir, monkeypatch):
+        cache = str(tmpdir)
+        calls = self.count_preprocess(monkeypatch)
+        self.generator(schema, lexicon, examples, cache)
+
+        # Entity forms are applied when converting to integers: the dialogues are shared
+        # but the integer turns are not
+        self.generator(schema, lexicon, examples, cache, entity_form='canonical')
+        assert calls == [len(examples)]
+        assert len(tmpdir.listdir(lambda p: p.basename.startswith('turns-'))) == 2
+
+        # Fingerprinted options of the lexicon and of the preprocessor
+        stop_words = lexicon.stop_words
+        monkeypatch.setattr(lexicon, 'stop_words', stop_words | set(['zzyzx']))
+        self.generator(schema, lexicon, examples, cache)
+        assert len(calls) == 2
+        monkeypatch.setattr(lexicon, 'stop_words', stop_words)
+        self.generator(schema, lexicon, examples, cache, attribute_types=dict(schema.get_attributes(), Hobby='sport'))
+        assert len(calls) == 3
+        assert len(tmpdir.listdir(lambda p: p.basename.startswith('dialogues-'))) == 3
+
+        # Different examples
+        self.generator(schema, lexicon, examples[:2], cache)
+        assert len(calls) == 4
+        assert len(tmpdir.listdir(lambda p: p.basename.startswith('dialogues-'))) == 4
+
+class TestPreparedData(object):
+    def assert_batches_equal(self, batch, prepared_batch):
+        assert batch['agent'] == prepared_batch['agent']
+        assert_array_equal(batch['matched_items'], prepared_batch['matched_items'])
+        assert [kb.to_dict() for kb in batch['kb']] == [kb.to_dict() for kb in prepared_batch['kb']]
+        assert len(batch['batch_seq']) == len(prepared_batch['batch_seq'])
+        for b, prepared_b in izip(batch['batch_seq'], prepared_batch['batch_seq']):
+            assert sorted(b.keys()) == sorted(prepared_b.keys())
+            for name, value in b.iteritems():
+                if isinstance(value, np.ndarray):
+                    assert value.dtype == prepared_b[name].dtype, name
+                    assert_array_equal(value, prepared_b[name])
+                else:
+                    assert value == prepared_b[name], name
+
+    def test_write_read(self, friends_schema, friends_lexicon, friends_examples, tmpdir):
+        path = str(tmpdir.join('prepared'))
+        preprocessor = Preprocessor(friends_schema, friends_lexicon, 'type', 'type', 'type')
+        generator = DataGenerator(friends_examples, friends_examples[:2], None, preprocessor, friends_schema, 3)
+        batch_size = 2
+        # One shard per batch: 2 dialogue batches with a batch for each agent
+        generator.write_prepared_data(path, batch_size, shard_size=1)
+        assert len(tmpdir.join('prepared').listdir(lambda p: p.basename.startswith('train-'))) == 4
+
+        prepared = PreparedDataGenerator(path, Preprocessor(friends_schema, None, 'type', 'type', 'type'))
+        assert DataGenerator.mappings_fingerprint(prepared.mappings) == DataGenerator.mappings_fingerprint(generator.mappings)
+        # Empty splits are not written
+        assert sorted(prepared.num_examples.keys()) == ['dev', 'train']
+        for name in ('train', 'dev'):
+            assert prepared.num_examples[name] == generator.num_examples[name]
+            batches = generator.generator(name, batch_size, shuffle=False)
+            prepared_batches = prepared.generator(name, batch_size, shuffle=False)
+            num_batches = batches.next()
+            assert prepared_batches.next() == num_batches
+            for _ in xrange(num_batches):
+                self.assert_batches_equal(batches.next(), prepared_batches.next())
+            assert prepared.padding_ratio(name) == generator.padding_ratio(name)
+
+        # Batches are read as written
+        with pytest.raises(AssertionError):
+            prepared.generator('train', batch_size + 1).next()
+        with pytest.raises(AssertionError):
+            PreparedDataGenerator(path, Preprocessor(friends_schema, None, 'canonical', 'type', 'type'))
+
+class TestBucket(object):
+    def get_dialogues(self, schema, eos, turn_lengths):
+        items = [{'Name': 'Alice', 'Company': 'Microsoft', 'Hobby': 'hiking'}]
+        kb = KB.from_dict(schema.attributes, items)
+        dialogues = []
+        for lengths in turn_lengths:
+            dialogue = Dialogue([kb, kb], None)
+            dialogue.turns = (TurnArray.from_turns([[[5] * n] for n in lengths], eos),) * Dialogue.num_stages
+            dialogues.append(dialogue)
+        return dialogues
+
+    def num_pad_tokens(self, groups, pad):
+        num_pad_tokens = 0
+        for group in groups:
+            dialogue_batch = DialogueBatch(group)
+            dialogue_batch._normalize_dialogue()
+            num_pad_tokens += sum([np.sum(turn_batch == pad) for turn_batch in dialogue_batch._create_turn_batches()[Dialogue.ENC]])
+        return num_pad_tokens
+
+    def test_group_dialogues(self, friends_schema, friends_lexicon, friends_examples, monkeypatch):
+        preprocessor = Preprocessor(friends_schema, friends_lexicon, 'type', 'type', 'type')
+        generator = DataGenerator(friends_examples, None, None, preprocessor, friends_schema, 3)
+        monkeypatch.setattr(preprocess, 'int_markers', SpecialSymbols(*range(len(markers))), raising=False)
+        eos, pad = preprocess.int_markers.EOS, preprocess.int_markers.PAD
+        # Long and short turns alternate in different orders: sorting by the number of turns
+        # (or by the average turn length) mixes them in each batch
+        turn_lengths = [[8, 1, 8, 1], [1, 8, 1, 8], [8, 1, 8], [1, 8, 1]] * 2
+        dialogues = self.get_dialogues(friends_schema, eos, turn_lengths)
+        batch_size = 4
+
+        groups = generator.group_dialogues(dialogues, batch_size)
+        assert [[len(d.turns[0]) for d in group] for group in groups] == [[3] * 4, [4] * 4]
+
+        monkeypatch.setattr(generator, 'bucket', True)
+        bucketed_groups = generator.group_dialogues(dialogues, batch_size)
+        assert [len(group) for group in bucketed_groups] == [4] * 2
+        assert sorted([id(d) for group in bucketed_groups for d in group]) == sorted([id(d) for d in dialogues])
+        # Long and short turns are aligned in each batch
+        for group in bucketed_groups:
+            assert len(set([d.turns[0].turn_lengths()[0] for d in group])) == 1
+        assert self.num_pad_tokens(bucketed_groups, pad) < self.num_pad_tokens(groups, pad) / 2
+
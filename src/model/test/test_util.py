@@ -1,8 +1,21 @@
 import pytest
+import copy_reg
+import cPickle as pickle
 import numpy as np
 import tensorflow as tf
 from numpy.testing import assert_array_equal
 from model.util import batch_embedding_lookup, batch_linear
+from model.vocab import Vocabulary
+
+class OldVocabulary(object):
+    '''
+    Pickled as a Vocabulary with the state of one from before ind_to_word was a list.
+    '''
+    def __init__(self, state):
+        self.state = state
+
+    def __reduce__(self):
+        return (copy_reg._reconstructor, (Vocabulary, object, None), self.state)
 
 class TestUtil(object):
     def test_batch_embedding_lookup(self):
@@ -28,3 +41,35 @@ class TestUtil(object):
         assert ans.shape == (2, 3, 3)
         assert_array_equal(ans[0], ans[1])
 
+    def check_vocab(self, vocab, words, offset):
+        assert vocab.ind_to_word == words
+        assert vocab.size == len(words) and vocab.offset == offset
+        assert vocab.unk_ind == offset
+        assert vocab.to_ind(('b', 'type')) == offset + 2
+        assert vocab.to_ind('c') == vocab.unk_ind
+        assert_array_equal(vocab.to_inds(['a', ('b', 'type'), 'c']), [offset + 1, offset + 2, offset])
+        assert vocab.to_words([offset + 2, offset + 1]).tolist() == [('b', 'type'), 'a']
+
+    @pytest.mark.parametrize('protocol', [0, 2])
+    def test_vocab_pickle(self, protocol):
+        offset = 3
+        vocab = Vocabulary(offset=offset)
+        vocab.add_words(['a', ('b', 'type')])
+        new_vocab = pickle.loads(pickle.dumps(vocab, protocol))
+        self.check_vocab(new_vocab, [Vocabulary.UNK, 'a', ('b', 'type')], offset)
+        # Pickled in the dict-based format, which the previous class can load
+        assert vocab.__getstate__()['ind_to_word'] == {3: Vocabulary.UNK, 4: 'a', 5: ('b', 'type')}
+
+    @pytest.mark.parametrize('protocol', [0, 2])
+    def test_vocab_old_pickle(self, protocol):
+        offset = 3
+        state = {'word_to_ind': {Vocabulary.UNK: 3, 'a': 4, ('b', 'type'): 5},
+                 'ind_to_word': {3: Vocabulary.UNK, 4: 'a', 5: ('b', 'type')},
+                 'size': 3,
+                 'offset': offset,
+                }
+        vocab = pickle.loads(pickle.dumps(OldVocabulary(state), protocol))
+        assert type(vocab) is Vocabulary
+        self.check_vocab(vocab, [Vocabulary.UNK, 'a', ('b', 'type')], offset)
+        vocab.add_word('c')
+        assert vocab.to_ind('c') == offset + 3
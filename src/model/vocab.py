@@ -1,3 +1,5 @@
+import numpy as np
+
 # TODO: use named tuple to represent entities?
 def is_entity(word):
     if not isinstance(word, basestring):
@@ -5,17 +7,41 @@ def is_entity(word):
     return False
 
 class Vocabulary(object):
+    '''
+    Map between words and indices (starting from offset). ind_to_word is a list of words
+    by index - offset; to_inds and to_words look up many words or indices at once.
+    A frozen vocabulary cannot be extended, so its lookup arrays are built only once.
+    '''
 
     UNK = '<unk>'
 
     def __init__(self, offset=0, unk=True):
         self.word_to_ind = {}
-        self.ind_to_word = {}
+        self.ind_to_word = []
         self.size = 0
         self.offset = offset
+        self.unk_ind = None
+        self.frozen = False
+        # Object array of ind_to_word, built on first use
+        self.words = None
         if unk:
             self.add_word(self.UNK)
 
+    def __getstate__(self):
+        # Same as the dict-based format of existing vocab.pkl files
+        return {'word_to_ind': self.word_to_ind,
+                'ind_to_word': dict(enumerate(self.ind_to_word, self.offset)),
+                'size': self.size,
+                'offset': self.offset,
+               }
+
+    def __setstate__(self, state):
+        Vocabulary.__init__(self, offset=state['offset'], unk=False)
+        self.word_to_ind = state['word_to_ind']
+        self.ind_to_word = [state['ind_to_word'][i + self.offset] for i in xrange(state['size'])]
+        self.size = state['size']
+        self.unk_ind = self.word_to_ind.get(self.UNK)
+
     def add_words(self, words):
         for w in words:
             self.add_word(w)
@@ -25,24 +51,62 @@ class Vocabulary(object):
 
     def add_word(self, word):
         if not self.has(word):
+            assert not self.frozen, 'Cannot add %s to a frozen vocabulary' % str(word)
             ind = self.size + self.offset
             self.word_to_ind[word] = ind
-            self.ind_to_word[ind] = word
+            self.ind_to_word.append(word)
             self.size += 1
+            if word == self.UNK:
+                self.unk_ind = ind
+
+    def freeze(self):
+        self.frozen = True
+        self.get_words()
 
     def to_ind(self, word):
-        if word in self.word_to_ind:
+        try:
             return self.word_to_ind[word]
-        else:
+        except KeyError:
             # NOTE: if UNK is not enabled, it will throw an exception
-            if self.UNK in self.word_to_ind:
-                return self.word_to_ind[self.UNK]
-            else:
-                raise KeyError(str(word))
+            if self.unk_ind is not None:
+                return self.unk_ind
+            raise KeyError(str(word))
 
     def to_word(self, ind):
-        return self.ind_to_word[ind]
+        if ind < self.offset or ind >= self.offset + self.size:
+            raise KeyError(ind)
+        return self.ind_to_word[ind - self.offset]
+
+    def get_words(self):
+        '''
+        Object array of the word of each index - offset.
+        '''
+        if self.words is None or (not self.frozen and len(self.words) != self.size):
+            words = np.empty(self.size, dtype=object)
+            # Assign one by one as entities are tuples
+            for i, word in enumerate(self.ind_to_word):
+                words[i] = word
+            self.words = words
+        return self.words
+
+    def to_inds(self, words):
+        '''
+        Array of the index of each word.
+        '''
+        if self.unk_ind is None:
+            return np.array([self.to_ind(word) for word in words], dtype=np.int32)
+        word_to_ind, unk_ind = self.word_to_ind, self.unk_ind
+        return np.array([word_to_ind.get(word, unk_ind) for word in words], dtype=np.int32)
+
+    def to_words(self, inds):
+        '''
+        Array (of the same shape as inds) of the word of each index.
+        '''
+        inds = np.asarray(inds, dtype=np.int64) - self.offset
+        if inds.size > 0 and (inds.min() < 0 or inds.max() >= self.size):
+            raise KeyError('Index out of range of the vocabulary')
+        return self.get_words()[inds]
 
     def dump(self):
-        for i, w in self.ind_to_word.iteritems():
+        for i, w in enumerate(self.ind_to_word, self.offset):
             print '{:<8}{:<}'.format(i, w)
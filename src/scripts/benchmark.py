@@ -0,0 +1,123 @@
+'''
+Micro-benchmarks of the preprocessing pipeline on a transcript corpus.
+'''
+
+import argparse
+import re
+import time
+from src.basic.util import read_json
+from src.basic.schema import Schema
+from src.basic.scenario_db import ScenarioDB, add_scenario_arguments
+from src.basic.dataset import read_examples
+from src.basic.lexicon import Lexicon, add_lexicon_arguments
+from src.model.preprocess import tokenize, tokenize_batch, Preprocessor, DataGenerator, DialogueBatch, add_preprocess_arguments
+
+def timeit(func, repeat):
+    '''
+    Return the best time of repeat runs of func.
+    '''
+    times = []
+    for _ in xrange(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+def reference_tokenize(utterance):
+    '''
+    The original preprocess.tokenize, to validate the output of the fast tokenizer against.
+    '''
+    utterance = utterance.encode('utf-8').lower()
+    for s in (' - ', '-'):
+        utterance = utterance.replace(s, ' ')
+    return re.findall(r"[\w']+|[.,!?;&-]", utterance)
+
+def benchmark_tokenize(args, examples):
+    utterances = [e.data for ex in examples for e in ex.events if e.action == 'message']
+    expected = [reference_tokenize(u) for u in utterances]
+    assert [tokenize(u) for u in utterances] == expected, 'tokenize differs from the reference'
+    assert tokenize_batch(utterances) == expected, 'tokenize_batch differs from the reference'
+    print '%d utterances (%d unique), output identical to the reference' % (len(utterances), len(set(utterances)))
+
+    for name, func in (('reference', lambda: [reference_tokenize(u) for u in utterances]),
+                       ('tokenize', lambda: [tokenize(u) for u in utterances]),
+                       ('tokenize_batch', lambda: tokenize_batch(utterances))):
+        t = timeit(func, args.repeat)
+        print '%s: %.3fs (best of %d), %.0f utterances/s' % (name, t, args.repeat, len(utterances) / t)
+
+def benchmark_link_entity(args, schema, examples):
+    # Time linking itself rather than the cache of linked utterances
+    lexicon = Lexicon(schema, False, stop_words=args.stop_words, lexicon_cache=args.lexicon_cache, fuzzy_index=args.fuzzy_index, link_cache_size=0)
+    dialogues = []
+    for ex in examples:
+        utterances = [tokenize(e.data) if e.action == 'message' else None for e in ex.events]
+        kbs = [ex.scenario.kbs[e.agent] for e in ex.events]
+        dialogues.append((utterances, kbs))
+    num_utterances = sum([len([u for u in utterances if u is not None]) for utterances, _ in dialogues])
+    num_tokens = sum([len(u) for utterances, _ in dialogues for u in utterances if u is not None])
+
+    def link():
+        for utterances, kbs in dialogues:
+            lexicon.link_dialogue(utterances, kbs)
+    t = timeit(link, args.repeat)
+
+    # Count lexicon lookups in a separate run so that counting is not timed
+    lookup = lexicon.lookup
+    num_lookups = [0]
+    def counted_lookup(phrase):
+        num_lookups[0] += 1
+        return lookup(phrase)
+    lexicon.lookup = counted_lookup
+    link()
+
+    print '%d utterances, %d tokens' % (num_utterances, num_tokens)
+    print 'link_entity: %.3fs (best of %d), %.3f ms/utterance, %.2f lookups/token' % \
+            (t, args.repeat, t * 1000. / num_utterances, num_lookups[0] / float(num_tokens))
+
+def benchmark_create_batches(args, schema, examples):
+    lexicon = Lexicon(schema, False, stop_words=args.stop_words, lexicon_cache=args.lexicon_cache, fuzzy_index=args.fuzzy_index, lexicon_mmap=args.lexicon_mmap)
+    preprocessor = Preprocessor(schema, lexicon, args.entity_encoding_form, args.entity_decoding_form, args.entity_target_form)
+    data = DataGenerator(examples, None, None, preprocessor, schema, args.num_items, bucket=args.bucket)
+    dialogues = data.dialogues['train']
+    for dialogue in dialogues:
+        dialogue.convert_to_int()
+    # Batch the dialogues as DataGenerator.create_dialogue_batches does
+    groups = data.group_dialogues(dialogues, args.batch_size)
+    num_batches = len(groups)
+
+    def create():
+        for group in groups:
+            DialogueBatch(group).create_batches()
+    t = timeit(create, args.repeat)
+
+    print '%d dialogues, %d batches of size %d' % (len(dialogues), num_batches, args.batch_size)
+    print 'create_batches: %.3fs (best of %d), %.3f ms/batch' % \
+            (t, args.repeat, t * 1000. / num_batches)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=['link_entity', 'create_batches', 'tokenize'], help='Stage to benchmark')
+    parser.add_argument('--domain', type=str, choices=['MutualFriends', 'Matchmaking'])
+    parser.add_argument('--transcripts', nargs='+', required=True, help='Paths to transcripts (examples) to run on')
+    parser.add_argument('--max-examples', type=int, help='Maximum number of examples to run on')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs (the best one is reported)')
+    parser.add_argument('--batch-size', type=int, default=32, help='Number of dialogues in a batch (create_batches)')
+    parser.add_argument('--num-items', type=int, default=10, help='Maximum number of items in each KB (create_batches)')
+    add_scenario_arguments(parser)
+    add_lexicon_arguments(parser)
+    add_preprocess_arguments(parser)
+    args = parser.parse_args()
+    if args.learned_lex:
+        # It needs an EntityRanker trained from annotated examples
+        parser.error('--learned-lex is not supported; the benchmarks use the rule-based lexicon')
+
+    schema = Schema(args.schema_path, args.domain)
+    scenario_db = ScenarioDB.from_dict(schema, read_json(args.scenarios_path))
+    examples = read_examples(scenario_db, args.transcripts, args.max_examples)
+
+    if args.benchmark == 'link_entity':
+        benchmark_link_entity(args, schema, examples)
+    elif args.benchmark == 'create_batches':
+        benchmark_create_batches(args, schema, examples)
+    elif args.benchmark == 'tokenize':
+        benchmark_tokenize(args, examples)
@@ -0,0 +1,42 @@
+'''
+Prebuild the lexicon artifact so that training, the web app and dataset generation
+can load it from --lexicon-cache instead of recomputing all synonyms at startup.
+With --inverse-lexicon, also prebuild the realization table of the inverse lexicon.
+'''
+
+import argparse
+import time
+from src.basic.schema import Schema
+from src.basic.lexicon import Lexicon, add_lexicon_arguments
+from src.basic.inverse_lexicon import InverseLexicon
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--schema-path', help='Input path that describes the schema of the domain', required=True)
+    parser.add_argument('--domain', type=str, choices=['MutualFriends', 'Matchmaking'])
+    parser.add_argument('--force', default=False, action='store_true', help='Rebuild the artifact even if it exists')
+    add_lexicon_arguments(parser)
+    args = parser.parse_args()
+    assert args.lexicon_cache, 'Provide --lexicon-cache to write the artifact to'
+
+    schema = Schema(args.schema_path, args.domain)
+    start = time.time()
+    if args.force:
+        lexicon = Lexicon(schema, stop_words=args.stop_words, fuzzy_index=args.fuzzy_index)
+        # Save in the format the lexicon will be loaded in
+        lexicon.lexicon_mmap = args.lexicon_mmap
+        path = lexicon.save(args.lexicon_cache, replace=True)
+    else:
+        lexicon = Lexicon(schema, stop_words=args.stop_words, lexicon_cache=args.lexicon_cache, fuzzy_index=args.fuzzy_index, lexicon_mmap=args.lexicon_mmap)
+        path = lexicon.artifact_path(args.lexicon_cache)
+    print 'Lexicon artifact %s [%.2fs]' % (path, time.time() - start)
+
+    if args.inverse_lexicon:
+        start = time.time()
+        if args.force:
+            realizer = InverseLexicon(schema, args.inverse_lexicon)
+            path = realizer.save(args.lexicon_cache, args.inverse_lexicon)
+        else:
+            realizer = InverseLexicon(schema, args.inverse_lexicon, lexicon_cache=args.lexicon_cache)
+            path = realizer.artifact_path(args.lexicon_cache, args.inverse_lexicon)
+        print 'Inverse lexicon artifact %s [%.2fs]' % (path, time.time() - start)
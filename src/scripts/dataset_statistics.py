@@ -359,11 +359,13 @@ def analyze_strategy(all_chats, scenario_db, preprocessor, text_output, lm):
     total_dialogues = 0.
 
     lm_summary_map = {}
-    for raw in all_chats:
-        ex = Example.from_dict(scenario_db, raw)
+    all_examples = [Example.from_dict(scenario_db, raw) for raw in all_chats]
+    # skip incomplete dialogues
+    all_examples = [ex for ex in all_examples if ex.outcome is not None and ex.outcome["reward"] != 0]
+    # Link entities of all dialogues at once (in parallel); selections are not counted as mentions here
+    all_linked_events = preprocessor.link_examples(all_examples, select_mentions=False)
+    for ex, linked_events in izip(all_examples, all_linked_events):
         kbs = ex.scenario.kbs
-        if ex.outcome is None or ex.outcome["reward"] == 0:
-            continue  # skip incomplete dialogues
         total_dialogues += 1.
         dialog = []
         mentioned_entities = set()
@@ -371,7 +373,7 @@ def analyze_strategy(all_chats, scenario_db, preprocessor, text_output, lm):
             if event.action == 'select':
                 utterance = []
             elif event.action == 'message':
-                utterance = preprocessor.process_event(event, kbs[event.agent], mentioned_entities)
+                utterance = preprocessor.process_event(event, kbs[event.agent], mentioned_entities, entity_tokens=linked_events[i])
                 # Skip empty utterances
                 if not utterance:
                     continue
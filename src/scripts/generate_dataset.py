@@ -5,7 +5,7 @@ Takes two agent implementations and generates the dialogues.
 import argparse
 import random
 import json
-from src.basic.util import read_json
+from src.basic.util import read_json, write_jsonl
 from src.basic.schema import Schema
 from src.basic.scenario_db import ScenarioDB, add_scenario_arguments
 from src.basic.dataset import add_dataset_arguments
@@ -38,9 +38,9 @@ if args.random_seed:
 
 schema = Schema(args.schema_path)
 scenario_db = ScenarioDB.from_dict(schema, read_json(args.scenarios_path))
-lexicon = Lexicon(schema, args.learned_lex, stop_words=args.stop_words)
+lexicon = Lexicon(schema, args.learned_lex, stop_words=args.stop_words, lexicon_cache=args.lexicon_cache, fuzzy_index=args.fuzzy_index, link_cache_size=args.link_cache_size, lexicon_mmap=args.lexicon_mmap)
 if args.inverse_lexicon:
-    realizer = InverseLexicon(schema, args.inverse_lexicon)
+    realizer = InverseLexicon(schema, args.inverse_lexicon, lexicon_cache=args.lexicon_cache)
 else:
     realizer = None
 
@@ -82,8 +82,11 @@ def generate_examples(description, examples_path, max_examples, remove_fail, max
         examples.append(ex)
         num_examples += 1
         logstats.update_summary_map(summary_map, {'length': len(ex.events)})
-    with open(examples_path, 'w') as out:
-        print >>out, json.dumps([e.to_dict() for e in examples])
+    if examples_path.endswith('.jsonl'):
+        write_jsonl((e.to_dict() for e in examples), examples_path)
+    else:
+        with open(examples_path, 'w') as out:
+            print >>out, json.dumps([e.to_dict() for e in examples])
     print 'number of failed dialogues:', num_failed
 
     logstats.add('length', summary_map['length']['mean'])
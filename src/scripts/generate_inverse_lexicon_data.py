@@ -40,7 +40,7 @@ if __name__ == "__main__":
 
     re_pattern = r"[\w*\']+|[(\w*&)]+|[\w]+|\.|\(|\)|\\|\"|\/|;|\#|\$|\%|\@|\{|\}|\:"
 
-    lexicon = Lexicon(schema, learned_lex=False, entity_ranker=None, scenarios_json=args.scenarios_json, stop_words=args.stop_words)
+    lexicon = Lexicon(schema, learned_lex=False, entity_ranker=None, scenarios_json=args.scenarios_json, stop_words=args.stop_words, lexicon_cache=args.lexicon_cache, fuzzy_index=args.fuzzy_index, link_cache_size=args.link_cache_size, lexicon_mmap=args.lexicon_mmap)
 
     with open(args.annotated_examples_path, "r") as f:
         annotated_examples = json.load(f)
@@ -42,7 +42,7 @@ def compute_statistics(args, lexicon, schema, scenario_db, transcripts):
         lm = None
 
     # Speech acts
-    preprocessor = Preprocessor(schema, lexicon, 'canonical', 'canonical', 'canonical')
+    preprocessor = Preprocessor(schema, lexicon, 'canonical', 'canonical', 'canonical', num_workers=args.link_workers)
     strategy_stats = analyze_strategy(transcripts, scenario_db, preprocessor, args.text_output, lm)
     print_strategy_stats(strategy_stats)
     stats["speech_act"] = {k[0]: v for k, v in strategy_stats['speech_act'].iteritems() if len(k) == 1}
@@ -73,5 +73,5 @@ if __name__ == "__main__":
     scenario_db = ScenarioDB.from_dict(schema, read_json(parsed_args.scenarios_path))
     transcripts = json.load(open(parsed_args.transcripts, 'r'))
     # transcripts = transcripts[:100]
-    lexicon = Lexicon(schema, False, scenarios_json=parsed_args.scenarios_path, stop_words=parsed_args.stop_words)
+    lexicon = Lexicon(schema, False, scenarios_json=parsed_args.scenarios_path, stop_words=parsed_args.stop_words, lexicon_cache=parsed_args.lexicon_cache, fuzzy_index=parsed_args.fuzzy_index, link_cache_size=parsed_args.link_cache_size, lexicon_mmap=parsed_args.lexicon_mmap)
     compute_statistics(parsed_args, lexicon, schema, scenario_db, transcripts)
@@ -0,0 +1,49 @@
+'''
+Preprocess and batch examples once and write the integer batches to --prepared-data,
+so that training jobs (main.py --prepared-data) can share them instead of preprocessing.
+'''
+
+import argparse
+import time
+from src.basic.util import read_json, read_pickle
+from src.basic.dataset import add_dataset_arguments, read_dataset
+from src.basic.schema import Schema
+from src.basic.scenario_db import ScenarioDB, add_scenario_arguments
+from src.basic.lexicon import Lexicon, add_lexicon_arguments
+from src.model.preprocess import DataGenerator, Preprocessor, add_preprocess_arguments
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--domain', type=str, choices=['MutualFriends', 'Matchmaking'])
+    parser.add_argument('--test', default=False, action='store_true', help='Prepare the test examples for testing (otherwise training examples and test examples as dev)')
+    parser.add_argument('--model', default='encdec', help='Model the data is prepared for (determines entity forms)')
+    parser.add_argument('--num-items', type=int, default=10, help='Maximum number of items in each KB')
+    parser.add_argument('--batch-size', type=int, default=1, help='Number of dialogues in a batch')
+    parser.add_argument('--shard-size', type=int, default=100, help='Number of batches in each shard')
+    parser.add_argument('--mappings', help='Path to mappings (vocab.pkl) to encode with, e.g. of a trained model; built from the training examples if not given')
+    add_scenario_arguments(parser)
+    add_lexicon_arguments(parser)
+    add_dataset_arguments(parser)
+    add_preprocess_arguments(parser)
+    args = parser.parse_args()
+    assert args.prepared_data, 'Provide --prepared-data to write the batches to'
+
+    schema = Schema(args.schema_path, args.domain)
+    scenario_db = ScenarioDB.from_dict(schema, read_json(args.scenarios_path))
+    dataset = read_dataset(scenario_db, args)
+    lexicon = Lexicon(schema, args.learned_lex, stop_words=args.stop_words, lexicon_cache=args.lexicon_cache, fuzzy_index=args.fuzzy_index, lexicon_mmap=args.lexicon_mmap)
+
+    # Same as main.py
+    copy = True if args.model == 'attn-copy-encdec' else False
+    if args.model == 'attn-copy-encdec':
+        args.entity_target_form = 'graph'
+    preprocessor = Preprocessor(schema, lexicon, args.entity_encoding_form, args.entity_decoding_form, args.entity_target_form, num_workers=args.link_workers)
+    mappings = read_pickle(args.mappings) if args.mappings else None
+    if args.test:
+        data_generator = DataGenerator(None, None, dataset.test_examples, preprocessor, schema, args.num_items, mappings, copy=copy, cache=args.preprocess_cache, bucket=args.bucket)
+    else:
+        data_generator = DataGenerator(dataset.train_examples, dataset.test_examples, None, preprocessor, schema, args.num_items, mappings, copy=copy, cache=args.preprocess_cache, bucket=args.bucket)
+
+    start = time.time()
+    data_generator.write_prepared_data(args.prepared_data, args.batch_size, args.shard_size)
+    print 'Prepared data %s [%.2fs]' % (args.prepared_data, time.time() - start)
@@ -331,7 +331,7 @@ if __name__ == '__main__':
 
     if args.analyze:
         schema = Schema(args.schema_path)
-        lexicon = Lexicon(schema, False, scenarios_json=args.scenarios_path, stop_words=args.stop_words)
+        lexicon = Lexicon(schema, False, scenarios_json=args.scenarios_path, stop_words=args.stop_words, lexicon_cache=args.lexicon_cache, fuzzy_index=args.fuzzy_index, link_cache_size=args.link_cache_size, lexicon_mmap=args.lexicon_mmap)
         preprocessor = Preprocessor(schema, lexicon, 'canonical', 'canonical', 'canonical')
         analyze(question_scores, uuid_to_chat, preprocessor)
 
@@ -9,7 +9,7 @@ from src.basic.kb import KB
 from argparse import ArgumentParser
 from src.basic.scenario_db import add_scenario_arguments, ScenarioDB
 from src.basic.schema import Schema
-from src.basic.util import read_json
+from src.basic.util import read_json, write_jsonl
 from datetime import datetime
 
 date_fmt = '%Y-%m-%d %H-%M-%S'
@@ -74,9 +74,12 @@ def log_transcripts_to_json(scenario_db, db_path, json_path, uids):
         ex = convert_events_to_json(chat_id[0], cursor, scenario_db)
         examples.append(ex)
 
-    outfile = open(json_path, 'w')
-    json.dump([ex.to_dict() for ex in examples], outfile)
-    outfile.close()
+    if json_path.endswith('.jsonl'):
+        write_jsonl((ex.to_dict() for ex in examples), json_path)
+    else:
+        outfile = open(json_path, 'w')
+        json.dump([ex.to_dict() for ex in examples], outfile)
+        outfile.close()
     conn.close()
 
 
@@ -130,7 +133,7 @@ if __name__ == "__main__":
     parser.add_argument('--db', type=str, required=True, help='Path to database file containing logged events')
     parser.add_argument('--domain', type=str,
                         choices=['MutualFriends', 'Matchmaking'])
-    parser.add_argument('--output', type=str, required=True, help='File to write JSON examples to.')
+    parser.add_argument('--output', type=str, required=True, help='File to write JSON examples to (JSON lines if it ends with .jsonl).')
     parser.add_argument('--uid', type=str, nargs='*', help='Only print chats from these uids')
     parser.add_argument('--surveys', type=str, help='If provided, writes a file containing results from user surveys.')
     args = parser.parse_args()
@@ -215,9 +215,9 @@ if __name__ == "__main__":
 
     schema = Schema(schema_path, domain=args.domain)
     # todo in the future would we want individual models to have different lexicons?
-    lexicon = Lexicon(schema, args.learned_lex, stop_words=args.stop_words)
+    lexicon = Lexicon(schema, args.learned_lex, stop_words=args.stop_words, lexicon_cache=args.lexicon_cache, fuzzy_index=args.fuzzy_index, link_cache_size=args.link_cache_size, lexicon_mmap=args.lexicon_mmap)
     if args.inverse_lexicon:
-        realizer = InverseLexicon(schema, args.inverse_lexicon)
+        realizer = InverseLexicon(schema, args.inverse_lexicon, lexicon_cache=args.lexicon_cache)
     else:
         realizer = None
     scenario_db = ScenarioDB.from_dict(schema, read_json(args.scenarios_path))